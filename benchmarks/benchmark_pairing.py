@@ -0,0 +1,194 @@
+"""Benchmark pairs_from_summary, filter_pairs and pair on simulated runs.
+
+Runs of reads, some of which are duplex template/complement pairs, are
+simulated with `duplex_tools.simulate` as a sequencing summary and a
+dorado-like uBAM. The stages of pairing are timed on them and throughput,
+peak memory and pairing precision/recall against the simulated pairs are
+reported, for example:
+
+    python benchmarks/benchmark_pairing.py --n_reads 10000 1000000
+
+Writing and reading the uBAM dominates at large scales, so stages using it
+only run up to `--max_bam_reads`; `find_pairs` on the sequencing summary
+runs at every scale, including 10M reads. Results are labelled with the
+git commit, so runs on different commits can be compared.
+
+Each stage is run in a fresh process so that peak memory is attributed to
+that stage alone.
+"""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import json
+from pathlib import Path
+import subprocess
+import tempfile
+
+import pandas as pd
+
+import duplex_tools
+from duplex_tools import simulate
+from duplex_tools.filter_pairs import align_all_pairs, read_all_sequences
+from duplex_tools.pair import pair_and_align
+from duplex_tools.pairs_from_summary import find_pairs
+
+from benchmark_split import precision_recall, run_isolated  # noqa: I100
+
+# defaults of the pair command
+PAIR_PARAMS = {
+    'max_time_between_reads': 200000, 'max_seqlen_diff': 0.1,
+    'max_abs_seqlen_diff': 5000, 'min_qscore': 6}
+FILTER_PARAMS = {
+    'bases_to_align': 250, 'align_threshold': 0.6, 'penalty_open': 4,
+    'penalty_extend': 1, 'score_match': 2, 'score_mismatch': -1,
+    'min_length': 1, 'max_length': float('inf'), 'no_end_penalties': False}
+
+
+def git_commit():
+    """Return the current git commit, or None outside of a repository."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _find_pairs(path):
+    return find_pairs(path, outdir=None, **PAIR_PARAMS)
+
+
+def _align_all_pairs(fastq_index, pairs):
+    params = FILTER_PARAMS
+    return align_all_pairs(
+        params['align_threshold'], fastq_index, params['bases_to_align'],
+        pairs, params['penalty_extend'], params['penalty_open'],
+        params['score_match'], params['score_mismatch'],
+        params['min_length'], params['max_length'],
+        params['no_end_penalties'])
+
+
+def _pair(bam, output_dir, threads):
+    return pair_and_align(
+        bam, output_dir=output_dir, threads=threads, **PAIR_PARAMS,
+        **FILTER_PARAMS)
+
+
+def _scored_pairs(scored):
+    passed = scored[scored['score'] > FILTER_PARAMS['align_threshold']]
+    return set(zip(passed['read_id'], passed['read_id_next']))
+
+
+def _result(stage, n_reads, seconds, rss, pairs=None, truth=None):
+    result = {
+        'stage': stage, 'reads': n_reads, 'seconds': seconds,
+        'reads_per_s': n_reads / seconds, 'peak_rss_mb': rss}
+    if pairs is not None:
+        precision, recall = precision_recall(
+            len(pairs & truth), len(pairs), len(truth))
+        result.update(
+            {'pairs': len(pairs), 'precision': precision, 'recall': recall})
+    return result
+
+
+def benchmark_pairing(
+        workdir, n_reads, threads, seed, min_length, max_length,
+        error_rate, with_bam):
+    """Benchmark the stages of pairing on a simulated run.
+
+    :param with_bam: also simulate a uBAM and benchmark the stages reading
+        it, otherwise only `find_pairs` on the sequencing summary is run.
+    """
+    summary = simulate.simulate_pairing_summary(
+        n_reads, min_length=min_length, max_length=max_length, seed=seed)
+    truth = simulate.pairing_truth(summary)
+    summary_path = Path(workdir, f'summary_{n_reads}.txt')
+    simulate.write_sequencing_summary(summary_path, summary)
+    bam = Path(workdir, f'reads_{n_reads}.bam')
+    if with_bam:
+        simulate.write_dorado_bam(bam, summary, error_rate, seed=seed)
+    del summary
+
+    results = []
+    pairs, seconds, rss = run_isolated(_find_pairs, summary_path)
+    candidates = set(zip(pairs['read_id'], pairs['read_id_next']))
+    results.append(_result(
+        'find_pairs_summary', n_reads, seconds, rss, candidates, truth))
+    if not with_bam:
+        return results
+
+    pairs, seconds, rss = run_isolated(_find_pairs, str(bam))
+    candidates = set(zip(pairs['read_id'], pairs['read_id_next']))
+    results.append(_result(
+        'find_pairs_bam', n_reads, seconds, rss, candidates, truth))
+
+    pairs = pairs.set_axis(['first', 'second'], axis=1)
+    fastq_index, seconds, rss = run_isolated(
+        read_all_sequences, str(bam), pairs,
+        FILTER_PARAMS['bases_to_align'], threads)
+    results.append(_result('read_all_sequences', n_reads, seconds, rss))
+
+    scored, seconds, rss = run_isolated(_align_all_pairs, fastq_index, pairs)
+    results.append(_result(
+        'align_all_pairs', n_reads, seconds, rss, _scored_pairs(scored),
+        truth))
+    del fastq_index
+
+    scored, seconds, rss = run_isolated(
+        _pair, str(bam), Path(workdir, f'pair_{n_reads}'), threads)
+    results.append(_result(
+        'pair', n_reads, seconds, rss, _scored_pairs(scored), truth))
+    return results
+
+
+def argparser():
+    """Create argument parser."""
+    parser = ArgumentParser(
+        "Benchmark read pairing on simulated data.",
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--n_reads", type=int, nargs='+', default=[10000],
+        help="Numbers of reads to simulate, one benchmark for each.")
+    parser.add_argument(
+        "--max_bam_reads", type=int, default=1000000,
+        help="Only benchmark stages reading the uBAM up to this many reads.")
+    parser.add_argument(
+        "--min_length", type=int, default=1000,
+        help="Minimum length of the simulated templates.")
+    parser.add_argument(
+        "--max_length", type=int, default=10000,
+        help="Maximum length of the simulated templates.")
+    parser.add_argument(
+        "--error_rate", type=float, default=0.05,
+        help="Error rate of the complements relative to their template.")
+    parser.add_argument(
+        "--threads", type=int, default=None,
+        help="Number of threads reading the uBAM.")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Random seed for the simulation.")
+    parser.add_argument(
+        "--output",
+        help="Write results to this JSON file.")
+    return parser
+
+
+def main():
+    """Run the benchmarks."""
+    args = argparser().parse_args()
+    results = []
+    for n_reads in args.n_reads:
+        with tempfile.TemporaryDirectory() as workdir:
+            results.extend(benchmark_pairing(
+                workdir, n_reads, args.threads, args.seed, args.min_length,
+                args.max_length, args.error_rate,
+                with_bam=n_reads <= args.max_bam_reads))
+    commit, version = git_commit(), duplex_tools.__version__
+    for result in results:
+        result.update({'commit': commit, 'version': version})
+    print(pd.DataFrame(results).to_string(index=False, float_format='%.3g'))
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""Benchmark split_on_adapter and split_pairs on simulated reads.
+
+Reads with known structure are simulated with `duplex_tools.simulate`, the
+splitting steps are run on them and throughput, peak memory and splitting
+accuracy are reported. Everything runs locally, for example:
+
+    python benchmarks/benchmark_split.py --n_reads 2000 --threads 4
+
+Each step is run in a fresh process so that peak memory is attributed to
+that step alone.
+"""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+from pathlib import Path
+import resource
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from duplex_tools import simulate
+from duplex_tools.split_on_adapter import (
+    build_targets, find_mid_adaptor, mask_size_default_head,
+    mask_size_default_N, mask_size_default_tail, split)
+from duplex_tools.split_pairs_steps import get_split_points
+from duplex_tools.writers import ManifestWriter
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and its children in MB."""
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start, peak_rss_mb()
+
+
+def run_isolated(func, *args, **kwargs):
+    """Run a function in a fresh process.
+
+    :returns: tuple of (result, wall time, peak RSS in MB).
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(_timed, func, *args, **kwargs).result()
+
+
+def precision_recall(n_true_positive, n_predicted, n_positive):
+    """Calculate precision and recall, defaulting to 1 when undefined."""
+    precision = n_true_positive / n_predicted if n_predicted else 1.0
+    recall = n_true_positive / n_positive if n_positive else 1.0
+    return precision, recall
+
+
+def _split_on_adapter(input_dir, output_dir, sample_type, threads):
+    split(input_dir, output_dir=output_dir, type=sample_type,
+          threads=threads)
+    manifests = sorted(Path(output_dir).glob(f'*{ManifestWriter.suffix}'))
+    return pd.concat([pd.read_parquet(x) for x in manifests])
+
+
+def benchmark_split_on_adapter(
+        workdir, n_reads, sample_type, error_rate, threads, seed,
+        tolerance=50):
+    """Benchmark split_on_adapter on simulated concatemers.
+
+    A split read is counted as correct when one of its split points lies
+    within `tolerance` bases of the inserted adapter.
+    """
+    input_dir = Path(workdir, f'concatemers_{sample_type}')
+    input_dir.mkdir()
+    records = list(simulate.simulate_concatemers(
+        n_reads, sample_type=sample_type, error_rate=error_rate, seed=seed))
+    nbases = sum(len(x[1]) for x in records)
+    truth = simulate.write_fastq(input_dir / 'reads.fastq', records)
+    del records
+
+    manifest, seconds, rss = run_isolated(
+        _split_on_adapter, input_dir,
+        Path(workdir, f'split_{sample_type}'), sample_type, threads)
+
+    n_true_positive = 0
+    predicted = manifest[manifest['status'] == 'split']
+    for read_id, ends in zip(predicted['read_id'], predicted['ends']):
+        start, end = truth[read_id]
+        if start is not None and any(
+                start - tolerance <= x <= end + tolerance for x in ends[:-1]):
+            n_true_positive += 1
+    n_positive = sum(x[0] is not None for x in truth.values())
+    precision, recall = precision_recall(
+        n_true_positive, len(predicted), n_positive)
+    return {
+        'subcommand': 'split_on_adapter', 'sample_type': sample_type,
+        'error_rate': error_rate, 'reads': n_reads, 'bases': nbases,
+        'seconds': seconds, 'reads_per_s': n_reads / seconds,
+        'bases_per_s': nbases / seconds, 'peak_rss_mb': rss,
+        'precision': precision, 'recall': recall}
+
+
+def benchmark_adapter_search(n_reads, error_rate, seed, length=20000):
+    """Time the adapter search of each sample type on the same reads.
+
+    The PCR search aligns each of its four primer combinations to the
+    whole read, Native a single adapter.
+    """
+    records = list(simulate.simulate_concatemers(
+        n_reads, sample_type='PCR', error_rate=error_rate,
+        min_length=length, max_length=length + 1, seed=seed))
+    nbases = sum(len(x[1]) for x in records)
+    targets = build_targets(
+        n_bases_to_mask_head=mask_size_default_head,
+        n_bases_to_mask_tail=mask_size_default_tail,
+        degenerate_bases=mask_size_default_N)
+    results = []
+    for sample_type in ('Native', 'PCR'):
+        start = time.perf_counter()
+        for _, seq, *_ in records:
+            find_mid_adaptor(seq, targets[sample_type])
+        seconds = time.perf_counter() - start
+        results.append({
+            'subcommand': 'find_mid_adaptor', 'sample_type': sample_type,
+            'error_rate': error_rate, 'reads': n_reads, 'bases': nbases,
+            'seconds': seconds, 'reads_per_s': n_reads / seconds,
+            'bases_per_s': nbases / seconds})
+    return results
+
+
+def benchmark_split_pairs(
+        workdir, n_reads, error_rate, threads, seed, tolerance=1000,
+        fraction_pairs=0.1):
+    """Benchmark finding split points of template/complement reads.
+
+    A split read is counted as correct when its split point lies within
+    `tolerance` signal samples of the simulated midpoint. The detection is
+    run with and without the k-mer pre-screen to measure its recall
+    against self-aligning every read.
+    """
+    bam = Path(workdir, 'tempcomp.bam')
+    records = list(simulate.simulate_template_complement(
+        n_reads, fraction_pairs=fraction_pairs, error_rate=error_rate,
+        seed=seed))
+    nbases = sum(len(x[1]) for x in records)
+    truth = simulate.write_moves_bam(bam, records)
+    del records
+
+    results = []
+    unscreened = None
+    for prescreen in (False, True):
+        split_locations, seconds, rss = run_isolated(
+            get_split_points, str(bam), threads, prescreen=prescreen)
+
+        n_true_positive = 0
+        for read_id, location in split_locations.items():
+            if truth[read_id] is not None and \
+                    abs(location['left'][1] - truth[read_id][1]) <= tolerance:
+                n_true_positive += 1
+        n_positive = sum(x is not None for x in truth.values())
+        precision, recall = precision_recall(
+            n_true_positive, len(split_locations), n_positive)
+        if unscreened is None:
+            unscreened = set(split_locations)
+        results.append({
+            'subcommand': 'split_pairs', 'prescreen': prescreen,
+            'error_rate': error_rate, 'reads': n_reads, 'bases': nbases,
+            'seconds': seconds, 'reads_per_s': n_reads / seconds,
+            'bases_per_s': nbases / seconds, 'peak_rss_mb': rss,
+            'precision': precision, 'recall': recall,
+            # fraction of reads split without the pre-screen still found
+            'recall_vs_unscreened': precision_recall(
+                len(unscreened & set(split_locations)), 0,
+                len(unscreened))[1]})
+    return results
+
+
+def argparser():
+    """Create argument parser."""
+    parser = ArgumentParser(
+        "Benchmark read splitting on simulated data.",
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--n_reads", type=int, default=2000,
+        help="Number of reads to simulate for each benchmark.")
+    parser.add_argument(
+        "--error_rates", type=float, nargs='+', default=[0.05],
+        help="Error rates of the simulated adapters and complements.")
+    parser.add_argument(
+        "--sample_types", nargs='+', default=['Native', 'PCR'],
+        choices=['Native', 'PCR'],
+        help="Sample types to benchmark split_on_adapter with.")
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="Number of worker processes.")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Random seed for the simulation.")
+    parser.add_argument(
+        "--output",
+        help="Write results to this JSON file.")
+    return parser
+
+
+def main():
+    """Run the benchmarks."""
+    args = argparser().parse_args()
+    results = []
+    for error_rate in args.error_rates:
+        with tempfile.TemporaryDirectory() as workdir:
+            for sample_type in args.sample_types:
+                results.append(benchmark_split_on_adapter(
+                    workdir, args.n_reads, sample_type, error_rate,
+                    args.threads, args.seed))
+            results.extend(benchmark_adapter_search(
+                min(args.n_reads, 200), error_rate, args.seed))
+            results.extend(benchmark_split_pairs(
+                workdir, args.n_reads, error_rate, args.threads, args.seed))
+    print(pd.DataFrame(results).to_string(index=False, float_format='%.3g'))
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
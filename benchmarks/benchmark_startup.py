@@ -0,0 +1,96 @@
+"""Benchmark the startup time of the duplex_tools command line.
+
+Each subcommand is started with `--help` in a fresh interpreter, as a
+workflow engine starting many short jobs would, and the wall time to
+exit is reported along with the heavy dependencies which were imported,
+for example:
+
+    python benchmarks/benchmark_startup.py --repeats 5
+"""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+import duplex_tools
+
+HEAVY_DEPENDENCIES = (
+    'edlib', 'mappy', 'matplotlib', 'pandas', 'parasail', 'pod5', 'pysam')
+# run the CLI and report the heavy dependencies it imported
+SCRIPT = """
+import json, sys
+from duplex_tools import main
+try:
+    main({argv!r})
+except SystemExit:
+    pass
+print(json.dumps(sorted(
+    x for x in {heavy!r} if x in sys.modules)), file=sys.stderr)
+"""
+
+
+def startup(argv):
+    """Run the CLI in a fresh interpreter.
+
+    :param argv: command line arguments.
+    :returns: tuple of (wall time, list of heavy dependencies imported).
+    """
+    script = SCRIPT.format(argv=argv, heavy=HEAVY_DEPENDENCIES)
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', script], stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, check=True, text=True)
+    seconds = time.perf_counter() - start
+    return seconds, json.loads(result.stderr.splitlines()[-1])
+
+
+def benchmark_startup(argv, repeats):
+    """Time the startup of the CLI with the given arguments.
+
+    :param argv: command line arguments.
+    :param repeats: number of times to start the CLI.
+    """
+    # the first run warms the filesystem cache
+    startup(argv)
+    times = list()
+    for _ in range(repeats):
+        seconds, imported = startup(argv)
+        times.append(seconds)
+    return {
+        'command': ' '.join(argv), 'median_s': statistics.median(times),
+        'min_s': min(times), 'max_s': max(times),
+        'heavy_imports': ','.join(imported)}
+
+
+def argparser():
+    """Create argument parser."""
+    parser = ArgumentParser(
+        "Benchmark the startup time of each subcommand.",
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--repeats", type=int, default=5,
+        help="Number of times to start each subcommand.")
+    parser.add_argument(
+        "--output",
+        help="Write results to this JSON file.")
+    return parser
+
+
+def main():
+    """Run the benchmarks."""
+    args = argparser().parse_args()
+    results = [benchmark_startup(['--version'], args.repeats)]
+    for module in duplex_tools.modules:
+        results.append(benchmark_startup([module, '--help'], args.repeats))
+    print(pd.DataFrame(results).to_string(index=False, float_format='%.3g'))
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
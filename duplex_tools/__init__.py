@@ -1,20 +1,36 @@
 """Duplex Sequencing Tools package."""
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import importlib
 import logging
+import sys
 
-from duplex_tools import \
-    assess_split_on_adapter, filter_pairs, pair, pairs_from_summary, \
-    split_on_adapter, split_pairs  # noqa: F401
-
+# subcommand modules, imported only when their subcommand is run as they
+# pull in heavy dependencies
 modules = [
     "split_on_adapter", "assess_split_on_adapter",
-    "pairs_from_summary", "filter_pairs", "pair", "split_pairs"]
+    "pairs_from_summary", "filter_pairs", "pair", "split_pairs",
+    "split_pod5", "merge_pairs"]
 
 __version__ = '0.3.3'
 
 
-def main():
-    """Entry point."""
+def __getattr__(name):
+    """Import subcommand modules on first access."""
+    if name in modules:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def main(argv=None):
+    """Entry point.
+
+    Only the module of the subcommand given is imported, the others are
+    listed without building their argument parsers.
+
+    :param argv: command line arguments, by default `sys.argv[1:]`.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
     parser = ArgumentParser(
         "Duplex Sequencing Tools",
         formatter_class=ArgumentDefaultsHelpFormatter)
@@ -22,21 +38,43 @@ def main():
         title="subcommands", description="valid commands",
         help="additional help", dest="command")
     subparsers.required = True
+    command = next((x for x in argv if not x.startswith('-')), None)
     for module in modules:
-        mod = globals()[module]
-        p = subparsers.add_parser(module, parents=[mod.argparser()])
+        if module != command:
+            subparsers.add_parser(module)
+            continue
+        mod = importlib.import_module(f'{__name__}.{module}')
+        p = subparsers.add_parser(
+            module, parents=[mod.argparser(), _memory(), _profile()])
         p.set_defaults(func=mod.main)
     parser.add_argument(
         '--version', action='version',
         version='%(prog)s {}'.format(__version__))
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.profiler and not args.profile_dir:
+        parser.error("--profiler requires --profile_dir")
 
     logging.basicConfig(
         format='[%(asctime)s - %(name)s] %(message)s',
         datefmt='%H:%M:%S', level=logging.INFO)
     logger = logging.getLogger(__package__)
     logger.setLevel(args.log_level)
-    args.func(args)
+    if args.max_memory is not None:
+        from duplex_tools import memory
+        memory.configure(args.max_memory)
+    profile = args.profile or args.profile_dir is not None
+    if not (profile or args.metrics):
+        args.func(args)
+        return
+    from duplex_tools import profiling
+    profiling.configure(args.profile_dir, args.profiler)
+    try:
+        args.func(args)
+    finally:
+        profiling.report(
+            args.metrics, log=profile, command=command, arguments={
+                k: v for k, v in vars(args).items()
+                if k not in {'func', 'command'}})
 
 
 def _log_level():
@@ -55,6 +93,46 @@ def _log_level():
     return parser
 
 
+def _memory():
+    """Parser to set the memory budget of a subcommand."""
+    from duplex_tools.memory import parse_size
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter, add_help=False)
+    group = parser.add_argument_group("resource options")
+    group.add_argument(
+        '--max_memory', type=parse_size,
+        help='Memory budget, for example 8G, sizing the chunks, batches in '
+             'flight, worker processes and partitions of the subcommand. '
+             'Memory use against the budget is logged after each stage.')
+    return parser
+
+
+def _profile():
+    """Parser to time and profile the stages of a subcommand."""
+    parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter, add_help=False)
+    group = parser.add_argument_group("profiling options")
+    group.add_argument(
+        '--profile', action='store_true',
+        help='Log the time spent in each stage, including in worker '
+             'processes.')
+    group.add_argument(
+        '--profile_dir',
+        help='Write profiles of each stage, merged over processes, to this '
+             'directory. Implies --profile.')
+    group.add_argument(
+        '--profiler', choices=['cprofile', 'sampling'],
+        help='Profile each stage with cProfile (written as <stage>.pstats) '
+             'or by sampling stacks (written as <stage>.folded) to '
+             '--profile_dir.')
+    group.add_argument(
+        '--metrics',
+        help='Write run metrics to this JSON file: throughput, wall and CPU '
+             'time of each stage, peak memory, worker utilisation and the '
+             'counters of the subcommand.')
+    return parser
+
+
 def get_named_logger(name):
     """Create a logger with a name."""
     logger = logging.getLogger('{}.{}'.format(__package__, name))
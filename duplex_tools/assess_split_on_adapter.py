@@ -1,98 +1,322 @@
 """Assessment of read_fillet results."""
 
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
-import pickle
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pysam
 
 import duplex_tools
+from duplex_tools import memory, profiling
+from duplex_tools.writers import ManifestWriter
 
+SPLIT_CLASSES = {
+    'split': 'Read split',
+    'not_split': 'Read not split',
+    'split_multiple_times': 'Split more than once'}
+# columns of the `seqkit bam` statistics used for the assessment
+STATS_TYPES = {
+    'Read': pa.string(), 'Ref': pa.dictionary(pa.int32(), pa.string()),
+    'Pos': pa.int64(), 'Strand': pa.int8(), 'LeftClip': pa.int64(),
+    'RightClip': pa.int64(), 'ReadLen': pa.int64(), 'ReadCov': pa.float64()}
+# how each per-read summary column is reduced over alignments and chunks
+SUMMARY_REDUCTIONS = {
+    'n': np.add, 'qstart_max': np.maximum, 'qend_min': np.minimum,
+    'pos_max': np.maximum, 'pos_min': np.minimum, 'ref_min': np.minimum,
+    'ref_max': np.maximum, 'cov_max': np.maximum}
+NO_OVERLAP = int(1e8)
 
-def assess(
-        seqkit_stats_nosecondary, edited_reads, unedited_reads,
-        split_multiple_times, suffix=None):
-    """Run assessment."""
-    with open(edited_reads, 'rb') as handle:
-        edited_reads = pickle.load(handle)
-    with open(unedited_reads, 'rb') as handle:
-        unedited_reads = pickle.load(handle)
-    with open(split_multiple_times, 'rb') as handle:
-        split_multiple_times = pickle.load(handle)
-
-    txt = pd.read_csv(
-        seqkit_stats_nosecondary,
-        sep='\t')
-    print(f'{seqkit_stats_nosecondary} contains {len(txt)} reads')
-
-    expected_read_ids = (
-        set(edited_reads)
-        .union(unedited_reads)
-        .union(split_multiple_times))
-    txt = txt[txt['Read'].isin(expected_read_ids)]
-    print(f'Using {len(txt)} reads for assessment')
-
-    txt['qstart'] = np.where(
-        txt['Strand'] == 1, txt['LeftClip'], txt['RightClip'])
-    txt['qend'] = np.where(
-        txt['Strand'] == -1,
-        txt['ReadLen'] - txt['LeftClip'], txt['ReadLen'] - txt['RightClip'])
-
-    txt['read_count'] = txt.groupby('Read')['Ref'].transform('count')
-    txt['bases_between_reads'] = np.where(
-        txt['read_count'] == 2,
-        (txt.groupby('Read')['qstart'].transform('max')
-            - txt.groupby('Read')['qend'].transform('min')),
-        0)
-    txt['bases_between_alignments_start'] = np.where(
-        txt['read_count'] == 2,
-        (txt.groupby('Read')['Pos'].transform('max')
-            - txt.groupby('Read')['Pos'].transform('min')),
-        int(1e8))
-    txt['bases_between_alignments_end'] = np.where(
-        txt['read_count'] == 2,
-        (txt.groupby('Read')['Pos'].transform('max')
-            - txt.groupby('Read')['Pos'].transform('min')),
-        int(1e8))
-    txt['bases_between_alignments_min'] = np.where(
-        ((txt['read_count'] == 2)
-            & (txt.groupby('Read')['Ref'].transform('nunique') == 1)),
-        txt[['bases_between_alignments_start',
-            'bases_between_alignments_end']].min(axis=1),
-        int(1e8))
-
-    txt['expected_class'] = None
-    txt.loc[
-        (txt['ReadCov'] > 95) & (txt['read_count'] == 1),
-        'expected_class'] = 'single_alignment_95%cov'
-    txt.loc[
-        (txt['bases_between_reads'].between(20, 160)
-            & (txt['read_count'] == 2)),
-        'expected_class'] = 'disjoint_with_gap'
-    txt.loc[
-        txt['bases_between_reads'].lt(20) & (txt['read_count'] == 2),
-        'expected_class'] = 'disjoint_without_gap'
-    txt.loc[
-        txt['bases_between_alignments_min'] < 10000,
-        'expected_class'] = 'overlapping'
-    txt.loc[
-        txt['read_count'] > 2, 'expected_class'] = 'Read_gt-2-supplementary'
-
-    txt = txt.query('expected_class != "overlapping"')
-
-    txt['split_class'] = "None"
-    txt.loc[txt['Read'].isin(edited_reads), 'split_class'] = 'Read split'
-    txt.loc[txt['Read'].isin(unedited_reads), 'split_class'] = 'Read not split'
-    txt.loc[
-        txt['Read'].isin(split_multiple_times),
-        'split_class'] = 'Split more than once'
-
-    txt_only_once_twice = txt.query(
-        '(split_class!= "Split more than once") & (split_class != "None") ')
-
-    crosstabbed = pd.crosstab(
-        txt_only_once_twice['split_class'],
-        txt_only_once_twice['expected_class'])
+
+def read_manifest(split_manifest):
+    """Read the read ids and status from split_on_adapter manifest(s).
+
+    :param split_manifest: a manifest file, or a split_on_adapter output
+        directory containing manifests.
+    """
+    split_manifest = Path(split_manifest)
+    if split_manifest.is_dir():
+        files = sorted(split_manifest.glob(f'*{ManifestWriter.suffix}'))
+    else:
+        files = [split_manifest]
+    manifest = pd.concat(
+        [pd.read_parquet(x, columns=['read_id', 'status']) for x in files],
+        ignore_index=True).drop_duplicates('read_id', keep='last')
+    manifest['status'] = manifest['status'].astype('category')
+    return manifest
+
+
+def reduce_by_read(read, columns):
+    """Reduce columns over the rows of each read in one sorted pass.
+
+    :param read: integer read code of each row.
+    :param columns: dictionary of `SUMMARY_REDUCTIONS` column name to
+        the values of each row.
+    :returns: dataframe indexed by read code.
+    """
+    order = np.argsort(read, kind='stable')
+    read = read[order]
+    starts = np.flatnonzero(np.diff(read, prepend=-1))
+    return pd.DataFrame(
+        {name: SUMMARY_REDUCTIONS[name].reduceat(values[order], starts)
+         for name, values in columns.items()},
+        index=pd.Index(read[starts], name='read'))
+
+
+def read_alignment_stats(seqkit_stats, chunk_size=None):
+    """Read the columns of `seqkit bam` statistics used for assessment.
+
+    :param seqkit_stats: tab-separated `seqkit bam` statistics.
+    :param chunk_size: size in MB of the blocks of the file to read at a
+        time, by default the file is read at once.
+    :returns: iterator of `pyarrow.RecordBatch`.
+    """
+    parse_options = pcsv.ParseOptions(delimiter='\t')
+    convert_options = pcsv.ConvertOptions(
+        include_columns=list(STATS_TYPES), column_types=STATS_TYPES)
+    if chunk_size is None:
+        table = pcsv.read_csv(
+            seqkit_stats, parse_options=parse_options,
+            convert_options=convert_options)
+        yield from table.unify_dictionaries().combine_chunks().to_batches()
+        return
+    read_options = pcsv.ReadOptions(block_size=int(chunk_size * 1024 ** 2))
+    with pcsv.open_csv(
+            seqkit_stats, read_options=read_options,
+            parse_options=parse_options,
+            convert_options=convert_options) as reader:
+        yield from reader
+
+
+def read_alignments_bam(bam, threads=1, batch_size=100000):
+    """Calculate the `seqkit bam` statistics used for assessment.
+
+    Secondary and unmapped records are skipped. Clips include both soft
+    and hard clipped bases, so the read length and coverage of
+    supplementary alignments refer to the whole read.
+
+    :param bam: aligned BAM file.
+    :param threads: number of decompression threads.
+    :param batch_size: number of records per batch.
+    :returns: iterator of `pyarrow.RecordBatch`.
+    """
+    with pysam.AlignmentFile(
+            str(bam), threads=threads, check_sq=False) as fh:
+        refs = pa.array(fh.references, type=pa.string())
+        rows = {name: [] for name in STATS_TYPES}
+        for record in fh:
+            if record.is_secondary or record.is_unmapped:
+                continue
+            cigar = record.cigartuples
+            left = right = 0
+            for op, length in cigar:
+                if op not in (pysam.CSOFT_CLIP, pysam.CHARD_CLIP):
+                    break
+                left += length
+            for op, length in reversed(cigar):
+                if op not in (pysam.CSOFT_CLIP, pysam.CHARD_CLIP):
+                    break
+                right += length
+            readlen = record.infer_read_length()
+            rows['Read'].append(record.query_name)
+            rows['Ref'].append(record.reference_id)
+            rows['Pos'].append(record.reference_start + 1)
+            rows['Strand'].append(-1 if record.is_reverse else 1)
+            rows['LeftClip'].append(left)
+            rows['RightClip'].append(right)
+            rows['ReadLen'].append(readlen)
+            rows['ReadCov'].append(100 * (readlen - left - right) / readlen)
+            if len(rows['Read']) >= batch_size:
+                yield _stats_batch(rows, refs)
+                rows = {name: [] for name in STATS_TYPES}
+        if rows['Read']:
+            yield _stats_batch(rows, refs)
+
+
+def _stats_batch(rows, refs):
+    ref = pa.DictionaryArray.from_arrays(
+        pa.array(rows.pop('Ref'), type=pa.int32()), refs)
+    return pa.RecordBatch.from_pydict(
+        {'Ref': ref, **rows},
+        schema=pa.schema([
+            (name, STATS_TYPES[name]) for name in ['Ref', *rows]]))
+
+
+def summarise_alignments(alignments, reads, refs):
+    """Summarise the alignments of each read.
+
+    :param alignments: `pyarrow.RecordBatch` of `seqkit bam` statistics.
+    :param reads: `pyarrow.Array` of the read ids to assess, alignments
+        of other reads are ignored.
+    :param refs: dictionary of reference name to integer code, updated
+        with unseen references so codes are consistent across chunks.
+    :returns: dataframe indexed by the position of the read in `reads`
+        with the number of alignments and the extremes of their
+        coordinates.
+    """
+    read = pc.index_in(
+        alignments.column('Read'), value_set=reads).fill_null(-1)
+    read = read.to_numpy()
+    keep = read >= 0
+
+    def column(name):
+        return alignments.column(name).to_numpy()[keep]
+
+    ref = alignments.column('Ref')
+    codes = np.array(
+        [refs.setdefault(x, len(refs)) for x in ref.dictionary.to_pylist()],
+        dtype=np.int64)
+    ref = codes[ref.indices.to_numpy()[keep]]
+    left, right = column('LeftClip'), column('RightClip')
+    strand, readlen, pos = column('Strand'), column('ReadLen'), column('Pos')
+    return reduce_by_read(read[keep], {
+        'n': np.ones(len(pos), dtype=np.int64),
+        'qstart_max': np.where(strand == 1, left, right),
+        'qend_min': np.where(strand == -1, readlen - left, readlen - right),
+        'pos_max': pos, 'pos_min': pos, 'ref_min': ref, 'ref_max': ref,
+        'cov_max': column('ReadCov')})
+
+
+def classify_reads(summary):
+    """Assign the expected class of each read from its alignments.
+
+    Classes are checked in order of priority, reads matching none of them
+    are given None.
+
+    :param summary: per-read summary from `summarise_alignments`.
+    """
+    n = summary['n'].to_numpy()
+    pair = n == 2
+    bases_between_reads = np.where(
+        pair, summary['qstart_max'] - summary['qend_min'], 0)
+    bases_between_alignments = np.where(
+        pair & (summary['ref_min'] == summary['ref_max']).to_numpy(),
+        summary['pos_max'] - summary['pos_min'], NO_OVERLAP)
+    return np.select(
+        [n > 2,
+         bases_between_alignments < 10000,
+         pair & (bases_between_reads < 20),
+         pair & (bases_between_reads >= 20) & (bases_between_reads <= 160),
+         (summary['cov_max'].to_numpy() > 95) & (n == 1)],
+        ['Read_gt-2-supplementary', 'overlapping', 'disjoint_without_gap',
+         'disjoint_with_gap', 'single_alignment_95%cov'],
+        default=None)
+
+
+def merge_summaries(summaries):
+    """Combine per-read summaries of different chunks.
+
+    :param summaries: list of summaries from `summarise_alignments`.
+    """
+    summary = pd.concat(summaries)
+    return reduce_by_read(
+        summary.index.to_numpy(),
+        {name: summary[name].to_numpy() for name in SUMMARY_REDUCTIONS})
+
+
+def count_classes(summary, split_class):
+    """Count alignments by the split class and expected class of the read.
+
+    :param summary: per-read summary from `summarise_alignments`.
+    :param split_class: array of the split class of each manifest read.
+    :returns: series of counts indexed by split and expected class, reads
+        without an expected class are counted as "None".
+    """
+    return pd.DataFrame({
+        'split_class': split_class[summary.index.to_numpy()],
+        'expected_class': classify_reads(summary),
+        'n': summary['n'].to_numpy()}).fillna("None").groupby(
+            ['split_class', 'expected_class'])['n'].sum()
+
+
+def assess(alignments, split_manifest, suffix=None, chunk_size=None,
+           threads=1):
+    """Run assessment.
+
+    Alignments are counted towards the class of their read. When reading
+    a BAM which is not coordinate sorted the alignments of a read are
+    expected to be adjacent, as output by the aligner or after sorting
+    by name, and reads are counted as soon as all their alignments have
+    been read.
+
+    :param alignments: `seqkit bam` statistics of the alignments of the
+        unsplit reads, or the alignments themselves as a BAM file.
+    :param split_manifest: manifest file or output directory of
+        split_on_adapter.
+    :param suffix: label for the output files.
+    :param chunk_size: size in MB of the statistics to read at a time,
+        by default the statistics are read at once, or in chunks fitting
+        the memory budget.
+    :param threads: number of threads to decompress a BAM with.
+    """
+    if chunk_size is None:
+        # parsed statistics take several times the size of the text
+        chunk_size = memory.within_budget(None, 4 << 20, 0.25)
+    manifest = read_manifest(split_manifest)
+    reads = pa.array(manifest['read_id'])
+    split_class = (
+        manifest['status'].map(SPLIT_CLASSES).astype(object).fillna("None")
+        .to_numpy())
+
+    grouped = False
+    if Path(alignments).suffix in {'.bam', '.sam'}:
+        with pysam.AlignmentFile(str(alignments), check_sq=False) as fh:
+            order = fh.header.to_dict().get('HD', {}).get('SO')
+        grouped = order != 'coordinate'
+        chunks = read_alignments_bam(
+            alignments, threads,
+            memory.within_budget(100000, 500, 0.25, minimum=1000))
+    else:
+        chunks = read_alignment_stats(alignments, chunk_size)
+
+    refs = dict()
+    counts = list()
+    summaries = list()
+    counted = np.zeros(len(reads), dtype=bool)
+    nalignments = nused = 0
+    for chunk in chunks:
+        summary = summarise_alignments(chunk, reads, refs)
+        nalignments += chunk.num_rows
+        nused += summary['n'].sum()
+        if not grouped:
+            # a read's alignments may be spread over chunks
+            summaries.append(summary)
+            continue
+        if counted[summary.index.to_numpy()].any():
+            raise ValueError(
+                f"Alignments of a read are not adjacent in {alignments}, "
+                "sort it by read name or coordinate.")
+        # only the last read of the chunk may continue in the next
+        summary = merge_summaries([*summaries, summary])
+        last = pc.index_in(
+            chunk.column('Read')[-1:], value_set=reads)[0].as_py()
+        done = summary.index.to_numpy() != last
+        counts.append(count_classes(summary[done], split_class))
+        counted[summary.index.to_numpy()[done]] = True
+        summaries = [summary[~done]]
+    print(f'{alignments} contains {nalignments} reads')
+    print(f'Using {nused} reads for assessment')
+    if summaries:
+        counts.append(count_classes(merge_summaries(summaries), split_class))
+    memory.log_usage("Summarising alignments")
+
+    counts = pd.concat(counts).groupby(level=[0, 1]).sum()
+    profiling.add_counts({
+        'reads': counts.sum(), 'alignments': nalignments,
+        'alignments_used': nused})
+    counts = counts[
+        counts.index.get_level_values('expected_class') != 'overlapping']
+    only_once_twice = counts[
+        ~counts.index.get_level_values('split_class').isin(
+            ["Split more than once", "None"])]
+    # classes in alphabetical order, as from pd.crosstab, whatever the
+    # order in which they were counted
+    crosstabbed = only_once_twice[
+        only_once_twice.index.get_level_values('expected_class') != "None"
+    ].unstack(fill_value=0).sort_index().sort_index(axis=1)
     crosstabbed_fraction = crosstabbed.apply(lambda r: r / r.sum(), axis=0)
     crosstabbed.assign(label=suffix).to_csv(
         f'read_splitting_assessment_{suffix}.txt', sep='\t')
@@ -100,7 +324,7 @@ def assess(
         f'read_splitting_assessment_{suffix}_fraction.txt', sep='\t')
 
     print('Amount of data excluded')
-    print(1 - len(txt_only_once_twice) / len(txt))
+    print(1 - only_once_twice.sum() / counts.sum())
 
 
 def argparser():
@@ -112,23 +336,29 @@ def argparser():
         formatter_class=ArgumentDefaultsHelpFormatter,
         parents=[duplex_tools._log_level()], add_help=False)
     parser.add_argument(
-        "seqkit_stats_nosecondary")
+        "alignments",
+        help="`seqkit bam` statistics of the alignments of the unsplit "
+             "reads, or a BAM file of the alignments.")
     parser.add_argument(
-        "edited_reads")
+        "split_manifest",
+        help="Manifest file or output directory of split_on_adapter.")
     parser.add_argument(
-        "unedited_reads")
+        "--suffix")
     parser.add_argument(
-        "split_multiple_times")
+        "--chunk_size", type=float,
+        help="Size in MB of the statistics to read at a time, limits "
+             "memory use for large statistics files.")
     parser.add_argument(
-        "--suffix")
+        "--threads", type=int, default=1,
+        help="Number of threads to decompress a BAM with.")
     return parser
 
 
 def main(args):
     """Entry point."""
     assess(
-        args.seqkit_stats_nosecondary,
-        args.edited_reads,
-        args.unedited_reads,
-        args.split_multiple_times,
-        args.suffix)
+        args.alignments,
+        args.split_manifest,
+        args.suffix,
+        args.chunk_size,
+        args.threads)
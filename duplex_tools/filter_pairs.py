@@ -1,18 +1,25 @@
 """Filter candidate pairs by inspecting mutual basecall alignment."""
 
-from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from argparse import (
+    ArgumentDefaultsHelpFormatter, ArgumentParser, ArgumentTypeError)
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 import functools
 import glob
+import json
+import os
 from pathlib import Path
 import pickle
+import zlib
 
+import numpy as np
 import pandas as pd
 import parasail
 import pysam
 
 import duplex_tools
+from duplex_tools import memory, profiling
+from duplex_tools.reads import is_xam, read_batches
 from duplex_tools.utils import is_ubam
 
 comp = {
@@ -34,8 +41,8 @@ def reverse_complement(seq):
 
 
 def filter_candidate_pairs_by_aligning(
-        read_pairs: str,
-        reads_path: str,
+        read_pairs,
+        reads_path,
         bases_to_align: int = 250,
         align_threshold: float = 0.6,
         penalty_open: int = 4,
@@ -47,13 +54,26 @@ def filter_candidate_pairs_by_aligning(
         threads: int = None,
         no_end_penalties: bool = False,
         loglevel: str = "INFO",
-        ) -> None:
+        output_dir: str = None,
+        shard: tuple = None,
+        ) -> pd.DataFrame:
     """Filter candidate read pairs by quality of alignment.
 
+    With a memory budget, the pairs are processed in partitions whose read
+    ends fit in it, scanning the reads once for each partition.
+
+    With `shard`, only the pairs assigned to the shard by `shard_of` are
+    scored, keeping only their read ends. The outputs are written with a
+    `.shard-i-of-N` suffix, along with the position of each pair in
+    `read_pairs`, and a completion marker. Once all shards are complete,
+    `merge_pairs` combines them into the outputs of an unsharded run.
+
     :param read_pairs: Path to file with two space-separated read-ids per row,
-        the leftmost coming first in time.
+        the leftmost coming first in time, or a DataFrame of the pairs in
+        its first two columns, as returned by `find_pairs`.
     :param reads_path: The path to .fastq or .bam files with _all_ reads,
-        both passing and failing.
+        both passing and failing, or the read ends returned by
+        `read_all_sequences`.
     :param bases_to_align: Number of bases to use from end of the first read,
         and from the start of second.
     :param align_threshold: Which alignment threshold to use for passing
@@ -70,7 +90,14 @@ def filter_candidate_pairs_by_aligning(
     :param no_end_penalties: Do not penalise ends of complement alignment.
         Favours truncated alignments
     :param loglevel: Level to log at, for example 'INFO' or 'DEBUG'.
+    :param output_dir: Directory to write the outputs to. By default
+        outputs are written next to a `read_pairs` file, and not at all for
+        a DataFrame.
+    :param shard: (i, N) to score only the i-th of N shards of the pairs,
+        counting from 1, as parsed by `parse_shard`.
 
+    :returns: DataFrame of the scored pairs, with columns `read_id`,
+        `read_id_next` and `score`, as written to `*_scored.csv`.
 
     This function takes a path to a file with pairs of candidate followon
     read-ids and require a fastq that contains the same read-ids.
@@ -90,65 +117,191 @@ def filter_candidate_pairs_by_aligning(
         f"\n\tscore_mismatch={score_mismatch}"
         f"\n\tpenalty_open={penalty_open}"
         f"\n\tpenalty_extend:{penalty_extend}")
-    read_pairs = Path(read_pairs)
     # Index and read pairs
-    pairs = pd.read_csv(read_pairs, sep=" ", names=["first", "second"])
-    if reads_path.endswith(".pkl"):  # for testing
-        logger.info("Extracting read end data from pickle file.")
-        with open(reads_path, 'rb') as fh:
-            fastq_index = pickle.load(fh)
+    if isinstance(read_pairs, pd.DataFrame):
+        pairs = read_pairs.iloc[:, :2].set_axis(
+            ["first", "second"], axis=1).reset_index(drop=True)
+        stem = "pair_ids"
+        if output_dir is not None:
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
     else:
-        fastq_index = read_all_sequences(
-            reads_path, pairs, bases_to_align, threads=threads)
-        # dump to pickle
-        pkl = Path(read_pairs.parent, "read_segments.pkl")
-        with open(pkl, "wb") as fh:
-            pickle.dump(fastq_index, fh)
-    logger.info("Starting alignments.")
-
-    # Align all of them
-    alignment_scores_df = align_all_pairs(
-        align_threshold, fastq_index, bases_to_align, pairs,
-        penalty_extend, penalty_open, score_match, score_mismatch,
-        min_length, max_length, no_end_penalties)
-
-    # Finally, write full summary and filtered pairs
-    alignment_scores_df.to_csv(
-        Path(read_pairs.parent, f"{read_pairs.stem}_scored.csv"),
-        index=False)
-    alignment_pairs_filtered = alignment_scores_df.query(
-        f"score > {align_threshold}")
-    alignment_pairs_filtered[["read_id", "read_id_next"]].to_csv(
-        Path(read_pairs.parent, f"{read_pairs.stem}_filtered.txt"),
-        index=False, header=False, sep=" ")
-
-
-def scrape_sequences(file, first, second, n_bases):
-    """Compile data from a fastq file."""
+        read_pairs = Path(read_pairs)
+        pairs = pd.read_csv(read_pairs, sep=" ", names=["first", "second"])
+        stem = read_pairs.stem
+        if output_dir is None:
+            output_dir = read_pairs.parent
+    if shard is not None:
+        npairs = len(pairs)
+        pairs = pairs[shard_of(pairs["first"], shard[1]) == shard[0] - 1]
+        logger.info(
+            f"Scoring {len(pairs)} of {npairs} pairs in shard "
+            f"{shard[0]}/{shard[1]}.")
+    partitions = [pairs]
+    if not (isinstance(reads_path, dict) or reads_path.endswith(".pkl")):
+        # the read ends of a pair, with the overhead of python objects
+        size = memory.within_budget(
+            max(len(pairs), 1), 2 * (bases_to_align + 200), 0.5)
+        partitions = [
+            pairs[i:i + size] for i in range(0, len(pairs), size)] or [pairs]
+        if len(partitions) > 1:
+            logger.info(
+                f"Scanning reads for {len(partitions)} partitions of "
+                f"{size} pairs within the memory budget.")
+    alignment_scores = []
+    for i, partition in enumerate(partitions):
+        with profiling.stage('scan_reads'):
+            if isinstance(reads_path, dict):
+                fastq_index = reads_path
+            elif reads_path.endswith(".pkl"):  # for testing
+                logger.info("Extracting read end data from pickle file.")
+                with open(reads_path, 'rb') as fh:
+                    fastq_index = pickle.load(fh)
+            else:
+                # reads are scanned for each partition, count them once
+                fastq_index = read_all_sequences(
+                    reads_path, partition, bases_to_align, threads=threads,
+                    count_reads=i == 0)
+                if output_dir is not None and len(partitions) == 1 \
+                        and shard is None:
+                    # dump to pickle
+                    pkl = Path(output_dir, "read_segments.pkl")
+                    with open(pkl, "wb") as fh:
+                        pickle.dump(fastq_index, fh)
+        memory.log_usage("Scanning reads")
+        logger.info("Starting alignments.")
+
+        # Align all of them
+        with profiling.stage('align'):
+            alignment_scores.append(align_all_pairs(
+                align_threshold, fastq_index, bases_to_align, partition,
+                penalty_extend, penalty_open, score_match, score_mismatch,
+                min_length, max_length, no_end_penalties))
+        del fastq_index
+    # indexed by the position of each pair in `read_pairs`
+    alignment_scores_df = pd.concat(alignment_scores)
+
+    if output_dir is not None:
+        with profiling.stage('write'):
+            write_pairs(
+                alignment_scores_df, output_dir, stem, align_threshold,
+                shard)
+    return alignment_scores_df.reset_index(drop=True)
+
+
+def write_pairs(scored, output_dir, stem, align_threshold, shard=None):
+    """Write the scored pairs and those passing the threshold.
+
+    :param scored: DataFrame of the scored pairs, indexed by the position
+        of each pair in the candidate pairs.
+    :param output_dir: Directory to write `<stem>_scored.csv` and
+        `<stem>_filtered.txt` to.
+    :param stem: Stem of the output file names.
+    :param align_threshold: Score a pair must exceed to be written to
+        `<stem>_filtered.txt`.
+    :param shard: (i, N) of a shard. Its outputs get a `.shard-i-of-N`
+        suffix, the scored pairs a `pair_index` column, and a completion
+        marker `<stem>.shard-i-of-N.done` is written once they are
+        complete.
+    """
+    suffix = '' if shard is None else shard_suffix(shard)
+    scored_path = Path(output_dir, f"{stem}_scored{suffix}.csv")
+    filtered_path = Path(output_dir, f"{stem}_filtered{suffix}.txt")
+    filtered = scored.query(f"score > {align_threshold}")
+    if shard is None:
+        scored.to_csv(scored_path, index=False)
+        filtered[["read_id", "read_id_next"]].to_csv(
+            filtered_path, index=False, header=False, sep=" ")
+        return
+    # merge_pairs may look at the directory while a shard is writing, so
+    # outputs are only renamed into place once complete, and the marker
+    # of an earlier run of the shard is removed first
+    marker = Path(output_dir, f"{stem}{suffix}.done")
+    marker.unlink(missing_ok=True)
+    outputs = {scored_path: scored, filtered_path: filtered}
+    for path, df in outputs.items():
+        partial = path.with_name(path.name + '.partial')
+        if path == scored_path:
+            df.to_csv(partial, index_label='pair_index')
+        else:
+            df[["read_id", "read_id_next"]].to_csv(
+                partial, index=False, header=False, sep=" ")
+        os.replace(partial, path)
+    partial = marker.with_name(marker.name + '.partial')
+    with open(partial, 'w') as fh:
+        json.dump({
+            'shard': shard[0], 'nshards': shard[1],
+            'scored': len(scored), 'filtered': len(filtered),
+            'outputs': [path.name for path in outputs]}, fh, indent=2)
+    os.replace(partial, marker)
+
+
+def parse_shard(text):
+    """Parse a shard given as i/N, counting from 1.
+
+    :returns: (i, N).
+    """
+    try:
+        i, n = (int(x) for x in text.split('/'))
+    except ValueError:
+        raise ArgumentTypeError(f"Invalid shard, expected i/N: {text}")
+    if not 1 <= i <= n:
+        raise ArgumentTypeError(
+            f"Invalid shard, expected 1 <= i <= N: {text}")
+    return i, n
+
+
+def shard_of(read_ids, nshards):
+    """Assign read IDs to shards by a hash of the ID.
+
+    The hash does not depend on the process or platform, so all shards
+    of a run agree on the assignment.
+
+    :param read_ids: iterable of read IDs.
+    :param nshards: number of shards.
+    :returns: array of the shard of each read, counting from 0.
+    """
+    hashes = np.fromiter(
+        (zlib.crc32(read_id.encode()) for read_id in read_ids),
+        dtype=np.uint32)
+    return hashes % nshards
+
+
+def shard_suffix(shard):
+    """Return the suffix of the outputs of a shard (i, N)."""
+    return f".shard-{shard[0]}-of-{shard[1]}"
+
+
+def scrape_sequences(
+        file, first, second, n_bases, threads=1, count_reads=True):
+    """Compile data from a fastq file.
+
+    :param threads: number of decompression threads.
+    :param count_reads: add the reads and bases scanned to the profiling
+        counters.
+    """
     logger = duplex_tools.get_named_logger("ReadFastq")
     logger.debug("Extracting read ends from: {}".format(file))
     results = dict()
-    if file.endswith('.bam') or file.endswith('.sam'):
-        bamfile = pysam.AlignmentFile(file, check_sq=False)
-        if is_ubam(bamfile):
-            for read in bamfile.fetch(until_eof=True):
-                if read.qname in first:
-                    results[(read.qname, 0)] = \
-                        str(read.query_sequence[-n_bases:])
-                if read.qname in second:
-                    results[(read.qname, 1)] = reverse_complement(
-                        str(read.query_sequence[:n_bases]))
-    else:
-        for read in pysam.FastxFile(file, persist=False):
-            if read.name in first:
-                results[(read.name, 0)] = str(read.sequence[-n_bases:])
-            if read.name in second:  # a read can be in both
-                results[(read.name, 1)] = reverse_complement(
-                    str(read.sequence[:n_bases]))
+    if is_xam(file):
+        with pysam.AlignmentFile(file, check_sq=False) as bamfile:
+            if not is_ubam(bamfile):
+                return results
+    nreads, nbases = 0, 0
+    for batch in read_batches(file, ('read_id', 'seq'), threads=threads):
+        nreads += len(batch)
+        for read_id, seq in batch:
+            nbases += len(seq)
+            if read_id in first:
+                results[(read_id, 0)] = seq[-n_bases:]
+            if read_id in second:  # a read can be in both
+                results[(read_id, 1)] = reverse_complement(seq[:n_bases])
+    if count_reads:
+        profiling.add_counts({'reads': nreads, 'bases': nbases})
     return results
 
 
-def read_all_sequences(reads_directory, pairs, n_bases, threads=None):
+def read_all_sequences(
+        reads_directory, pairs, n_bases, threads=None, count_reads=True):
     """Find and read all necessary data from fastq or bam files."""
     logger = duplex_tools.get_named_logger("ReadFastq")
     first = set(pairs["first"])
@@ -167,8 +320,11 @@ def read_all_sequences(reads_directory, pairs, n_bases, threads=None):
     files = list(_get_files())
 
     executor = ThreadPoolExecutor(max_workers=threads)
+    # threads not needed for reading files in parallel decompress them
+    read_threads = max(1, (threads or os.cpu_count()) // max(len(files), 1))
     worker = functools.partial(
-        scrape_sequences, first=first, second=second, n_bases=n_bases)
+        scrape_sequences, first=first, second=second, n_bases=n_bases,
+        threads=read_threads, count_reads=count_reads)
     for i, res in enumerate(executor.map(worker, files)):
         if i % 50 == 0:
             logger.info(
@@ -180,6 +336,32 @@ def read_all_sequences(reads_directory, pairs, n_bases, threads=None):
     return results
 
 
+def score_pair(
+        seq1, seq2, score_matrix, penalty_open=4, penalty_extend=1,
+        no_end_penalties=False):
+    """Score the alignment of the end of a read to the start of the next.
+
+    :param seq1: The end of the first read.
+    :param seq2: The reverse complement of the start of the second read.
+    :param score_matrix: Scoring matrix created by parasail.
+    :param penalty_open: Open penalty passed to parasail.
+    :param penalty_extend: Extend penalty passed to parasail.
+    :param no_end_penalties: Do not penalise ends of complement alignment.
+
+    :returns: alignment score per base of `seq1`.
+    """
+    # Run a semi-global alignment (sg) with zero end-penalty for seq2 (dx)
+    if no_end_penalties:
+        aligner = parasail.sg_trace_scan_16
+    else:
+        aligner = parasail.sg_dx_trace_scan_16
+    result = aligner(
+        seq1, seq2, penalty_open, penalty_extend, score_matrix)
+
+    # scale score to read length
+    return result.score / result.len_ref
+
+
 def align_all_pairs(
         align_threshold,
         fastq_index,
@@ -192,9 +374,13 @@ def align_all_pairs(
         min_length,
         max_length,
         no_end_penalties) -> pd.DataFrame:
-    """Align read pairs to each other using parasail."""
+    """Align read pairs to each other using parasail.
+
+    :returns: DataFrame of the scored pairs, indexed as `pairs`.
+    """
     counter = defaultdict(int)
     alignment_scores = list()
+    indices = list()
     npairs = len(pairs)
     logger = duplex_tools.get_named_logger("AlignPairs")
     logger.info(f"Aligning {npairs} pairs")
@@ -240,16 +426,9 @@ def align_all_pairs(
             counter["skipped"] += 1
             continue
 
-        # Run a semi-global alignment (sg) with zero end-penalty for seq2 (dx)
-        if no_end_penalties:
-            aligner = parasail.sg_trace_scan_16
-        else:
-            aligner = parasail.sg_dx_trace_scan_16
-        result = aligner(
-            seq1, seq2, penalty_open, penalty_extend, score_matrix)
-
-        # scale score to read length
-        score_followon = result.score / result.len_ref
+        score_followon = score_pair(
+            seq1, seq2, score_matrix, penalty_open, penalty_extend,
+            no_end_penalties)
         if score_followon > align_threshold:
             logger.debug(
                 f"\n{read_pair.first} {read_pair.second}: {score_followon}")
@@ -257,13 +436,16 @@ def align_all_pairs(
 
         alignment_scores.append(
             (read_pair.first, read_pair.second, score_followon))
+        indices.append(read_pair.Index)
         align_quality = "good" if score_followon > align_threshold else "bad"
         counter[align_quality] += 1
 
     alignment_scores_df = pd.DataFrame(
-        alignment_scores, columns=["read_id", "read_id_next", "score"])
+        alignment_scores, columns=["read_id", "read_id_next", "score"],
+        index=pd.Index(indices, dtype=pairs.index.dtype))
     logger.info("Good pairs: {}".format(counter["good"]))
     logger.debug(counter)
+    profiling.add_counts({'pairs': npairs, **counter})
     return alignment_scores_df
 
 
@@ -305,6 +487,13 @@ def add_args(parser):
         "--no_end_penalties", action="store_true",
         help="Do no use end penalties for alignment. Allows truncated "
              "complement")
+    grp = parser.add_argument_group("shard options")
+    grp.add_argument(
+        "--shard", type=parse_shard,
+        help="Score only the i-th of N shards of the candidate pairs, given "
+             "as i/N counting from 1, for example 2/8. Pairs are assigned to "
+             "shards by a hash of their read IDs. Once all shards have "
+             "written their outputs, combine them with merge_pairs.")
     return parser
 
 
@@ -332,4 +521,4 @@ def main(args):
         args.penalty_open, args.penalty_extend,
         args.score_match, args.score_mismatch,
         args.min_length, args.max_length,
-        args.threads, args.no_end_penalties)
+        args.threads, args.no_end_penalties, shard=args.shard)
@@ -0,0 +1,140 @@
+"""Memory budget shared by the subcommands.
+
+A budget set with `configure`, as done by the `--max_memory` option of
+the command line, is divided by each subcommand between its buffers:
+chunk and batch sizes, the number of batches or files in flight, the
+number of worker processes and the number of partitions an input is
+processed in. Without a budget the defaults of each subcommand apply.
+
+The budget is passed to worker processes through the environment.
+Memory use is logged by `log_usage` against the budget at the end of
+the main stages, so it can be seen which stage comes closest to it.
+"""
+from contextlib import contextmanager
+import logging
+import os
+import re
+import resource
+import sys
+
+import duplex_tools
+
+ENV_VAR = 'DUPLEX_TOOLS_MAX_MEMORY'
+UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+# a worker process, with its dependencies imported
+WORKER_BYTES = 200 << 20
+
+
+def parse_size(text):
+    """Parse a memory size such as 512M or 4G, in binary units.
+
+    :param text: number of bytes, optionally with a K, M, G or T suffix.
+    :returns: number of bytes.
+    """
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)I?B?\s*', text.upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size: {text}")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def format_size(nbytes):
+    """Format a memory size in the binary units of `parse_size`.
+
+    :param nbytes: number of bytes.
+    :returns: size such as 512 B, 1.5 KiB or 4 GiB.
+    """
+    for unit in 'TGMK':
+        if nbytes >= UNITS[unit]:
+            return f"{nbytes / UNITS[unit]:.4g} {unit}iB"
+    return f"{nbytes:.0f} B"
+
+
+def configure(max_memory):
+    """Set the memory budget of this process and its workers.
+
+    :param max_memory: budget in bytes, or a size parsed by `parse_size`,
+        or None to remove the budget.
+    """
+    if max_memory is None:
+        os.environ.pop(ENV_VAR, None)
+        return
+    if isinstance(max_memory, str):
+        max_memory = parse_size(max_memory)
+    os.environ[ENV_VAR] = str(int(max_memory))
+
+
+def budget():
+    """Return the memory budget in bytes, or None without a budget."""
+    value = os.environ.get(ENV_VAR)
+    return None if value is None else int(value)
+
+
+@contextmanager
+def reserved(nbytes):
+    """Take memory held for a stage out of the budget.
+
+    Calls of `within_budget` within the context, including those of worker
+    processes started within it, share what is left of the budget.
+
+    :param nbytes: memory held.
+    """
+    total = budget()
+    if total is not None:
+        configure(max(total - int(nbytes), 0))
+    try:
+        yield
+    finally:
+        configure(total)
+
+
+def within_budget(default, item_bytes, fraction=1.0, minimum=1):
+    """Limit a number of items to a fraction of the budget.
+
+    :param default: number of items used without a budget, and the most
+        used with one.
+    :param item_bytes: estimated memory used by each item.
+    :param fraction: fraction of the budget the items may use.
+    :param minimum: the fewest items to use, regardless of the budget.
+    :returns: number of items.
+    """
+    total = budget()
+    if total is None:
+        return default
+    n = max(minimum, int(total * fraction // max(item_bytes, 1)))
+    return n if default is None else min(default, n)
+
+
+def rss_bytes():
+    """Return the resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """Return the peak resident memory of this process in bytes."""
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def log_usage(stage):
+    """Log the memory used by this process at the end of a stage.
+
+    Usage is logged against the budget, or at debug level without one.
+
+    :param stage: name of the stage.
+    """
+    logger = duplex_tools.get_named_logger("Memory")
+    rss, peak, total = rss_bytes(), peak_rss_bytes(), budget()
+    message = (
+        f"{stage}: RSS {format_size(rss)}, peak {format_size(peak)}")
+    if total is None:
+        logger.debug(message)
+        return
+    message += (
+        f" ({100 * peak / max(total, 1):.0f}% of {format_size(total)} "
+        "budget)")
+    logger.log(logging.WARNING if peak > total else logging.INFO, message)
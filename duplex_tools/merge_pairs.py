@@ -0,0 +1,118 @@
+"""Merge the outputs of filter_pairs or pair run in shards."""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import json
+from pathlib import Path
+import re
+
+import pandas as pd
+
+import duplex_tools
+from duplex_tools.filter_pairs import shard_suffix
+
+MARKER_PATTERN = re.compile(r'(.+)\.shard-(\d+)-of-(\d+)\.done')
+
+
+def find_sharded_runs(output_dir):
+    """Find the runs with shards in a directory.
+
+    :param output_dir: The output directory of the shards.
+    :returns: dictionary of output stem to the number of shards and the
+        completion markers found, by shard.
+    """
+    runs = dict()
+    for path in sorted(Path(output_dir).glob('*.shard-*-of-*.done')):
+        match = MARKER_PATTERN.fullmatch(path.name)
+        if match is None:
+            continue
+        stem, shard, nshards = match.group(1), *map(int, match.groups()[1:])
+        if stem in runs and runs[stem][0] != nshards:
+            raise ValueError(
+                f"Shards of {stem} in {output_dir} were run with "
+                f"different numbers of shards.")
+        runs.setdefault(stem, (nshards, dict()))[1][shard] = path
+    return runs
+
+
+def merge_shards(output_dir, stem='pair_ids'):
+    """Merge the scored and filtered pairs of all shards of a run.
+
+    The pairs are put back in the order of the candidate pairs, so that
+    `<stem>_scored.csv` and `<stem>_filtered.txt` are identical to those
+    of an unsharded run.
+
+    :param output_dir: The output directory of the shards.
+    :param stem: Stem of the output file names, `pair_ids` for `pair` and
+        the stem of the candidate pairs file for `filter_pairs`.
+    :returns: DataFrame of the scored pairs.
+    """
+    logger = duplex_tools.get_named_logger("MergePairs")
+    runs = find_sharded_runs(output_dir)
+    if stem not in runs:
+        raise FileNotFoundError(
+            f"No completed shards of {stem} found in {output_dir}.")
+    nshards, markers = runs[stem]
+    missing = sorted(set(range(1, nshards + 1)) - set(markers))
+    if missing:
+        raise FileNotFoundError(
+            f"Shards {', '.join(map(str, missing))} of {nshards} of {stem} "
+            f"are not complete in {output_dir}.")
+    logger.info(f"Merging {nshards} shards of {stem} in {output_dir}.")
+
+    scored, filtered = [], set()
+    for shard in range(1, nshards + 1):
+        with open(markers[shard]) as fh:
+            marker = json.load(fh)
+        suffix = shard_suffix((shard, nshards))
+        # scores are written as they were read, so that they are identical
+        shard_scored = pd.read_csv(
+            Path(output_dir, f"{stem}_scored{suffix}.csv"),
+            dtype={'read_id': str, 'read_id_next': str, 'score': float},
+            float_precision='round_trip', index_col='pair_index')
+        if len(shard_scored) != marker['scored']:
+            raise ValueError(
+                f"Shard {shard} of {stem} has {len(shard_scored)} scored "
+                f"pairs, expected {marker['scored']}.")
+        scored.append(shard_scored)
+        with open(Path(output_dir, f"{stem}_filtered{suffix}.txt")) as fh:
+            filtered.update(tuple(line.split()) for line in fh)
+    scored = pd.concat(scored).sort_index(kind='stable')
+    passed = [
+        pair in filtered
+        for pair in zip(scored['read_id'], scored['read_id_next'])]
+
+    scored.to_csv(Path(output_dir, f"{stem}_scored.csv"), index=False)
+    scored.loc[passed, ["read_id", "read_id_next"]].to_csv(
+        Path(output_dir, f"{stem}_filtered.txt"),
+        index=False, header=False, sep=" ")
+    logger.info(
+        f"Merged {len(scored)} scored and {sum(passed)} filtered pairs.")
+    return scored.reset_index(drop=True)
+
+
+def argparser():
+    """Create argument parser."""
+    parser = ArgumentParser(
+        "Merge the outputs of filter_pairs or pair run with --shard.",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        parents=[duplex_tools._log_level()],
+        add_help=False)
+    parser.add_argument(
+        "output_dir",
+        help="The output directory of the shards: --output_dir of pair, or "
+             "the directory of the candidate pairs file of filter_pairs.")
+    parser.add_argument(
+        "--stem",
+        help="Stem of the outputs to merge, for example pair_ids. By "
+             "default all sharded outputs in the directory are merged.")
+    return parser
+
+
+def main(args):
+    """Entry point."""
+    stems = [args.stem] if args.stem is not None else list(
+        find_sharded_runs(args.output_dir))
+    if not stems:
+        raise FileNotFoundError(
+            f"No completed shards found in {args.output_dir}.")
+    for stem in stems:
+        merge_shards(args.output_dir, stem)
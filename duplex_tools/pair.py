@@ -31,6 +31,7 @@ def pair_and_align(input_bam,
                    score_match,
                    score_mismatch,
                    threads,
+                   shard=None,
                    **kwargs):
     """Pair and align reads from an unmapped bam.
 
@@ -43,37 +44,51 @@ def pair_and_align(input_bam,
     :param bases_to_align: see filter_pairs
     :param min_length: see filter_pairs
     :param max_length: see filter_pairs
+    :param shard: see filter_pairs. Only the first shard writes the
+        candidate pairs.
+
+    :returns: DataFrame of the scored pairs, see filter_pairs.
     """
     logger = duplex_tools.get_named_logger("Pair")
-    find_pairs(input_bam,
-               outdir=output_dir,
-               max_time_between_reads=max_time_between_reads,
-               max_seqlen_diff=max_seqlen_diff,
-               max_abs_seqlen_diff=max_abs_seqlen_diff,
-               min_qscore=min_qscore,
-               )
-    filter_candidate_pairs_by_aligning(f'{output_dir}/pair_ids.txt',
-                                       reads_path=input_bam,
-                                       bases_to_align=bases_to_align,
-                                       min_length=min_length,
-                                       max_length=max_length,
-                                       align_threshold=align_threshold,
-                                       no_end_penalties=no_end_penalties,
-                                       penalty_open=penalty_open,
-                                       penalty_extend=penalty_extend,
-                                       score_match=score_match,
-                                       score_mismatch=score_mismatch,
-                                       threads=threads
-                                       )
+    # candidate pairs are passed on in memory, as well as written
+    write_candidates = shard is None or shard[0] == 1
+    pairs = find_pairs(input_bam,
+                       outdir=output_dir if write_candidates else None,
+                       max_time_between_reads=max_time_between_reads,
+                       max_seqlen_diff=max_seqlen_diff,
+                       max_abs_seqlen_diff=max_abs_seqlen_diff,
+                       min_qscore=min_qscore,
+                       )
+    scored = filter_candidate_pairs_by_aligning(
+        pairs,
+        reads_path=input_bam,
+        output_dir=output_dir,
+        bases_to_align=bases_to_align,
+        min_length=min_length,
+        max_length=max_length,
+        align_threshold=align_threshold,
+        no_end_penalties=no_end_penalties,
+        penalty_open=penalty_open,
+        penalty_extend=penalty_extend,
+        score_match=score_match,
+        score_mismatch=score_mismatch,
+        threads=threads,
+        shard=shard,
+        )
 
-    npairs = sum(1 for _ in open(f'{output_dir}/pair_ids_filtered.txt'))
+    npairs = int((scored['score'] > align_threshold).sum())
     nreads = pysam.AlignmentFile(input_bam, check_sq=False).count(
         until_eof=True)
     logger.info(f'Initial reads: {nreads}')
+    if shard is not None:
+        # the rate of the run is only known once the shards are merged
+        logger.info(f'Created pairs in shard {shard[0]}/{shard[1]}: {npairs}')
+        return scored
     logger.info(f'Created pairs: {npairs}')
     logger.info(f'Paired reads:  {2 * npairs}')
     logger.info(f'Approximate duplex rate for {input_bam}: '
                 f'{2*100*npairs / nreads:.2f}%')
+    return scored
 
 
 def argparser():
@@ -114,4 +129,5 @@ def main(args):
                    score_match=args.score_match,
                    score_mismatch=args.score_mismatch,
                    threads=args.threads,
+                   shard=args.shard,
                    )
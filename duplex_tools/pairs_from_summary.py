@@ -10,18 +10,20 @@ This script takes a sequencing summary and examines:
 """
 # TODO: rewrite this, its seems a little verbose/contorted
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from collections import defaultdict
 import math
 from pathlib import Path
 
 import pandas as pd
-import pysam
 from tqdm import tqdm
 
 import duplex_tools
+from duplex_tools import memory, profiling
+from duplex_tools.reads import is_xam, read_batches
 
 
 def find_pairs(
-        sequencing_summary_path: str,
+        sequencing_summary_path,
         outdir: str = "1d2_pairs_noalign",
         prefix: str = "pair",
         prepend_seqsummary_stem: bool = False,
@@ -29,28 +31,97 @@ def find_pairs(
         max_seqlen_diff=0.1,
         match_barcodes: bool = False,
         min_qscore: float = None,
-        max_abs_seqlen_diff: int = None) -> None:
-    """Find pairs using metrics stored in a sequencing summary file."""
+        max_abs_seqlen_diff: int = None) -> pd.DataFrame:
+    """Find pairs using metrics stored in a sequencing summary file.
+
+    :param sequencing_summary_path: Path to a sequencing summary or dorado
+        (u)BAM, or a summary already loaded by `load_seqsummary`.
+    :param outdir: Directory to write `<prefix>_ids.txt` and
+        `<prefix>_stats.txt` to, or None to write nothing.
+
+    :returns: DataFrame of candidate pairs, with columns `read_id` and
+        `read_id_next`, as written to `<prefix>_ids.txt`.
+    """
     logger = duplex_tools.get_named_logger("FindPairs")
     logger.info(f'Duplex tools version: {duplex_tools.__version__}')
-    outdir, output_pairs, output_intermediate = prepare_output_paths(
-        outdir, prefix, prepend_seqsummary_stem, sequencing_summary_path)
-    if Path(sequencing_summary_path).suffix in {'.bam', '.sam'}:
+    in_memory = isinstance(sequencing_summary_path, pd.DataFrame)
+    if outdir is not None:
+        if in_memory and prepend_seqsummary_stem:
+            raise ValueError(
+                "prepend_seqsummary_stem requires a sequencing summary path.")
+        outdir, output_pairs, output_intermediate = prepare_output_paths(
+            outdir, prefix, prepend_seqsummary_stem, sequencing_summary_path)
+    with profiling.stage('load_summary'):
+        if in_memory:
+            # the metrics are added to the summary as columns
+            seqsummary = sequencing_summary_path.copy()
+        else:
+            seqsummary = load_seqsummary(sequencing_summary_path)
+    memory.log_usage("Loading summary")
+
+    with profiling.stage('compute_metrics'):
+        logger.info('Calculating metrics.')
+        seqsummary = calculate_metrics_for_next_strand(seqsummary)
+
+        try:
+            seqsummary = calculate_alignment_metrics(seqsummary)
+        except KeyError:
+            logger.info("No alignment information found for validation.")
+
+        logger.info('Classifying pairs.')
+        tempcompsummary = seqsummary_to_tempcompsummary(
+            seqsummary,
+            max_time_between_reads=max_time_between_reads,
+            max_seqlen_diff=max_seqlen_diff,
+            match_barcodes=match_barcodes,
+            min_qscore=min_qscore,
+            max_abs_seqlen_diff=max_abs_seqlen_diff)
+    memory.log_usage("Calculating metrics")
+
+    candidate_pairs = seqsummary.query('candidate_followon')
+    ncandidate_pairs = len(candidate_pairs)
+    nstrands = len(seqsummary)
+    frac_pairs = 100 * ncandidate_pairs * 2 / nstrands
+    logger.info(
+        f"Found {ncandidate_pairs} pairs within {nstrands} reads. "
+        f"({frac_pairs:.1f}% of reads are part of a pair).")
+    logger.info('Values above 100% are allowed since reads can be either '
+                'template or complement')
+    profiling.add_counts({
+        'reads': nstrands,
+        'bases': seqsummary['sequence_length_template'].sum(),
+        'candidate_pairs': ncandidate_pairs})
+    pairs = candidate_pairs[['read_id', 'read_id_next']] \
+        .drop_duplicates() \
+        .reset_index(drop=True)
+    if outdir is None:
+        return pairs
+
+    logger.info(f'Writing files into {outdir} directory')
+    with profiling.stage('write'):
+        tempcompsummary.to_csv(output_intermediate, index=False, sep="\t")
+        pairs.to_csv(output_pairs, index=False, sep=" ", header=False)
+    return pairs
+
+
+def load_seqsummary(sequencing_summary_path):
+    """Load a sequencing summary, or create one from a dorado (u)BAM."""
+    logger = duplex_tools.get_named_logger("FindPairs")
+    if is_xam(sequencing_summary_path):
         logger.info('Creating seqsummary from bam')
-        bamfile = pysam.AlignmentFile(sequencing_summary_path,
-                                      check_sq=False)  # Allow uBAM
-        records = []
-        for read in tqdm(bamfile.fetch(until_eof=True)):  # Allow uBAM
-            records.append({'read_id': read.qname,
-                            'duration': read.get_tag('du'),
-                            'start_time': read.get_tag('st'),
-                            'channel': read.get_tag('ch'),
-                            'mux': read.get_tag('mx'),
-                            'sequence_length_template': read.query_length,
-                            'mean_qscore_template': read.get_tag('qs')
-                            }
-                           )
-        seqsummary = pd.DataFrame(records)
+        # columns rather than a dictionary per read, to save memory
+        columns = defaultdict(list)
+        fields = {
+            'read_id': 'read_id', 'du': 'duration', 'st': 'start_time',
+            'ch': 'channel', 'mx': 'mux',
+            'length': 'sequence_length_template',
+            'qs': 'mean_qscore_template'}
+        with tqdm(unit=' reads') as progress:
+            for batch in read_batches(sequencing_summary_path, fields):
+                for name, values in zip(fields.values(), zip(*batch)):
+                    columns[name].extend(values)
+                progress.update(len(batch))
+        seqsummary = pd.DataFrame(columns)
         seqsummary['start_time'] = (
                 pd.to_datetime(seqsummary['start_time']) -
                 pd.to_datetime(seqsummary['start_time']).min()
@@ -81,40 +152,7 @@ def find_pairs(
                 "alignment_genome_start": "-",
                 "alignment_genome_end": "-"}
         )
-
-    logger.info('Calculating metrics.')
-    seqsummary = calculate_metrics_for_next_strand(seqsummary)
-
-    try:
-        seqsummary = calculate_alignment_metrics(seqsummary)
-    except KeyError:
-        logger.info("No alignment information found for validation.")
-
-    logger.info('Classifying pairs.')
-    tempcompsummary = seqsummary_to_tempcompsummary(
-        seqsummary,
-        max_time_between_reads=max_time_between_reads,
-        max_seqlen_diff=max_seqlen_diff,
-        match_barcodes=match_barcodes,
-        min_qscore=min_qscore,
-        max_abs_seqlen_diff=max_abs_seqlen_diff)
-
-    candidate_pairs = seqsummary.query('candidate_followon')
-    ncandidate_pairs = len(candidate_pairs)
-    nstrands = len(seqsummary)
-    frac_pairs = 100 * ncandidate_pairs * 2 / nstrands
-    logger.info(
-        f"Found {ncandidate_pairs} pairs within {nstrands} reads. "
-        f"({frac_pairs:.1f}% of reads are part of a pair).")
-    logger.info('Values above 100% are allowed since reads can be either '
-                'template or complement')
-    logger.info(f'Writing files into {outdir} directory')
-
-    # Write
-    tempcompsummary.to_csv(output_intermediate, index=False, sep="\t")
-    candidate_pairs[['read_id', 'read_id_next']] \
-        .drop_duplicates() \
-        .to_csv(output_pairs, index=False, sep=" ", header=False)
+    return seqsummary
 
 
 def prepare_output_paths(
@@ -0,0 +1,314 @@
+"""Per-stage timing and profiling.
+
+Code wraps its named stages in `stage`, and reports its counters with
+`add_counts`, both of which do nothing unless profiling has been enabled
+with `configure`, as done by the `--profile` and `--metrics` options of
+the command line. Stage wall and CPU times are then accumulated and,
+optionally, each stage is profiled with `cProfile` or a sampling
+profiler.
+
+Profiling is passed to worker processes through the environment; each
+process writes its own timings, counters and profiles, which are merged
+by `report` in the main process.
+"""
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import cProfile
+import functools
+import json
+from multiprocessing import util
+import os
+from pathlib import Path
+import platform
+import pstats
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import duplex_tools
+
+ENV_VAR = 'DUPLEX_TOOLS_PROFILE'
+PROFILERS = ('cprofile', 'sampling')
+
+_SESSION = None
+
+
+class _Session:
+    """Profiling state of a single process."""
+
+    def __init__(self, directory, profiler=None, keep=False, interval=0.005):
+        self.directory = Path(directory)
+        self.profiler = profiler
+        self.keep = keep
+        self.interval = interval
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+        self.timings = defaultdict(lambda: [0.0, 0.0, 0])
+        self.counts = Counter()
+        self.counts_lock = threading.Lock()
+        self.profiles = dict()
+        self.samples = defaultdict(Counter)
+        self.stacks = dict()
+        self.local = threading.local()
+        self.stopped = threading.Event()
+        self.sampler = None
+        if profiler == 'sampling':
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = list()
+            self.stacks[threading.get_ident()] = stack
+        return stack
+
+    @contextmanager
+    def stage(self, name):
+        stack = self._stack()
+        # only one cProfile profiler can be active in a thread
+        if self.profiler == 'cprofile':
+            if stack:
+                self.profiles[stack[-1]].disable()
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        stack.append(name)
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            timing = self.timings[name]
+            timing[0] += time.perf_counter() - start
+            timing[1] += time.thread_time() - cpu_start
+            timing[2] += 1
+            stack.pop()
+            if self.profiler == 'cprofile':
+                profile.disable()
+                if stack:
+                    self.profiles[stack[-1]].enable()
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, stack in list(self.stacks.items()):
+                if not stack or ident not in frames:
+                    continue
+                frame, names = frames[ident], list()
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(
+                        f'{code.co_name} ({Path(code.co_filename).name}'
+                        f':{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.samples[stack[-1]][';'.join(reversed(names))] += 1
+
+    def dump(self):
+        """Write the timings, counters and profiles of this process."""
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        pid = os.getpid()
+        with open(self.directory / f'timings.{pid}.json', 'w') as fh:
+            json.dump(
+                {'timings': dict(self.timings), 'counts': dict(self.counts)},
+                fh)
+        for name, profile in self.profiles.items():
+            profile.dump_stats(self.directory / f'{name}.{pid}.pstats')
+        for name, samples in list(self.samples.items()):
+            with open(self.directory / f'{name}.{pid}.folded', 'w') as fh:
+                for stack, count in samples.items():
+                    fh.write(f'{stack} {count}\n')
+
+
+def _session():
+    global _SESSION
+    if _SESSION is not None and _SESSION.pid == os.getpid():
+        return _SESSION
+    if ENV_VAR not in os.environ:
+        return None
+    # a worker process, forked or spawned, profiles into the same directory
+    _SESSION = _Session(**json.loads(os.environ[ENV_VAR]))
+    util.Finalize(_SESSION, _SESSION.dump, exitpriority=100)
+    return _SESSION
+
+
+@contextmanager
+def stage(name):
+    """Time, and optionally profile, a named stage.
+
+    Nested stages are timed inclusively, while profiles attribute calls
+    to the innermost stage.
+
+    :param name: name of the stage, used in output file names.
+    """
+    session = _session()
+    if session is None:
+        yield
+    else:
+        with session.stage(name):
+            yield
+
+
+def staged(name):
+    """Decorate a function to run each call of it as a named `stage`.
+
+    :param name: name of the stage.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_counts(counts):
+    """Add to the counters reported for the run.
+
+    Counters are summed over calls and processes. The counters `reads`
+    and `bases` give the throughput of the run.
+
+    :param counts: mapping of counter name to number.
+    """
+    session = _session()
+    if session is None:
+        return
+    # counters may be added to from several threads
+    with session.counts_lock:
+        for name, count in counts.items():
+            session.counts[name] += int(count)
+
+
+def configure(profile_dir=None, profiler=None):
+    """Enable profiling in this process and worker processes it starts.
+
+    :param profile_dir: directory to write merged profiles to, by default
+        only stage timings are reported.
+    :param profiler: one of `PROFILERS`, or None to only time stages.
+    """
+    global _SESSION
+    if profile_dir is None:
+        directory = tempfile.mkdtemp(prefix='duplex_tools_profile_')
+    else:
+        directory = profile_dir
+        Path(directory).mkdir(parents=True, exist_ok=True)
+    config = {
+        'directory': str(directory), 'profiler': profiler,
+        'keep': profile_dir is not None}
+    os.environ[ENV_VAR] = json.dumps(config)
+    _SESSION = _Session(**config)
+
+
+def _peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale / 1e6
+
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def report(metrics=None, log=True, **run):
+    """Merge the timings, counters and profiles of all processes.
+
+    Profiles of each stage are merged into `<stage>.pstats` (cProfile) or
+    `<stage>.folded` (sampling, in the folded stack format taken by
+    flame graph tools) in the profile directory.
+
+    Worker figures cover worker processes which have finished, as those
+    of a pool do when it is shut down. Worker utilisation is the CPU time
+    of the workers as a fraction of the wall time of the run times the
+    number of workers.
+
+    :param metrics: path of a JSON file to write the run metrics to.
+    :param log: log the stage timings.
+    :param run: additional items describing the run, such as the command,
+        included in the metrics.
+    :returns: dictionary of run metrics.
+    """
+    global _SESSION
+    session = _session()
+    if session is None:
+        return {}
+    session.dump()
+    wall_seconds = time.perf_counter() - session.start
+    directory = session.directory
+    timings = defaultdict(lambda: {
+        'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0, 'processes': 0})
+    counts = Counter()
+    workers = 0
+    for path in directory.glob('timings.*.json'):
+        with open(path) as fh:
+            dumped = json.load(fh)
+        for name, (seconds, cpu_seconds, calls) in dumped['timings'].items():
+            timings[name]['wall_seconds'] += seconds
+            timings[name]['cpu_seconds'] += cpu_seconds
+            timings[name]['calls'] += calls
+            timings[name]['processes'] += 1
+        counts.update(dumped['counts'])
+        workers += path.name != f'timings.{session.pid}.json'
+        path.unlink()
+    profiles = defaultdict(list)
+    for path in directory.glob('*.*.pstats'):
+        profiles[path.name.split('.')[0]].append(path)
+    for name, paths in profiles.items():
+        pstats.Stats(*map(str, paths)).dump_stats(directory / f'{name}.pstats')
+        for path in paths:
+            path.unlink()
+    samples = defaultdict(Counter)
+    for path in directory.glob('*.*.folded'):
+        with open(path) as fh:
+            for line in fh:
+                stack, count = line.rsplit(' ', 1)
+                samples[path.name.split('.')[0]][stack] += int(count)
+        path.unlink()
+    for name, stacks in samples.items():
+        with open(directory / f'{name}.folded', 'w') as fh:
+            for stack, count in stacks.most_common():
+                fh.write(f'{stack} {count}\n')
+
+    worker_cpu_seconds = _cpu_seconds(resource.RUSAGE_CHILDREN)
+    results = {
+        **run,
+        'version': duplex_tools.__version__,
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': _cpu_seconds(resource.RUSAGE_SELF),
+        'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF),
+        'worker_processes': workers,
+        'worker_cpu_seconds': worker_cpu_seconds,
+        'worker_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+        'worker_utilisation': (
+            worker_cpu_seconds / (wall_seconds * workers)
+            if workers else None),
+        'reads_per_s': (
+            counts['reads'] / wall_seconds if 'reads' in counts else None),
+        'bases_per_s': (
+            counts['bases'] / wall_seconds if 'bases' in counts else None),
+        'stages': dict(timings),
+        'counters': dict(counts)}
+    logger = duplex_tools.get_named_logger("Profile")
+    if log:
+        logger.info("Stage timings (seconds summed over processes):")
+        for name, timing in sorted(
+                timings.items(), key=lambda x: -x[1]['wall_seconds']):
+            logger.info(
+                f"  {name}: {timing['wall_seconds']:.3f}s wall, "
+                f"{timing['cpu_seconds']:.3f}s CPU in {timing['calls']} "
+                f"calls by {timing['processes']} process(es)")
+    if metrics is not None:
+        with open(metrics, 'w') as fh:
+            json.dump(results, fh, indent=2, default=str)
+        logger.info(f"Run metrics written to {metrics}")
+    if session.keep:
+        logger.info(f"Profiles written to {directory}")
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+    del os.environ[ENV_VAR]
+    _SESSION = None
+    return results
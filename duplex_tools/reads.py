@@ -0,0 +1,394 @@
+"""Batched reading of fastq, gzip/BGZF fastq, SAM and uBAM files.
+
+All subcommands read their input through `read_batches`, which yields
+batches of compact records holding only the fields asked for:
+
+    for batch in read_batches(path, fields=('read_id', 'seq', 'qs')):
+        for read_id, seq, qscore in batch:
+            ...
+
+Fields are `read_id`, `seq`, `qual`, `comment`, `length`, `tags` (all the
+tags of a SAM/BAM record with their value types) or the name of a single
+tag, such as `qs`, whose value is None for records without it. Tags of
+fastq records are taken from `XX:T:value` items of their comment, as
+written by dorado.
+
+SAM/BAM files and BGZF compressed fastq are decompressed in parallel
+threads, other gzip compressed fastq in a thread of its own. Batches are
+read ahead in a background thread while the caller works on the previous
+ones.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+import os
+from pathlib import Path
+import queue
+import struct
+import threading
+import zlib
+
+import pysam
+
+FIELDS = ('read_id', 'seq', 'qual', 'comment', 'length', 'tags')
+XAM_SUFFIXES = {'.bam', '.sam'}
+GZIP_MAGIC = b'\x1f\x8b'
+# compressed bytes read at a time
+CHUNK_SIZE = 1 << 20
+TAG_TYPES = {'i': int, 'f': float, 'Z': str, 'A': str, 'H': str}
+
+
+def default_threads():
+    """Return the default number of decompression threads."""
+    return min(4, os.cpu_count() or 1)
+
+
+def is_xam(path):
+    """Check whether a path is a SAM/BAM file."""
+    return Path(path).suffix in XAM_SUFFIXES
+
+
+def read_batches(
+        path, fields=('read_id', 'seq'), batch_size=1000, threads=None,
+        read_ahead=2):
+    """Read batches of records from a fastq, SAM or BAM file.
+
+    :param path: fastq (optionally gzip or BGZF compressed), fasta, SAM
+        or BAM file.
+    :param fields: the fields of each record, see the module docstring.
+    :param batch_size: number of records in a batch.
+    :param threads: number of decompression threads, by default
+        `default_threads()`.
+    :param read_ahead: number of batches read ahead of the caller, or 0
+        to read in the calling thread.
+    :returns: iterator of lists of tuples of the requested fields.
+    """
+    fields = tuple(fields)
+    for field in fields:
+        if field not in FIELDS and len(field) != 2:
+            raise ValueError(f"Unknown read field: {field}")
+    if threads is None:
+        threads = default_threads()
+    if is_xam(path):
+        batches = _xam_batches(path, fields, batch_size, threads)
+    else:
+        batches = _fastx_batches(path, fields, batch_size, threads)
+    if read_ahead > 0:
+        batches = _read_ahead(batches, read_ahead)
+    return batches
+
+
+def read_records(path, fields=('read_id', 'seq'), **kwargs):
+    """Read records one at a time, as `read_batches`.
+
+    :returns: iterator of tuples of the requested fields.
+    """
+    for batch in read_batches(path, fields, **kwargs):
+        yield from batch
+
+
+def _read_ahead(batches, nbatches):
+    """Iterate batches produced in a background thread."""
+    done = object()
+    buffer = queue.Queue(maxsize=nbatches)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for batch in batches:
+                while not stop.is_set():
+                    try:
+                        buffer.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    break
+        except BaseException as e:
+            buffer.put(e)
+        finally:
+            batches.close()
+            buffer.put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = buffer.get()
+            if batch is done:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            yield batch
+    finally:
+        # the caller may stop early, let the producer finish
+        stop.set()
+        while thread.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+def _xam_batches(path, fields, batch_size, threads):
+    getters = [_xam_getter(field) for field in fields]
+    with pysam.AlignmentFile(
+            str(path), check_sq=False, threads=threads) as bam:
+        it = bam.fetch(until_eof=True)
+        while True:
+            batch = [
+                tuple([get(read) for get in getters])
+                for read in islice(it, batch_size)]
+            if not batch:
+                break
+            yield batch
+
+
+def _xam_qual(read):
+    qual = read.query_qualities
+    return '' if qual is None else pysam.qualities_to_qualitystring(qual)
+
+
+def _xam_tag(tag):
+    def get(read):
+        return read.get_tag(tag) if read.has_tag(tag) else None
+    return get
+
+
+def _xam_getter(field):
+    getters = {
+        'read_id': lambda read: read.query_name,
+        'seq': lambda read: read.query_sequence,
+        'qual': _xam_qual,
+        'comment': lambda read: '',
+        'length': lambda read: read.query_length,
+        'tags': lambda read: read.get_tags(with_value_type=True)}
+    return getters.get(field) or _xam_tag(field)
+
+
+def parse_tag(item):
+    """Parse a `XX:T:value` tag of a fastq comment.
+
+    :returns: (tag, value), or None if the item is not a tag.
+    """
+    if len(item) < 5 or item[2] != ':' or item[4] != ':':
+        return None
+    tag, value_type, value = item[:2], item[3], item[5:]
+    try:
+        if value_type == 'B':
+            subtype, *values = value.split(',')
+            convert = float if subtype == 'f' else int
+            return tag, [convert(x) for x in values]
+        return tag, TAG_TYPES[value_type](value)
+    except (KeyError, ValueError):
+        return None
+
+
+def _comment_tags(comment):
+    tags = {}
+    for item in (comment or '').split():
+        parsed = parse_tag(item)
+        if parsed is not None:
+            tags[parsed[0]] = parsed[1]
+    return tags
+
+
+def _fastx_record(read_id, seq, qual, comment, fields):
+    tags = None
+    values = []
+    for field in fields:
+        if field == 'read_id':
+            values.append(read_id)
+        elif field == 'seq':
+            values.append(seq)
+        elif field == 'qual':
+            values.append(qual)
+        elif field == 'comment':
+            values.append(comment)
+        elif field == 'length':
+            values.append(len(seq))
+        elif field == 'tags':
+            # the tags of fastq records stay in their comment
+            values.append(None)
+        else:
+            if tags is None:
+                tags = _comment_tags(comment)
+            values.append(tags.get(field))
+    return tuple(values)
+
+
+def _fastq_records(lines, fields):
+    """Create records from the lines of four-line fastq records.
+
+    Fields are created a column at a time, which is much faster than
+    a record at a time.
+    """
+    columns = {'seq': lines[1::4], 'qual': lines[3::4]}
+    if {'read_id', 'comment'}.intersection(fields) or \
+            not set(fields).issubset(FIELDS):
+        headers = [header[1:].split(maxsplit=1) for header in lines[0::4]]
+        columns['read_id'] = [header[0] for header in headers]
+        columns['comment'] = [
+            header[1] if len(header) > 1 else None for header in headers]
+    if 'length' in fields:
+        columns['length'] = [len(seq) for seq in columns['seq']]
+    if 'tags' in fields:
+        columns['tags'] = [None] * len(columns['seq'])
+    tags = [name for name in fields if name not in FIELDS]
+    if tags:
+        parsed = [_comment_tags(comment) for comment in columns['comment']]
+        for name in tags:
+            columns[name] = [x.get(name) for x in parsed]
+    return list(zip(*[columns[field] for field in fields]))
+
+
+def _fastx_batches(path, fields, batch_size, threads):
+    chunks = _decompressed_chunks(path, threads)
+    first = next((chunk for chunk in chunks if chunk), b'')
+    lines = first.decode(errors='replace').split('\n')
+    lines = lines[:4 * ((len(lines) - 1) // 4)]
+    if not lines or not _is_four_line(lines):
+        # fasta, multi-line fastq or very long reads: the generic (and
+        # slower) parser will do
+        chunks.close()
+        yield from _pysam_fastx_batches(path, fields, batch_size)
+        return
+    batch = []
+    for lines in _parse_fastq(first, chunks, path):
+        batch.extend(_fastq_records(lines, fields))
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    if batch:
+        yield batch
+
+
+def _pysam_fastx_batches(path, fields, batch_size):
+    with pysam.FastxFile(str(path), persist=False) as fh:
+        while True:
+            batch = [
+                _fastx_record(
+                    read.name, read.sequence, read.quality, read.comment,
+                    fields)
+                for read in islice(fh, batch_size)]
+            if not batch:
+                break
+            yield batch
+
+
+def _parse_fastq(data, chunks, path):
+    """Split chunks of decompressed data into lines of fastq records.
+
+    :returns: iterator of lists of the lines of four-line records.
+    """
+    # undecoded bytes of an incomplete line, and lines of an incomplete
+    # record
+    pending, remainder = b'', ''
+    for chunk in chain([data], chunks):
+        pending += chunk
+        # a newline is never part of a multibyte character
+        cut = pending.rfind(b'\n') + 1
+        if cut == 0:
+            continue
+        text = remainder + pending[:cut].decode()
+        pending = pending[cut:]
+        if '\r' in text:
+            text = text.replace('\r', '')
+        lines = text.split('\n')
+        nlines = 4 * ((len(lines) - 1) // 4)
+        remainder = '\n'.join(lines[nlines:])
+        if nlines:
+            yield _check_four_line(lines[:nlines], path)
+    remainder += pending.decode().replace('\r', '')
+    if remainder.strip():
+        lines = remainder.rstrip('\n').split('\n')
+        if len(lines) != 4:
+            raise ValueError(f"Truncated fastq record in {path}")
+        yield _check_four_line(lines, path)
+
+
+def _is_four_line(lines):
+    return (
+        all(header[:1] == '@' for header in lines[0::4])
+        and all(separator[:1] == '+' for separator in lines[2::4]))
+
+
+def _check_four_line(lines, path):
+    if not _is_four_line(lines):
+        raise ValueError(
+            f"Malformed fastq record in {path}, records of a fastq file "
+            "starting with four-line records must all have four lines.")
+    return lines
+
+
+def _decompressed_chunks(path, threads):
+    """Iterate chunks of the decompressed contents of a file."""
+    with open(path, 'rb') as fh:
+        magic = fh.read(18)
+        fh.seek(0)
+        if magic[:2] != GZIP_MAGIC:
+            while True:
+                chunk = fh.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        elif is_bgzf_header(magic) and threads > 1:
+            yield from _bgzf_chunks(fh, threads)
+        else:
+            yield from _gzip_chunks(fh)
+
+
+def is_bgzf_header(header):
+    """Check whether the first bytes of a file are a BGZF block header."""
+    return (
+        len(header) >= 18 and header[:4] == b'\x1f\x8b\x08\x04'
+        and header[12:16] == b'BC\x02\x00')
+
+
+def _gzip_chunks(fh):
+    """Decompress a (multi-member) gzip file."""
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    while True:
+        data = fh.read(CHUNK_SIZE)
+        if not data:
+            break
+        while data:
+            yield decompressor.decompress(data)
+            data = decompressor.unused_data
+            if data or decompressor.eof:
+                yield decompressor.flush()
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    yield decompressor.flush()
+
+
+def _inflate_blocks(blocks):
+    # zlib releases the GIL, so blocks are inflated in parallel
+    return b''.join(
+        zlib.decompress(block[18:-8], -15) for block in blocks)
+
+
+def _bgzf_chunks(fh, threads):
+    """Decompress a BGZF file, inflating blocks in worker threads."""
+    pending = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        buffer = b''
+        while True:
+            data = fh.read(CHUNK_SIZE)
+            buffer += data
+            blocks = []
+            offset = 0
+            while len(buffer) - offset >= 18:
+                bsize = struct.unpack_from('<H', buffer, offset + 16)[0] + 1
+                if len(buffer) - offset < bsize:
+                    break
+                blocks.append(buffer[offset:offset + bsize])
+                offset += bsize
+            buffer = buffer[offset:]
+            if blocks:
+                pending.append(executor.submit(_inflate_blocks, blocks))
+            while len(pending) > 2 * threads or (pending and not data):
+                yield pending.pop(0).result()
+            if not data:
+                break
+    if buffer:
+        raise ValueError("Truncated BGZF block")
@@ -0,0 +1,344 @@
+"""Simulate reads with known structure for testing and benchmarking.
+
+Three kinds of reads are produced:
+
+1. Concatemers of two molecules joined by an adapter, as split by
+   `split_on_adapter`.
+2. Template/complement reads, a template followed by its reverse
+   complement, with dorado-like move tables, as split by `split_pairs`.
+3. Runs of reads across channels, some of which are followed by their
+   complement as a separate read, with dorado-like `ch`, `mx`, `st`, `du`
+   and `qs` tags or a sequencing summary, as paired by `pairs_from_summary`
+   and `filter_pairs`.
+
+All generators are seeded so that data sets are reproducible.
+"""
+import array
+from datetime import datetime, timedelta, timezone
+import uuid
+
+import numpy as np
+import pandas as pd
+import pod5
+import pysam
+
+from duplex_tools.split_on_adapter import build_targets
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+COMPLEMENT = np.zeros(256, dtype=np.uint8)
+COMPLEMENT[BASES] = np.frombuffer(b'TGCA', dtype=np.uint8)
+
+
+def random_sequence(rng, length):
+    """Create a random DNA sequence.
+
+    :param rng: `numpy.random.Generator`.
+    :param length: length of the sequence.
+    """
+    return rng.choice(BASES, size=length).tobytes().decode()
+
+
+def reverse_complement(seq):
+    """Reverse complement a DNA sequence."""
+    return COMPLEMENT[np.frombuffer(seq.encode(), dtype=np.uint8)][
+        ::-1].tobytes().decode()
+
+
+def mutate(rng, seq, error_rate):
+    """Introduce substitutions, insertions and deletions into a sequence.
+
+    Errors of each type are equally likely.
+
+    :param rng: `numpy.random.Generator`.
+    :param seq: sequence to mutate.
+    :param error_rate: probability of an error at each base.
+    """
+    if error_rate == 0 or len(seq) == 0:
+        return seq
+    seq = np.frombuffer(seq.encode(), dtype=np.uint8)
+    draws = rng.random(len(seq))
+    substitute = draws < error_rate / 3
+    insert = (draws >= error_rate / 3) & (draws < 2 * error_rate / 3)
+    delete = (draws >= 2 * error_rate / 3) & (draws < error_rate)
+    seq = seq.copy()
+    seq[substitute] = rng.choice(BASES, size=substitute.sum())
+    # each base is emitted once, twice (insertion) or not at all (deletion)
+    counts = np.where(delete, 0, np.where(insert, 2, 1))
+    out = np.repeat(seq, counts)
+    positions = np.cumsum(counts)[insert] - 1
+    out[positions] = rng.choice(BASES, size=len(positions))
+    return out.tobytes().decode()
+
+
+def adapter_sequences(sample_type='Native'):
+    """Return the adapter junctions expected in concatemers.
+
+    These are the unmasked versions of the `split_on_adapter` targets.
+    """
+    return build_targets(
+        n_bases_to_mask_head=0, n_bases_to_mask_tail=0,
+        degenerate_bases=0)[sample_type]
+
+
+def simulate_concatemers(
+        n_reads, sample_type='Native', fraction_concatemers=0.5,
+        error_rate=0.05, min_length=1000, max_length=20000, seed=0):
+    """Simulate reads, some of which contain an internal adapter.
+
+    :param n_reads: number of reads.
+    :param sample_type: Native or PCR, decides the adapters inserted.
+    :param fraction_concatemers: fraction of reads with an adapter.
+    :param error_rate: error rate applied to the inserted adapter.
+    :param min_length: minimum length of the read (excluding adapter).
+    :param max_length: maximum length of the read (excluding adapter).
+    :param seed: random seed.
+    :returns: iterator of (read_id, seq, qual, adapter start, adapter end),
+        the adapter coordinates are None for reads without an adapter.
+    """
+    rng = np.random.default_rng(seed)
+    adapters = adapter_sequences(sample_type)
+    for i in range(n_reads):
+        read_id = f'concatemer_{seed}_{i}'
+        seq = random_sequence(rng, int(rng.integers(min_length, max_length)))
+        start = end = None
+        if rng.random() < fraction_concatemers:
+            adapter = mutate(
+                rng, adapters[rng.integers(len(adapters))], error_rate)
+            # keep the adapter away from the trimmed read ends
+            start = int(rng.integers(
+                min(300, len(seq) // 2), max(len(seq) - 300, len(seq) // 2)))
+            seq = seq[:start] + adapter + seq[start:]
+            end = start + len(adapter)
+        yield read_id, seq, '?' * len(seq), start, end
+
+
+def simulate_template_complement(
+        n_reads, fraction_pairs=0.5, error_rate=0.05, min_length=2000,
+        max_length=20000, stride=5, seed=0):
+    """Simulate reads, some of which are a template followed by complement.
+
+    :param n_reads: number of reads.
+    :param fraction_pairs: fraction of template/complement reads.
+    :param error_rate: error rate of the complement relative to template.
+    :param min_length: minimum length of the template.
+    :param max_length: maximum length of the template.
+    :param stride: signal stride of the move table.
+    :param seed: random seed.
+    :returns: iterator of (read_id, seq, qual, mv, ts, ns, midpoint), the
+        midpoint is None for reads which are not template/complement.
+    """
+    rng = np.random.default_rng(seed)
+    for i in range(n_reads):
+        read_id = f'tempcomp_{seed}_{i}'
+        template = random_sequence(
+            rng, int(rng.integers(min_length, max_length)))
+        midpoint = None
+        if rng.random() < fraction_pairs:
+            # a short stretch of sequence joins template and complement
+            junction = random_sequence(rng, int(rng.integers(10, 50)))
+            midpoint = len(template) + len(junction) // 2
+            seq = (
+                template + junction
+                + mutate(rng, reverse_complement(template), error_rate))
+        else:
+            seq = template
+        # one move per base followed by a variable number of stays
+        stays = rng.geometric(0.4, size=len(seq)) - 1
+        moves = np.zeros(len(seq) + stays.sum(), dtype=np.int8)
+        moves[np.cumsum(stays + 1) - stays - 1] = 1
+        mv = array.array('b', [stride]) + array.array('b', moves.tobytes())
+        ts = int(rng.integers(0, 500))
+        ns = ts + len(moves) * stride
+        yield read_id, seq, '?' * len(seq), mv, ts, ns, midpoint
+
+
+def write_fastq(path, records):
+    """Write simulated concatemers to a fastq file.
+
+    :returns: dictionary of read id to (adapter start, adapter end).
+    """
+    truth = {}
+    with open(path, 'w') as fh:
+        for read_id, seq, qual, start, end in records:
+            fh.write(f'@{read_id}\n{seq}\n+\n{qual}\n')
+            truth[read_id] = (start, end)
+    return truth
+
+
+def write_moves_bam(path, records):
+    """Write simulated template/complement reads to a uBAM with moves.
+
+    :returns: dictionary of read id to the midpoint in bases and in signal
+        samples, or None for reads which are not template/complement.
+    """
+    header = pysam.AlignmentHeader.from_dict(
+        {'HD': {'VN': '1.6', 'SO': 'unknown'}})
+    truth = {}
+    with pysam.AlignmentFile(str(path), 'wb', header=header) as bam:
+        for read_id, seq, qual, mv, ts, ns, midpoint in records:
+            record = pysam.AlignedSegment(header)
+            record.query_name = read_id
+            record.query_sequence = seq
+            record.query_qualities = pysam.qualitystring_to_array(qual)
+            record.flag = 4
+            record.set_tags([
+                ('mv', mv), ('ts', ts, 'i'), ('ns', ns, 'i')])
+            bam.write(record)
+            if midpoint is None:
+                truth[read_id] = None
+            else:
+                moves = np.cumsum(np.frombuffer(mv, dtype=np.int8)[1:])
+                truth[read_id] = (
+                    midpoint,
+                    int(np.searchsorted(moves, midpoint)) * mv[0] + ts)
+    return truth
+
+
+def write_pod5(path, records):
+    """Write simulated raw signal to a pod5 file.
+
+    :param records: iterable of (read id, signal), the read id must be a
+        UUID string and the signal an int16 array.
+    """
+    run_info = pod5.RunInfo(
+        acquisition_id='simulated',
+        acquisition_start_time=datetime.fromtimestamp(0, timezone.utc),
+        adc_max=4095, adc_min=-4096, context_tags={},
+        experiment_name='simulated', flow_cell_id='FAK00000',
+        flow_cell_product_code='FLO-MIN114', protocol_name='simulated',
+        protocol_run_id='simulated',
+        protocol_start_time=datetime.fromtimestamp(0, timezone.utc),
+        sample_id='simulated', sample_rate=5000,
+        sequencing_kit='SQK-LSK114', sequencer_position='MN00000',
+        sequencer_position_type='MinION', software='duplex_tools',
+        system_name='simulated', system_type='simulated', tracking_id={})
+    with pod5.Writer(str(path)) as writer:
+        for i, (read_id, signal) in enumerate(records):
+            writer.add_read(pod5.Read(
+                read_id=uuid.UUID(read_id),
+                pore=pod5.Pore(channel=1, well=1, pore_type='simulated'),
+                calibration=pod5.Calibration(offset=0.0, scale=1.0),
+                read_number=i, start_sample=0, median_before=200.0,
+                end_reason=pod5.EndReason(
+                    pod5.EndReasonEnum.SIGNAL_POSITIVE, False),
+                run_info=run_info, signal=signal))
+
+
+def simulate_pairing_summary(
+        n_reads, n_channels=512, fraction_duplex=0.2, min_length=1000,
+        max_length=20000, bases_per_second=400, mean_gap=5.0, seed=0):
+    """Simulate the reads of a run, some of which are duplex pairs.
+
+    Each channel sequences a series of molecules, separated by gaps drawn
+    from an exponential distribution. The template of a duplex molecule is
+    followed shortly after by its complement, which is up to 8% shorter.
+
+    :param n_reads: number of reads.
+    :param n_channels: number of channels, each with a fixed mux.
+    :param fraction_duplex: fraction of molecules which are duplex.
+    :param min_length: minimum length of a template.
+    :param max_length: maximum length of a template.
+    :param bases_per_second: translocation speed, giving read durations.
+    :param mean_gap: mean seconds between molecules in a channel.
+    :param seed: random seed.
+    :returns: sequencing summary DataFrame in order of start time, with a
+        `template_id` column holding the read id of the template of each
+        complement, or None.
+    """
+    rng = np.random.default_rng(seed)
+    duplex = rng.random(n_reads) < fraction_duplex
+    # keep whole molecules up to n_reads reads
+    nmolecules = int(np.searchsorted(np.cumsum(1 + duplex), n_reads, 'right'))
+    duplex = duplex[:nmolecules]
+    if nmolecules + duplex.sum() < n_reads:
+        duplex = np.append(duplex, False)
+    channel = rng.integers(1, n_channels + 1, size=len(duplex))
+    length = rng.integers(min_length, max_length, size=len(duplex))
+    qscore = np.clip(rng.normal(14, 3, size=len(duplex)), 2, 40)
+
+    # a read for each template, followed by one for each complement
+    molecule = np.repeat(np.arange(len(duplex)), 1 + duplex)
+    is_complement = np.zeros(len(molecule), dtype=bool)
+    is_complement[1:] = molecule[1:] == molecule[:-1]
+    lengths = length[molecule]
+    lengths[is_complement] = (lengths[is_complement] * (
+        1 - rng.uniform(0, 0.08, size=is_complement.sum()))).astype(int)
+    qscores = qscore[molecule]
+    qscores[is_complement] += rng.normal(0, 1, size=is_complement.sum())
+    duration = lengths / bases_per_second
+    gap = np.where(
+        is_complement, rng.uniform(0.05, 1.0, size=len(molecule)),
+        rng.exponential(mean_gap, size=len(molecule)))
+    id_bytes = rng.integers(
+        0, 256, size=(len(molecule), 16), dtype=np.uint8)
+    read_id = [str(uuid.UUID(bytes=x.tobytes(), version=4)) for x in id_bytes]
+    summary = pd.DataFrame({
+        'read_id': read_id,
+        'channel': channel[molecule],
+        'mux': (channel[molecule] % 4) + 1,
+        'duration': duration,
+        'sequence_length_template': lengths,
+        'mean_qscore_template': np.clip(qscores, 2, 40),
+        'template_id': pd.Series(read_id).shift(1).where(is_complement)})
+    # reads of a channel follow each other, in the order of the molecules
+    advance = pd.Series(gap + duration)
+    summary['start_time'] = (
+        advance.groupby(summary['channel']).cumsum() - duration)
+    summary['template_id'] = summary['template_id'].astype(object).where(
+        is_complement, None)
+    return summary.sort_values('start_time', ignore_index=True)
+
+
+def write_sequencing_summary(path, summary):
+    """Write a simulated sequencing summary, without the truth."""
+    summary.drop(columns='template_id').to_csv(path, sep='\t', index=False)
+
+
+def write_dorado_bam(path, summary, error_rate=0.05, seed=0):
+    """Write the reads of a simulated summary to a dorado-like uBAM.
+
+    Templates and simplex reads are random sequence, complements are the
+    mutated reverse complement of their template, trimmed to their length.
+
+    :param summary: DataFrame from `simulate_pairing_summary`.
+    :param error_rate: error rate of the complement relative to template.
+    :param seed: random seed.
+    """
+    rng = np.random.default_rng(seed)
+    run_start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    templates = set(summary['template_id'].dropna())
+    header = pysam.AlignmentHeader.from_dict(
+        {'HD': {'VN': '1.6', 'SO': 'unknown'}})
+    pending = {}
+    with pysam.AlignmentFile(str(path), 'wb', header=header) as bam:
+        for read in summary.itertuples(index=False):
+            length = int(read.sequence_length_template)
+            if read.template_id is None:
+                seq = random_sequence(rng, length)
+            else:
+                seq = mutate(
+                    rng, reverse_complement(pending.pop(read.template_id)),
+                    error_rate)[:length]
+                seq += random_sequence(rng, length - len(seq))
+            if read.read_id in templates:
+                pending[read.read_id] = seq
+            start = run_start + timedelta(seconds=float(read.start_time))
+            record = pysam.AlignedSegment(header)
+            record.query_name = read.read_id
+            record.query_sequence = seq
+            record.query_qualities = array.array(
+                'B', [int(read.mean_qscore_template)]) * length
+            record.flag = 4
+            record.set_tags([
+                ('qs', float(read.mean_qscore_template), 'f'),
+                ('du', float(read.duration), 'f'),
+                ('ch', int(read.channel), 'i'),
+                ('mx', int(read.mux), 'i'),
+                ('st', start.isoformat(timespec='milliseconds'), 'Z')])
+            bam.write(record)
+
+
+def pairing_truth(summary):
+    """Return the set of (template, complement) read ids of a summary."""
+    complements = summary.dropna(subset='template_id')
+    return set(zip(complements['template_id'], complements['read_id']))
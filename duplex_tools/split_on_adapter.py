@@ -1,20 +1,29 @@
 """Split reads containing internal adapter sequences."""
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from collections import defaultdict
 from concurrent.futures import ProcessPoolExecutor
 import functools
-import gzip
+import hashlib
+import json
+import os
 from pathlib import Path
-import pickle
 import sys
 
 import edlib
 from more_itertools import pairwise
 from natsort import natsorted
 import numpy as np
-from pyfastx import Fastx
+import parasail
+import pysam
 from tqdm import tqdm
 
 import duplex_tools
+from duplex_tools import memory, profiling
+from duplex_tools.filter_pairs import reverse_complement, score_pair
+from duplex_tools.reads import is_xam, read_records
+from duplex_tools.utils import mean_qscore
+from duplex_tools.writers import \
+    BamWriter, COMPRESSION_CHOICES, FastqWriter, ManifestWriter
 
 EDIT_THRESHOLDS = {'PCR': 45, 'Native': 9}
 mask_size_default_head = 5
@@ -23,6 +32,10 @@ mask_size_default_N = 11
 HEAD_ADAPTER = 'AATGTACTTCGTTCAGTTACGTATTGCT'
 TAIL_ADAPTER = 'GCAATACGTAACTGAACGAAGT'
 rctrans = str.maketrans('ACGT', 'TGCA')
+# uBAM tags which refer to positions in the read or signal and so cannot be
+# carried over to split reads
+POSITION_DEPENDENT_TAGS = {'mv', 'ts', 'ns', 'sp', 'MM', 'ML', 'MN'}
+READ_FIELDS = ('read_id', 'seq', 'qual', 'comment', 'tags')
 
 
 def rev_comp(seq):
@@ -60,6 +73,10 @@ def build_targets(
     return targets
 
 
+EDLIB_EQUALITIES = (('N', 'A'), ('N', 'C'), ('N', 'G'), ('N', 'T'))
+
+
+@profiling.staged('adapter_search')
 def find_mid_adaptor(
         seq, targets, print_alignment=False, print_threshold=10,
         print_id=None, trim_start=200, trim_end=200):
@@ -68,8 +85,7 @@ def find_mid_adaptor(
     results = [
         edlib.align(
             target, seq, mode="HW", task="path",
-            additionalEqualities=(
-                ('N', 'A'), ('N', 'C'), ('N', 'G'), ('N', 'T')))
+            additionalEqualities=EDLIB_EQUALITIES)
         for target in targets]
     if print_alignment:
         alignments = [
@@ -109,6 +125,214 @@ def deduplicate_locations_first_key(result):
     return result
 
 
+def iterate_reads(path, threads=1):
+    """Iterate over the records of a fastq/fasta or uBAM file.
+
+    :param path: the input file.
+    :param threads: number of decompression threads.
+    :returns: iterator of (read_id, seq, qual, comment, tags). The comment
+        of uBAM records is empty, fastq records keep their tags in the
+        comment and have no tags.
+    """
+    return read_records(path, READ_FIELDS, threads=threads)
+
+
+def split_reads(
+        reads, targets, edit_threshold,
+        print_alignment=False,
+        print_threshold_delta=0,
+        allow_multiple_splits=False,
+        trim_start=200,
+        trim_end=200,
+        ):
+    """Find where reads should be split on internal adapters.
+
+    :param reads: iterable of (read_id, seq, qual, comment, tags), as
+        from `iterate_reads`.
+    :param targets: adapter sequences, one of the values of `build_targets`.
+    :param edit_threshold: reads with an adapter hit of lower edit
+        distance are split.
+
+    :returns: iterator of (read, status, hits) for each read, where status
+        is one of `split`, `not_split` or `split_multiple_times` and hits
+        are the (start, end) of the parts of a split read, some of which
+        may be empty. See `split_parts`.
+    """
+    for read in reads:
+        read_id, seq = read[:2]
+        result = find_mid_adaptor(
+            seq, targets,
+            print_alignment=print_alignment,
+            print_threshold=edit_threshold + print_threshold_delta,
+            print_id=read_id,
+            trim_start=trim_start,
+            trim_end=trim_end)
+        if result['editDistance'] >= edit_threshold:
+            yield read, 'not_split', []
+            continue
+        result = deduplicate_locations_first_key(result)
+        if not allow_multiple_splits and len(result['locations']) > 1:
+            yield read, 'split_multiple_times', []
+            continue
+        hits = []
+        for left_hit, right_hit in pairwise(
+                [(0, 0), *result['locations'], (len(seq), len(seq))]):
+            hits.append((left_hit[1], right_hit[0]))
+        yield read, 'split', hits
+
+
+def split_parts(read, hits):
+    """Create the parts of a split read.
+
+    :param read: (read_id, seq, qual, comment, tags) of the read.
+    :param hits: (start, end) of the parts, as from `split_reads`.
+
+    :returns: iterator of (part, start, end), where part is the
+        (read_id, seq, qual, comment, tags) of a non-empty part.
+    """
+    read_id, seq, qual, comments, tags = read
+    for idx, (start, end) in enumerate(hits, start=1):
+        # This edge case can happen and results in empty
+        # sequence
+        if end <= start:
+            continue
+        subqual = qual[start:end]
+        part = (
+            f'{read_id}_{idx}', seq[start:end], subqual,
+            f'{comments} {start}->{end}',
+            None if tags is None else split_read_tags(tags, read_id, subqual))
+        yield part, start, end
+
+
+def split_read_tags(tags, read_id, qual):
+    """Create uBAM tags for a part of a split read.
+
+    Position dependent tags are dropped, the mean qscore is recalculated
+    for the part and the `pi` (parent read id) tag is set.
+    """
+    new_tags = []
+    parent = read_id
+    for tag, value, value_type in tags:
+        if tag in POSITION_DEPENDENT_TAGS:
+            continue
+        if tag == 'pi':
+            parent = value
+            continue
+        if tag == 'qs':
+            value = mean_qscore(
+                np.frombuffer(qual.encode(), dtype=np.uint8) - 33)
+            if value_type != 'f':
+                value = int(round(value))
+        new_tags.append((tag, value, value_type))
+    new_tags.append(('pi', parent, 'Z'))
+    return new_tags
+
+
+def output_paths(fastx, output_dir=None, compression='bgzf'):
+    """Decide output paths for an input file.
+
+    :returns: tuple of (split reads path, manifest path, completion marker
+        path).
+    """
+    if is_xam(fastx):
+        suffix = BamWriter.suffix
+    else:
+        suffix = FastqWriter.suffixes[compression]
+    newfastx = fastx.with_name(
+        fastx.name.replace('.fastq', '').replace('.gz', '')
+        .replace('.bam', '').replace('.sam', '') + '_split' + suffix)
+    if output_dir is not None:
+        newfastx = Path(output_dir) / newfastx.name
+    manifest_path = newfastx.with_name(
+        newfastx.name[:-len(suffix)] + ManifestWriter.suffix)
+    marker = newfastx.with_name(newfastx.name[:-len(suffix)] + '.done')
+    return newfastx, manifest_path, marker
+
+
+def partial_path(path):
+    """Temporary path for an output file which is not yet complete."""
+    return path.with_name(path.name + '.partial')
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """Calculate the md5 checksum of a file."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def input_identity(fastx):
+    """Identify an input file by its path, size and modification time."""
+    stat = os.stat(fastx)
+    return {
+        'path': str(fastx), 'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns}
+
+
+def output_options(
+        fastx, compression, debug_output=False, write_pairs=False,
+        score_pairs=False):
+    """Options deciding which outputs are written for an input file."""
+    return {
+        # uBAM inputs are always written as uBAM
+        'compression': None if is_xam(fastx) else compression,
+        'debug_output': debug_output,
+        'write_pairs': write_pairs or score_pairs,
+        'score_pairs': score_pairs}
+
+
+def write_completion_marker(marker, fastx, outputs, counts, options):
+    """Atomically record that an input file was processed completely.
+
+    :param marker: path of the marker file.
+    :param fastx: the input file, recorded with its size and modification
+        time.
+    :param outputs: the finished output files, recorded with checksums.
+    :param counts: the read and pair counts of the file, restored when
+        resuming.
+    :param options: the `output_options` the outputs were written with.
+    """
+    record = {
+        'input': input_identity(fastx),
+        'options': options,
+        'outputs': {x.name: file_checksum(x) for x in outputs},
+        'counts': dict(counts)}
+    tmp = partial_path(marker)
+    with open(tmp, 'w') as fh:
+        json.dump(record, fh, indent=2)
+    os.replace(tmp, marker)
+
+
+def is_complete(marker, fastx, options):
+    """Check an input file was processed and its outputs are intact.
+
+    Outputs of an input which has changed since, or which were written
+    with other `output_options`, are not complete.
+    """
+    try:
+        with open(marker) as fh:
+            record = json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    if record.get('input') != input_identity(fastx) or \
+            record.get('options') != options:
+        return False
+    for name, checksum in record['outputs'].items():
+        path = marker.with_name(name)
+        if not path.is_file() or file_checksum(path) != checksum:
+            return False
+    return True
+
+
+def counts_from_marker(marker):
+    """Read the counts of a processed file from its completion marker."""
+    with open(marker) as fh:
+        return defaultdict(int, json.load(fh)['counts'])
+
+
+@profiling.staged('split_file')
 def process_file(
         fastx, targets, output_dir=None,
         debug_output=False,
@@ -117,75 +341,136 @@ def process_file(
         print_threshold_delta=0,
         allow_multiple_splits=False,
         trim_start=200,
-        trim_end=200
+        trim_end=200,
+        compression='bgzf',
+        compression_threads=1,
+        compression_level=1,
+        write_pairs=False,
+        score_pairs=False,
+        bases_to_align=250,
+        align_threshold=0.6,
         ):
-    """Run the workflow on a single file."""
-    newfastx = fastx.with_name(
-        fastx.name.replace('.fastq',
-                           '').replace('.gz',
-                                       '') + '_split').with_suffix('.fastq.gz')
-    if output_dir is not None:
-        newfastx = Path(output_dir) / newfastx.name
+    """Run the workflow on a single file.
+
+    fastq files are written as fastq, uBAM (or uSAM) files are written as
+    uBAM keeping the position-independent tags of each read. The outcome
+    for each read is streamed to a manifest next to the output file.
+
+    The two parts of reads split in two are candidate template/complement
+    pairs. With `write_pairs` their ids are written to `*_pair_ids.txt`.
+    With `score_pairs` the pairs are also scored as by `filter_pairs`,
+    writing `*_pair_ids_scored.csv` and `*_pair_ids_filtered.txt`.
+
+    Outputs are written under temporary names and renamed once complete,
+    after which a completion marker holding their checksums is written.
+
+    :returns: dictionary of read counts.
+    """
+    newfastx, manifest_path, marker = output_paths(
+        fastx, output_dir, compression)
+    outputs = [newfastx, manifest_path]
     if debug_output:
         newfasta = Path(output_dir) / Path(
             fastx.stem.split('.')[0] + '_middle').with_suffix('.fasta')
-        fasta = open(newfasta, 'w')
-    edited_reads = set()
-    unedited_reads = set()
-    split_multiple_times = set()
-
-    nwritten = 0
-    with gzip.open(newfastx, mode='wt', compresslevel=1) as outfh:
-
-        for read_id, seq, qual, comments in \
-                tqdm(Fastx(str(fastx), comment=True), leave=False):
-            result = find_mid_adaptor(
-                seq, targets,
+        outputs.append(newfasta)
+        fasta = open(partial_path(newfasta), 'w')
+    stem = manifest_path.name[:-len(ManifestWriter.suffix)]
+    write_pairs = write_pairs or score_pairs
+    if write_pairs:
+        pairs_path = manifest_path.with_name(stem + '_pair_ids.txt')
+        outputs.append(pairs_path)
+        pairs_fh = open(partial_path(pairs_path), 'w')
+    if score_pairs:
+        scored_path = manifest_path.with_name(stem + '_pair_ids_scored.csv')
+        filtered_path = manifest_path.with_name(
+            stem + '_pair_ids_filtered.txt')
+        outputs.extend([scored_path, filtered_path])
+        scored_fh = open(partial_path(scored_path), 'w')
+        scored_fh.write('read_id,read_id_next,score\n')
+        filtered_fh = open(partial_path(filtered_path), 'w')
+        score_matrix = parasail.matrix_create("ACGT", 2, -1)
+    counter = defaultdict(int)
+    nbases = 0
+    if is_xam(fastx):
+        with pysam.AlignmentFile(str(fastx), check_sq=False) as infile:
+            header = infile.header
+        outfh = BamWriter(
+            partial_path(newfastx), header, threads=compression_threads)
+    else:
+        outfh = FastqWriter(
+            partial_path(newfastx), compression=compression,
+            threads=compression_threads,
+            level=compression_level)
+    reads = iterate_reads(fastx, threads=compression_threads)
+    with outfh, ManifestWriter(partial_path(manifest_path)) as manifest:
+        for read, status, hits in split_reads(
+                tqdm(reads, leave=False), targets, edit_threshold,
                 print_alignment=print_alignment,
-                print_threshold=edit_threshold + print_threshold_delta,
-                print_id=read_id,
+                print_threshold_delta=print_threshold_delta,
+                allow_multiple_splits=allow_multiple_splits,
                 trim_start=trim_start,
-                trim_end=trim_end)
-
-            if result['editDistance'] < edit_threshold:
-                result = deduplicate_locations_first_key(result)
-                if not allow_multiple_splits and len(result['locations']) > 1:
-                    outfh.write(f'@{read_id} {comments}\n{seq}\n+\n{qual}\n')
-                    split_multiple_times.add(read_id)
-                    nwritten += 1
-                    continue
-                else:
-                    hits = []
-                    edited_reads.add(read_id)
-                    for left_hit, right_hit in pairwise(
-                            [(0, 0), *result['locations'], (len(seq),
-                                                            len(seq))]):
-                        hits.append([left_hit[1], right_hit[0]])
-                    for idx, (start, end) in enumerate(hits, start=1):
-                        if debug_output:
-                            write_match_to_fasta(fasta,
-                                                 seq,
-                                                 start,
-                                                 end,
-                                                 read_id)
-                        # This edge case can happen and results in empty
-                        # sequence
-                        if end <= start:
-                            continue
-                        subseq = seq[start:end]
-                        subqual = qual[start:end]
-                        h = (f'@{read_id}_{idx} {comments} {start}->{end}\n'
-                             f'{subseq}\n'
-                             f'+\n'
-                             f'{subqual}\n')
-                        outfh.write(h)
-                        nwritten += 1
-            else:
-                outfh.write(f'@{read_id} {comments}\n{seq}\n+\n{qual}\n')
-                unedited_reads.add(read_id)
+                trim_end=trim_end):
+            read_id, seq = read[:2]
+            nbases += len(seq)
+            if status == 'not_split':
+                outfh.write(*read)
+                manifest.write(read_id, 'not_split')
+                counter['unedited'] += 1
+                continue
+            if status == 'split_multiple_times':
+                outfh.write(*read)
+                manifest.write(read_id, 'split_multiple_times')
+                counter['split_multiple_times'] += 1
+                counter['written'] += 1
+                continue
+            counter['edited'] += 1
+            if debug_output:
+                for start, end in hits:
+                    write_match_to_fasta(fasta, seq, start, end, read_id)
+            starts, ends = [], []
+            for part, start, end in split_parts(read, hits):
+                outfh.write(*part)
+                starts.append(start)
+                ends.append(end)
+                counter['written'] += 1
+            manifest.write(read_id, 'split', starts, ends)
+            if write_pairs and len(starts) == 2:
+                first, second = f'{read_id}_1', f'{read_id}_2'
+                pairs_fh.write(f'{first} {second}\n')
+                counter['pairs'] += 1
+                if score_pairs:
+                    # the end of the first part against the start of the
+                    # second, as in filter_pairs
+                    first_end = seq[max(
+                        starts[0], ends[0] - bases_to_align):ends[0]]
+                    second_start = seq[starts[1]:min(
+                        ends[1], starts[1] + bases_to_align)]
+                    with profiling.stage('score_pairs'):
+                        score = score_pair(
+                            first_end, reverse_complement(second_start),
+                            score_matrix)
+                    scored_fh.write(f'{first},{second},{score}\n')
+                    if score > align_threshold:
+                        filtered_fh.write(f'{first} {second}\n')
+                        counter['good_pairs'] += 1
     if debug_output:
         fasta.close()
-    return edited_reads, unedited_reads, split_multiple_times, nwritten
+    if write_pairs:
+        pairs_fh.close()
+    if score_pairs:
+        scored_fh.close()
+        filtered_fh.close()
+    for path in outputs:
+        os.replace(partial_path(path), path)
+    write_completion_marker(
+        marker, fastx, outputs, counter, output_options(
+            fastx, compression, debug_output, write_pairs, score_pairs))
+    profiling.add_counts({
+        'reads': (
+            counter['edited'] + counter['unedited']
+            + counter['split_multiple_times']),
+        'bases': nbases, **counter})
+    return counter
 
 
 def split(
@@ -204,11 +489,19 @@ def split(
         allow_multiple_splits=False,
         trim_start=200,
         trim_end=200,
+        compression='bgzf',
+        compression_threads=1,
+        compression_level=1,
+        resume=False,
+        write_pairs=False,
+        score_pairs=False,
+        bases_to_align=250,
+        align_threshold=0.6,
         ):
     """Split reads.
 
     :param fastq_dir: The directory from which to search for
-        fastq/fasta files to split.
+        fastq/fasta or uBAM files to split.
     :param output_dir: Output directory for fastq.
     :param type: The type of sample, either Native or PCR
     :param n_bases_to_mask_tail: Number of bases to mask from the
@@ -232,6 +525,23 @@ def split(
     :param trim_start: How many bases to trim (mask) from the
                        beginning of the strand
     :param trim_end: How many bases to trim (mask) from the end of the strand
+    :param compression: Compression of the output fastq, one of
+        bgzf, gzip, none or zstd. uBAM output is always BGZF compressed.
+    :param compression_threads: Number of threads used to compress each
+        output file and to decompress BGZF fastq or uBAM input.
+    :param compression_level: Compression level of the output.
+    :param resume: Continue a previous run into the same output directory,
+        skipping input files which were completed.
+    :param write_pairs: Write the ids of the two parts of reads split in
+        two as candidate pairs.
+    :param score_pairs: Score the candidate pairs by alignment, as done by
+        filter_pairs.
+    :param bases_to_align: Number of bases from each part to align.
+    :param align_threshold: Alignment score threshold (per-base) for
+        pairing decision.
+
+    :returns: dictionary of read counts over all files. To split reads in
+        memory, without writing files, use `split_reads`.
     """
     logger = duplex_tools.get_named_logger("SplitOnAdapters")
     logger.info(f'Duplex tools version: {duplex_tools.__version__}')
@@ -239,9 +549,10 @@ def split(
     if output_dir is not None:
         output = Path(output_dir)
         try:
-            output.mkdir()
+            output.mkdir(exist_ok=resume)
         except FileExistsError:
-            print("The output directory should not pre-exist.")
+            print("The output directory should not pre-exist "
+                  "(use --resume to continue a previous run).")
             sys.exit(1)
 
     targets = build_targets(
@@ -251,9 +562,6 @@ def split(
         n_replacement=n_replacement)[type]
     if edit_threshold is None:
         edit_threshold = EDIT_THRESHOLDS[type]
-    edited_reads = set()
-    unedited_reads = set()
-    split_multiple_times = set()
     worker = functools.partial(
         process_file,
         targets=targets, output_dir=output_dir,
@@ -264,34 +572,55 @@ def split(
         allow_multiple_splits=allow_multiple_splits,
         trim_start=trim_start,
         trim_end=trim_end,
+        compression=compression,
+        compression_threads=compression_threads,
+        compression_level=compression_level,
+        write_pairs=write_pairs,
+        score_pairs=score_pairs,
+        bases_to_align=bases_to_align,
+        align_threshold=align_threshold,
     )
 
-    with ProcessPoolExecutor(max_workers=threads) as executor:
+    counter = defaultdict(int)
+    if resume:
+        remaining = []
+        for fastx in fastxs:
+            _, _, marker = output_paths(fastx, output_dir, compression)
+            options = output_options(
+                fastx, compression, debug_output, write_pairs, score_pairs)
+            if is_complete(marker, fastx, options):
+                for key, value in counts_from_marker(marker).items():
+                    counter[key] += value
+            else:
+                remaining.append(fastx)
+        logger.info(
+            f'Resuming: {len(fastxs) - len(remaining)} of {len(fastxs)} '
+            f'files already completed')
+        fastxs = remaining
+
+    # each worker streams a file, so workers dominate memory use
+    nworkers = memory.within_budget(
+        threads or os.cpu_count(), memory.WORKER_BYTES, 0.5)
+    if memory.budget() is not None:
+        logger.info(f'Using {nworkers} workers within the memory budget')
+    with ProcessPoolExecutor(max_workers=nworkers) as executor:
         results = executor.map(worker, fastxs)
-        total_written = 0
-        for edited, unedited, multi, nwritten in results:
-            edited_reads.update(edited)
-            unedited_reads.update(unedited)
-            split_multiple_times.update(multi)
-            total_written += nwritten
-
-    with open(Path(output, 'edited.pkl'), 'wb') as handle:
-        pickle.dump(edited_reads, handle)
-    with open(Path(output, 'unedited.pkl'), 'wb') as handle:
-        pickle.dump(unedited_reads, handle)
-    if not allow_multiple_splits:
-        with open(Path(output, 'split_multiple_times.pkl'), 'wb') as handle:
-            pickle.dump(split_multiple_times, handle)
-    nedited_reads = len(edited_reads)
-    nunedited_reads = len(unedited_reads)
-    n_multisplit = len(split_multiple_times)
-    logger.info(f'Split {nedited_reads} reads\n'
-                f'Kept {nunedited_reads} reads')
-    logger.info(f'Wrote a total of {total_written} reads')
+        for file_counter in results:
+            for key, value in file_counter.items():
+                counter[key] += value
+
+    n_multisplit = counter['split_multiple_times']
+    logger.info(f'Split {counter["edited"]} reads\n'
+                f'Kept {counter["unedited"]} reads')
+    logger.info(f'Wrote a total of {counter["written"]} reads')
+    if write_pairs or score_pairs:
+        logger.info(f'Wrote {counter["pairs"]} pairs of split reads')
     if not allow_multiple_splits:
         logger.info(f'{n_multisplit} reads contained multiple'
                     f' adapters but we re written out as single reads '
                     f'(to split these, set --allow-multiple-splits')
+    memory.log_usage("Splitting reads")
+    return dict(counter)
 
 
 def argparser():
@@ -304,10 +633,12 @@ def argparser():
     default = ' (default: %(default)s)'
     parser.add_argument(
         "fastq_dir",
-        help="The directory to search for fastq/fasta files to split.")
+        help="The directory to search for fastq/fasta or uBAM files to "
+             "split. uBAM files (selected with --pattern '*.bam') are "
+             "written as uBAM.")
     parser.add_argument(
         "output_dir",
-        help="Output directory for fastq.")
+        help="Output directory for fastq/uBAM.")
     parser.add_argument(
         "sample_type", choices=["Native", "PCR"],
         help="Sample type.")
@@ -365,6 +696,40 @@ def argparser():
         "--trim_end", default=200, type=int,
         help="How many bases to trim (mask) "
              "from the end of the strand" + default)
+    parser.add_argument(
+        "--compression", default="bgzf", choices=COMPRESSION_CHOICES,
+        help="Compression of the output fastq. bgzf output is gzip "
+             "compatible and can be indexed, none is suitable for "
+             "piping, zstd requires the zstandard package." + default)
+    parser.add_argument(
+        "--compression_threads", default=1, type=int,
+        help="Number of threads used to compress each output "
+             "file and to decompress BGZF fastq or uBAM input." + default)
+    parser.add_argument(
+        "--compression_level", default=1, type=int,
+        help="Compression level of the output fastq." + default)
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Continue a previous run into the same output directory, "
+             "skipping input files which were completed.")
+    grp = parser.add_argument_group("pairing options")
+    grp.add_argument(
+        "--write_pairs", action="store_true",
+        help="Write the ids of the two parts of reads split in two, "
+             "which are candidate template/complement pairs, to "
+             "*_pair_ids.txt.")
+    grp.add_argument(
+        "--score_pairs", action="store_true",
+        help="Also score the pairs by aligning the end of the first "
+             "part to the start of the second, as filter_pairs does, "
+             "writing *_pair_ids_scored.csv and *_pair_ids_filtered.txt.")
+    grp.add_argument(
+        "--bases_to_align", default=250, type=int,
+        help="Number of bases from each part to align." + default)
+    grp.add_argument(
+        "--align_threshold", default=0.6, type=float,
+        help="Alignment score threshold (per-base) for pairing "
+             "decision." + default)
     return parser
 
 
@@ -387,4 +752,12 @@ def main(args):
         args.allow_multiple_splits,
         args.trim_start,
         args.trim_end,
+        args.compression,
+        args.compression_threads,
+        args.compression_level,
+        args.resume,
+        args.write_pairs,
+        args.score_pairs,
+        args.bases_to_align,
+        args.align_threshold,
         )
@@ -1,9 +1,11 @@
 """Split template/complement pairs which have come out as a single read."""
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 import os
+from pathlib import Path
 
 import duplex_tools
-from duplex_tools.split_pairs_steps import get_split_points, split_pod5
+from duplex_tools.split_pairs_steps import (
+    get_split_points, split_pairs_pipelined, split_pod5, write_split_bam)
 
 
 def split_pairs(
@@ -14,9 +16,16 @@ def split_pairs(
     max_reads: int = None,
     force_overwrite=False,
     debug_dir=None,
+    debug_n_reads=None,
+    debug_fraction=1.0,
     match_threshold=0.8,
     left_midpoint_threshold=0.45,
-    right_midpoint_threshold=0.55
+    right_midpoint_threshold=0.55,
+    prescreen=True,
+    pipeline=False,
+    split_locations_dir=None,
+    resume=False,
+    emit_bam=False,
 ):
     """Detect template/complement pairs which have come out as single reads.
 
@@ -29,34 +38,83 @@ def split_pairs(
     :param num_threads: The number of threads to use
     :param max_reads: Maximum number of reads to write out (for debug)
     :param force_overwrite: Whether to force overwrite of new pod5 files
+    :param debug_dir: Directory to write plots of raw signal to
+    :param debug_n_reads: Maximum number of reads to plot
+    :param debug_fraction: Fraction of reads to plot
+    :param prescreen: Only self-align reads passing a k-mer pre-screen
+    :param pipeline: Split pod5 files while split locations are still
+                     being detected
+    :param split_locations_dir: Directory to save split locations to
+    :param resume: Skip reads whose split locations are already saved
+    :param emit_bam: Also write uBAM records of the split reads, so they
+                     need not be basecalled again
     :return:
     """
     # First detect the locations where the reads should be split
     # The "split_locations" will be a dictionary like:
     # [{'read_id': {'left':(1,10), 'right': (20,30)}}]
     logger = duplex_tools.get_named_logger("SplitPairs")
-    logger.info('Find split locations.')
-    logger.info(f'Self-align reads from: {alignment_file}')
-    split_locations = get_split_points(
-        alignment_file,
-        num_threads,
-        max_reads=max_reads,
-        match_threshold=match_threshold,
-        left_midpoint_threshold=left_midpoint_threshold,
-        right_midpoint_threshold=right_midpoint_threshold
-    )
+    if resume and split_locations_dir is None:
+        raise ValueError("Resuming requires a split locations directory.")
+    if pipeline:
+        logger.info(f'Self-align reads from {alignment_file} while '
+                    f'splitting reads from {pod5_input_dir} into '
+                    f'{pod5_output_dir}')
+        split_locations = split_pairs_pipelined(
+            alignment_file,
+            pod5_input_dir,
+            pod5_output_dir,
+            num_threads,
+            max_reads=max_reads,
+            force_overwrite=force_overwrite,
+            debug_dir=debug_dir,
+            debug_n_reads=debug_n_reads,
+            debug_fraction=debug_fraction,
+            match_threshold=match_threshold,
+            left_midpoint_threshold=left_midpoint_threshold,
+            right_midpoint_threshold=right_midpoint_threshold,
+            prescreen=prescreen,
+            split_locations_dir=split_locations_dir,
+            resume=resume,
+            # the locations of all reads are only kept for the uBAM
+            keep_locations=emit_bam,
+        )
+    else:
+        logger.info('Find split locations.')
+        logger.info(f'Self-align reads from: {alignment_file}')
+        split_locations = get_split_points(
+            alignment_file,
+            num_threads,
+            max_reads=max_reads,
+            match_threshold=match_threshold,
+            left_midpoint_threshold=left_midpoint_threshold,
+            right_midpoint_threshold=right_midpoint_threshold,
+            prescreen=prescreen,
+            split_locations_dir=split_locations_dir,
+            resume=resume,
+        )
 
-    # Secondly, use the split locations to extract the reads into new pod5
-    # files
-    logger.info(f'Splitting {len(split_locations)} reads from: '
-                f'{pod5_input_dir} into {pod5_output_dir}')
-    _ = split_pod5(
-        pod5_input_dir,
-        split_locations,
-        pod5_output_dir,
-        force_overwrite=force_overwrite,
-        debug_dir=debug_dir
-    )
+        # Secondly, use the split locations to extract the reads into new
+        # pod5 files
+        logger.info(f'Splitting {len(split_locations)} reads from: '
+                    f'{pod5_input_dir} into {pod5_output_dir}')
+        _ = split_pod5(
+            pod5_input_dir,
+            split_locations,
+            pod5_output_dir,
+            force_overwrite=force_overwrite,
+            debug_dir=debug_dir,
+            threads=num_threads,
+            debug_n_reads=debug_n_reads,
+            debug_fraction=debug_fraction,
+        )
+
+    if emit_bam:
+        output_bam = Path(
+            pod5_output_dir, Path(alignment_file).stem + "_split_duplex.bam")
+        logger.info(f'Writing basecalls of split reads to {output_bam}')
+        write_split_bam(
+            alignment_file, split_locations, output_bam, num_threads)
 
 
 def argparser():
@@ -95,6 +153,18 @@ def argparser():
         default=None,
         help="Which directory to write plots of raw signal to",
     )
+    parser.add_argument(
+        "--debug_n_reads",
+        type=int,
+        default=None,
+        help="The maximum number of reads to plot into --debug_dir",
+    )
+    parser.add_argument(
+        "--debug_fraction",
+        type=float,
+        default=1.0,
+        help="The fraction of reads to plot into --debug_dir",
+    )
     parser.add_argument(
         "--match_threshold",
         type=float,
@@ -116,6 +186,44 @@ def argparser():
         help="Require this fraction of the template to align to the "
              "complement",
     )
+    parser.add_argument(
+        "--no_prescreen",
+        dest="prescreen",
+        action="store_false",
+        help="Self-align every read, instead of only those of 2 kb or more "
+             "passing a reverse-complement k-mer pre-screen. The pre-screen "
+             "saves self-aligning most reads which are not "
+             "template/complement pairs, at the cost of missing a small "
+             "fraction of pairs with more than 25%% error between template "
+             "and complement",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Split pod5 files as soon as all of their reads have been "
+             "self-aligned, rather than after all reads have been",
+    )
+    parser.add_argument(
+        "--split_locations",
+        dest="split_locations_dir",
+        default=None,
+        help="A directory to save split locations to, to resume the run "
+             "with --resume or to split pod5 files again with "
+             "`duplex_tools split_pod5`",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip reads whose split locations were saved to "
+             "--split_locations by a previous run",
+    )
+    parser.add_argument(
+        "--emit_bam",
+        action="store_true",
+        help="Also write the basecalls of the split reads, with moves, to "
+             "a uBAM in the output directory so they need not be "
+             "basecalled again",
+    )
     ncpu = os.cpu_count()
     if ncpu > 2:
         nthreads_default = ncpu-1
@@ -139,7 +247,14 @@ def main(args):
         max_reads=args.max_reads,
         force_overwrite=args.force_overwrite,
         debug_dir=args.debug_dir,
+        debug_n_reads=args.debug_n_reads,
+        debug_fraction=args.debug_fraction,
         match_threshold=args.match_threshold,
         left_midpoint_threshold=args.left_midpoint_threshold,
-        right_midpoint_threshold=args.right_midpoint_threshold
+        right_midpoint_threshold=args.right_midpoint_threshold,
+        prescreen=args.prescreen,
+        pipeline=args.pipeline,
+        split_locations_dir=args.split_locations_dir,
+        resume=args.resume,
+        emit_bam=args.emit_bam,
     )
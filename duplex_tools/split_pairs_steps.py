@@ -2,106 +2,726 @@
 
 1. One method for finding split points.
 2. One method for splitting raw data into new reads based on 1.
+3. One method running 1. and 2. concurrently.
 """
+import array
 from collections import defaultdict
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import dataclasses
 from functools import partial
+from itertools import islice
+import json
+import os
 from pathlib import Path
 import random
 import uuid
 
-from matplotlib import pyplot as plt
-from more_itertools import chunked
+from natsort import natsorted
+import numpy as np
 import pandas as pd
 import pod5 as p5
 from pod5 import EndReason, EndReasonEnum, Read, Reader
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pysam
 from tqdm import tqdm
 
 import duplex_tools
-from duplex_tools.split_pairs_utils import split
+from duplex_tools import memory, profiling
+from duplex_tools.reads import read_records
+from duplex_tools.split_on_adapter import split_read_tags
+from duplex_tools.split_pairs_utils import (
+    pack_reads, split_basecall, split_batch)
+from duplex_tools.writers import BamWriter
 
+UNKNOWN_END_REASON = EndReason(EndReasonEnum.UNKNOWN, False)
+# pod5.Read fields copied from a read to both of its halves, those of the
+# installed pod5 as newer versions add fields
+SHARED_READ_FIELDS = tuple(
+    field.name for field in dataclasses.fields(Read)
+    if field.name not in {'read_id', 'end_reason', 'signal'})
+# fields of the reads self-mapped, as packed by `pack_reads`: the moves,
+# trimmed samples and sample count (for the signal end)
+SPLIT_READ_FIELDS = ('read_id', 'seq', 'mv', 'ts', 'ns')
+# split locations of a read, the midpoint is in bases, the rest in samples
+SPLIT_LOCATIONS_SCHEMA = pa.schema([
+    ('read_id', pa.string()),
+    ('midpoint', pa.int64()),
+    ('left_start', pa.int64()),
+    ('left_end', pa.int64()),
+    ('right_start', pa.int64()),
+    ('right_end', pa.int64()),
+    ('match_fraction', pa.float64()),
+])
 
-def get_split_points(
+
+def split_locations_to_table(split_locations):
+    """Convert split locations to a `SPLIT_LOCATIONS_SCHEMA` table."""
+    rows = {name: [] for name in SPLIT_LOCATIONS_SCHEMA.names}
+    for read_id, at in split_locations.items():
+        rows['read_id'].append(read_id)
+        rows['midpoint'].append(int(at['midpoint']))
+        rows['left_start'].append(int(at['left'][0]))
+        rows['left_end'].append(int(at['left'][1]))
+        rows['right_start'].append(int(at['right'][0]))
+        rows['right_end'].append(int(at['right'][1]))
+        rows['match_fraction'].append(float(at['match_fraction']))
+    return pa.Table.from_pydict(rows, schema=SPLIT_LOCATIONS_SCHEMA)
+
+
+def split_locations_from_table(table, match_threshold=0.0):
+    """Convert a `SPLIT_LOCATIONS_SCHEMA` table to split locations.
+
+    :param table: The table to convert.
+    :param match_threshold: Drop reads with a lower match fraction.
+    """
+    return {
+        read_id: {
+            'left': (left_start, left_end),
+            'right': (right_start, right_end),
+            'midpoint': midpoint,
+            'match_fraction': match_fraction}
+        for (read_id, midpoint, left_start, left_end, right_start,
+             right_end, match_fraction)
+        in zip(*(table.column(name).to_pylist()
+                 for name in SPLIT_LOCATIONS_SCHEMA.names))
+        if match_fraction >= match_threshold}
+
+
+def chunk_path(split_locations_dir, chunk):
+    """Get the path of a chunk of the split locations table."""
+    return Path(split_locations_dir, f"chunk_{chunk:08d}.parquet")
+
+
+def write_split_chunk(split_locations_dir, chunk, split_locations):
+    """Write the split locations of a completed chunk of reads.
+
+    The file is renamed into place once complete, so that only completed
+    chunks are ever found.
+    """
+    path = chunk_path(split_locations_dir, chunk)
+    partial_path = path.with_name(path.name + '.partial')
+    pq.write_table(split_locations_to_table(split_locations), partial_path)
+    os.replace(partial_path, path)
+
+
+def read_split_chunks(split_locations_dir, match_threshold=0.0):
+    """Read the completed chunks of a split locations table.
+
+    :param split_locations_dir: The directory of the table.
+    :param match_threshold: Drop reads with a lower match fraction.
+    :return: A dictionary of chunk number to split locations.
+    """
+    return {
+        int(path.stem.split('_')[1]): split_locations_from_table(
+            pq.read_table(path), match_threshold)
+        for path in Path(split_locations_dir).glob('chunk_*.parquet')}
+
+
+def read_split_locations(split_locations_dir, match_threshold=0.0):
+    """Read all split locations of a split locations table.
+
+    :param split_locations_dir: The directory of the table.
+    :param match_threshold: Drop reads with a lower match fraction.
+    :return: A dictionary containing the split locations for each read.
+    """
+    split_locations = {}
+    for chunk in read_split_chunks(
+            split_locations_dir, match_threshold).values():
+        split_locations.update(chunk)
+    return split_locations
+
+
+def open_split_locations(split_locations_dir, parameters, resume=False):
+    """Create the directory of a split locations table.
+
+    :param split_locations_dir: The directory of the table.
+    :param parameters: The detection parameters, which must be the same
+                       when resuming.
+    :param resume: Whether to continue from an existing table.
+    """
+    split_locations_dir = Path(split_locations_dir)
+    split_locations_dir.mkdir(parents=True, exist_ok=resume)
+    metadata = split_locations_dir / 'parameters.json'
+    if metadata.exists():
+        with open(metadata) as fh:
+            previous = json.load(fh)
+        if previous != parameters:
+            raise ValueError(
+                f"Cannot resume {split_locations_dir}, it was created with "
+                f"different parameters: {previous}")
+    else:
+        with open(metadata, 'w') as fh:
+            json.dump(parameters, fh)
+
+
+def iter_split_points(
         input_dorado_xam,
         threads=-1,
         max_reads: int = None,
         chunk_size=5000,
         match_threshold=0.8,
         left_midpoint_threshold=0.45,
-        right_midpoint_threshold=0.55
-) -> dict:
+        right_midpoint_threshold=0.55,
+        batch_size=64,
+        batch_seconds=0.5,
+        prescreen=True,
+        split_locations_dir=None,
+        resume=False,
+):
     """Detect locations where reads in the Dorado SAM/BAM file should be split.
 
+    Reads are sent to the workers in compact batches while further reads
+    are being read, with at most two batches per worker in flight. The
+    batch size is adapted so that a batch takes around `batch_seconds` to
+    process. No further batches are submitted while the caller is busy
+    with a result. With a memory budget, the number of workers and the
+    size of the batches in flight are limited to fit it.
+
+    With `split_locations_dir`, the split locations of each chunk of
+    `chunk_size` reads are written to a parquet table once the chunk has
+    been processed, regardless of `match_threshold` so that the table can
+    be re-split at other thresholds. With `resume`, the reads of chunks
+    already in the table are not processed again.
+
     :param left_midpoint_threshold: Require the midpoint to be -> of here.
     :param right_midpoint_threshold: Require the midpoint to be <- of here.
     :param match_threshold: Require at least this fraction of the template
            to match the complement
     :param input_dorado_xam: The path to the input Dorado SAM/BAM file.
-    :param threads: The number of threads to use.
+    :param threads: The number of threads to use (all CPUs if < 1).
     :param max_reads: The maximum number of reads to process.
-    :param chunk_size: The number of reads to process in one batch
-                       (use lower value for more frequent logging)
-    :return: A dictionary containing the split locations for each read.
+    :param chunk_size: The number of reads processed between progress
+                       messages and in each chunk of the table.
+    :param batch_size: The initial number of reads in a batch.
+    :param batch_seconds: The target processing time of a batch.
+    :param prescreen: Only self-map reads passing a k-mer pre-screen.
+    :param split_locations_dir: A directory to write split locations to.
+    :param resume: Whether to skip reads already in `split_locations_dir`.
+    :return: An iterator of (read IDs of a batch, dictionary containing the
+             split locations of the reads in the batch which should be
+             split), in order of completion.
     """
     logger = duplex_tools.get_named_logger("SplitPairs")
+    if threads is None or threads < 1:
+        threads = os.cpu_count()
+    nworkers = memory.within_budget(threads, memory.WORKER_BYTES, 0.5)
+    if nworkers < threads:
+        logger.info(
+            f"Using {nworkers} of {threads} workers within the memory budget")
+        threads = nworkers
 
-    splitter = partial(split,
-                       match_threshold=match_threshold,
+    done_chunks = {}
+    if split_locations_dir is not None:
+        open_split_locations(
+            split_locations_dir,
+            {'chunk_size': chunk_size,
+             'left_midpoint_threshold': left_midpoint_threshold,
+             'right_midpoint_threshold': right_midpoint_threshold,
+             'prescreen': prescreen},
+            resume=resume)
+        done_chunks = read_split_chunks(split_locations_dir, match_threshold)
+        if done_chunks:
+            logger.info(
+                f"Resuming: {len(done_chunks)} chunks of {chunk_size} reads "
+                "already processed")
+
+    splitter = partial(split_batch,
+                       match_threshold=(
+                           match_threshold if split_locations_dir is None
+                           else 0.0),
                        left_midpoint_threshold=left_midpoint_threshold,
-                       right_midpoint_threshold=right_midpoint_threshold
+                       right_midpoint_threshold=right_midpoint_threshold,
+                       prescreen=prescreen,
                        )
-    split_locations = {}
-    finished = False
     counter = defaultdict(int)
-    with ProcessPoolExecutor(threads) as pool:
-        with pysam.AlignmentFile(input_dorado_xam, check_sq=False) as f:
-            it = f.fetch(until_eof=True)
-            iterator = chunked(it, chunk_size)
+    next_log = chunk_size
+    max_in_flight = 2 * threads
+    # number of batches in flight and split locations of unwritten chunks
+    chunk_batches = defaultdict(int)
+    chunk_locations = defaultdict(dict)
+
+    def report(read_ids, locations):
+        nonlocal next_log
+        counter['split'] += len(locations)
+        counter['assessed'] += len(read_ids)
+        if counter['assessed'] >= next_log:
+            next_log += chunk_size
+            assessed = counter['assessed']
+            nsplit = counter['split']
+            logger.info(
+                "Split/Processed reads:"
+                f"{nsplit:.0f}/{assessed:.0f}"
+                f" ({100 * nsplit / assessed:.2f}%)")
+
+    def collect(futures, complete_chunks):
+        nonlocal batch_size
+        for future in futures:
+            locations, nreads, seconds = future.result()
+            chunk, read_ids = in_flight.pop(future)
+            counter['seconds'] += seconds
+            counter['mapped'] += nreads
+            if split_locations_dir is not None:
+                chunk_locations[chunk].update(locations)
+                chunk_batches[chunk] -= 1
+                if chunk_batches[chunk] == 0 and chunk < complete_chunks:
+                    write_split_chunk(
+                        split_locations_dir, chunk,
+                        chunk_locations.pop(chunk))
+                    del chunk_batches[chunk]
+                locations = {
+                    read_id: at for read_id, at in locations.items()
+                    if at['match_fraction'] >= match_threshold}
+            report(read_ids, locations)
+            yield read_ids, locations
+        seconds_per_read = counter['seconds'] / max(counter['mapped'], 1)
+        if seconds_per_read > 0:
+            batch_size = int(min(
+                max(batch_seconds / seconds_per_read, 16), 10000))
+        # a batch in flight is held both here and by a worker
+        bytes_per_read = counter['bytes'] / max(counter['submitted'], 1)
+        batch_size = memory.within_budget(
+            batch_size, 2 * max_in_flight * bytes_per_read, 0.25, minimum=16)
 
-            for idx, chunk in enumerate(iterator):
-                if finished:
+    # future -> (chunk, read IDs of its batch)
+    in_flight = {}
+    nread = 0
+    eof = False
+    with ProcessPoolExecutor(threads) as pool:
+        it = read_records(input_dorado_xam, SPLIT_READ_FIELDS)
+        try:
+            while max_reads is None or counter['split'] <= max_reads:
+                chunk = nread // chunk_size
+                if chunk in done_chunks:
+                    read_ids = [read[0] for read in islice(it, chunk_size)]
+                    nread += len(read_ids)
+                    locations = done_chunks.pop(chunk)
+                    report(read_ids, locations)
+                    yield read_ids, locations
+                    continue
+                # batches do not span chunks
+                nbatch = min(batch_size, (chunk + 1) * chunk_size - nread)
+                reads = list(islice(it, nbatch))
+                if not reads:
+                    eof = True
                     break
-                futures = []
-
-                for read in chunk:
-                    seq = read.query_sequence
-                    elem = (
-                        read.qname,
-                        seq,
-                        read.get_tag("mv"),
-                        read.get_tag("ts"),
-                        read.get_tag("ns"),  # Sample count (For signal end)
-                    )
-                    future = pool.submit(splitter, elem)
-                    futures.append(future)
-
-                counter['assessed'] += len(futures)
-                for f in as_completed(futures):
-                    if f.result() is not None:
-                        split_locations.update(f.result())
-
-                counter['tosplit'] = len(split_locations.keys())
-
-                if max_reads is not None and len(split_locations.keys()) > \
-                        max_reads:
-                    finished = True
-                assessed = counter['assessed']
-                nsplit = counter['tosplit']
-                logger.info(
-                    "Split/Processed reads:"
-                    f"{nsplit:.0f}/{assessed:.0f}"
-                    f" ({100 * nsplit / assessed:.2f}%)")
+                nread += len(reads)
+                batch = pack_reads(reads)
+                counter['bytes'] += len(batch[1]) + len(batch[3])
+                counter['submitted'] += len(reads)
+                future = pool.submit(splitter, batch)
+                in_flight[future] = (chunk, [read[0] for read in reads])
+                chunk_batches[chunk] += 1
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    yield from collect(done, nread // chunk_size)
+        finally:
+            it.close()
+        # the last, partial, chunk is only complete at the end of the file
+        complete_chunks = (
+            -(-nread // chunk_size) if eof else nread // chunk_size)
+        done, _ = wait(in_flight)
+        yield from collect(done, complete_chunks)
+        for chunk, nbatches in chunk_batches.items():
+            if split_locations_dir is not None and nbatches == 0 \
+                    and chunk < complete_chunks:
+                write_split_chunk(
+                    split_locations_dir, chunk, chunk_locations.pop(chunk))
+    assessed = counter['assessed']
+    nsplit = counter['split']
+    logger.info(
+        "Split/Processed reads:"
+        f"{nsplit:.0f}/{assessed:.0f}"
+        f" ({100 * nsplit / max(assessed, 1):.2f}%)")
+    profiling.add_counts({'assessed': assessed, 'split': nsplit})
+    memory.log_usage("Finding breakpoints")
     logger.info("Finished finding breakpoints.")
+
+
+def get_split_points(input_dorado_xam, threads=-1, **kwargs) -> dict:
+    """Detect locations where reads in the Dorado SAM/BAM file should be split.
+
+    :param input_dorado_xam: The path to the input Dorado SAM/BAM file.
+    :param threads: The number of threads to use (all CPUs if < 1).
+    :param kwargs: Passed to `iter_split_points`.
+    :return: A dictionary containing the split locations for each read.
+    """
+    split_locations = {}
+    for _, locations in iter_split_points(
+            input_dorado_xam, threads, **kwargs):
+        split_locations.update(locations)
     return split_locations
 
 
+def pod5_read_ids(pod5):
+    """Read the ids of all reads in a pod5 file from its read table."""
+    with Reader(pod5) as reader:
+        return reader.read_ids
+
+
+@profiling.staged('index_pod5')
+def index_pod5_reads(pod5_files, read_ids, threads=1):
+    """Find which pod5 files hold the given reads.
+
+    Only the read tables of the files are read, in parallel.
+
+    :param pod5_files: The pod5 files to search.
+    :param read_ids: The read ids to look for, all reads if None.
+    :param threads: The number of processes to use.
+    :return: A dictionary of pod5 file to the list of read ids it holds,
+             files holding none of the reads are absent.
+    """
+    wanted = None if read_ids is None else set(read_ids)
+    index = defaultdict(list)
+    chunksize = max(1, len(pod5_files) // (4 * threads))
+    with ProcessPoolExecutor(threads) as pool:
+        for pod5, file_read_ids in zip(
+                pod5_files,
+                pool.map(pod5_read_ids, pod5_files, chunksize=chunksize)):
+            if wanted is None:
+                if file_read_ids:
+                    index[pod5] = file_read_ids
+                continue
+            for read_id in file_read_ids:
+                if read_id in wanted:
+                    index[pod5].append(read_id)
+    return dict(index)
+
+
+def split_read_ids(read_id):
+    """Generate the read IDs of the halves of a split read.
+
+    The IDs are derived from the read ID, so are the same every time.
+
+    :param read_id: The read ID, as a string or UUID.
+    :return: A tuple of the left and right read UUIDs.
+    """
+    rd = random.Random()
+    # seeding with a UUID hashes it, which newer Pythons refuse
+    rd.seed(hash(uuid.UUID(str(read_id))))
+    id_left = uuid.UUID(int=rd.getrandbits(128), version=4)
+    id_right = uuid.UUID(int=rd.getrandbits(128), version=4)
+    return id_left, id_right
+
+
+@profiling.staged('write_bam')
+def write_split_bam(input_dorado_xam, split_locations, output_bam, threads=1):
+    """Write uBAM records for the halves of split reads.
+
+    The halves get the read IDs of the split pod5 reads, with their
+    sequence, qualities and moves sliced so that they can be paired and
+    duplex called without basecalling them again.
+
+    :param input_dorado_xam: The path to the input Dorado SAM/BAM file.
+    :param split_locations: A dictionary of read IDs and their corresponding
+                            split locations.
+    :param output_bam: The uBAM file to write.
+    :param threads: The number of compression threads.
+    :return: The number of reads split.
+    """
+    nsplit = 0
+    with pysam.AlignmentFile(input_dorado_xam, check_sq=False) as bam, \
+            BamWriter(output_bam, bam.header, threads) as writer:
+        for read in bam.fetch(until_eof=True):
+            at = split_locations.get(read.query_name)
+            if at is None:
+                continue
+            tags = read.get_tags(with_value_type=True)
+            du = read.get_tag('du') if read.has_tag('du') else None
+            halves = split_basecall(
+                read.query_sequence,
+                pysam.qualities_to_qualitystring(read.query_qualities),
+                read.get_tag('mv'), read.get_tag('ts'), read.get_tag('ns'),
+                at)
+            for read_id, (seq, qual, mv, ts, ns, sp) in zip(
+                    split_read_ids(read.query_name), halves):
+                new_tags = [
+                    (tag, value, value_type) for tag, value, value_type
+                    in split_read_tags(tags, read.query_name, qual)
+                    if tag != 'du']
+                new_tags.extend([
+                    ('mv', array.array('b', mv.tobytes()), 'B'),
+                    ('ts', ts, 'i'), ('ns', ns, 'i'), ('sp', sp, 'i')])
+                if du is not None:
+                    new_tags.append(
+                        ('du', du * ns / read.get_tag('ns'), 'f'))
+                writer.write(str(read_id), seq, qual, tags=new_tags)
+            nsplit += 1
+    return nsplit
+
+
+def split_read_fields(read):
+    """Get the metadata shared by the halves of a split read.
+
+    :param read: A `pod5.ReadRecord`.
+    :return: A dictionary of `pod5.Read` fields, without the read id, end
+             reason and signal.
+    """
+    return {
+        name: getattr(read, name) for name in SHARED_READ_FIELDS}
+
+
+def signal_envelope(signal, width=2000):
+    """Decimate a signal to its minimum and maximum in `width` bins.
+
+    :param signal: The signal to decimate.
+    :param width: The maximum number of bins.
+    :return: A tuple of the bin start positions and the minimum and
+             maximum of each bin.
+    """
+    if len(signal) == 0:
+        return signal, signal, signal
+    nbins = min(width, len(signal))
+    starts = np.linspace(0, len(signal), nbins, endpoint=False).astype(int)
+    return (
+        starts,
+        np.minimum.reduceat(signal, starts),
+        np.maximum.reduceat(signal, starts))
+
+
+@profiling.staged('plot')
+def plot_split_read(path, envelopes, split_at):
+    """Plot the signal envelopes of a split read and its two halves.
+
+    :param path: The image file to write.
+    :param envelopes: The envelopes of the read, the template and the
+                      complement, see `signal_envelope`.
+    :param split_at: The signal position of the split, marked on the read.
+    """
+    # matplotlib is slow to import and only needed for debug plots
+    from matplotlib import pyplot as plt
+
+    _, axes = plt.subplots(3, 1, figsize=(23, 6))
+    for idx, ((starts, mins, maxs), ax) in enumerate(zip(envelopes, axes)):
+        ax.fill_between(starts, mins, maxs, linewidth=0.05)
+        if idx == 0:
+            ax.axvline(split_at, linewidth=0.2, color='red')
+    plt.savefig(path)
+    plt.close()
+
+
+def sample_debug_reads(read_ids, n_reads=None, fraction=1.0, seed=0):
+    """Choose the reads to plot for debugging.
+
+    :param read_ids: The ids of the reads being split.
+    :param n_reads: The maximum number of reads to choose.
+    :param fraction: The fraction of reads to choose.
+    :param seed: The random seed.
+    :return: A set of read ids.
+    """
+    read_ids = sorted(read_ids)
+    n = round(fraction * len(read_ids))
+    if n_reads is not None:
+        n = min(n, n_reads)
+    return set(random.Random(seed).sample(read_ids, n))
+
+
+@profiling.staged('pod5_write')
+def split_pod5_file(
+        pod5, split_locations, new_pod5_dir, force_overwrite=False,
+        debug_read_ids=(), batch_samples=2_000_000
+):
+    """Split the reads of a single pod5 file into a new pod5 file.
+
+    The signal of each read is decoded once, the two halves are views
+    into it. New reads are written in batches, holding at most around
+    `batch_samples` samples of decoded signal.
+
+    :param pod5: The pod5 file containing the reads to split.
+    :param split_locations: A dictionary of read IDs in `pod5` and their
+                            corresponding split locations.
+    :param new_pod5_dir: The directory where the split pod5 file will be saved.
+    :param force_overwrite: If True, an existing output file will be
+                            overwritten.
+    :param debug_read_ids: The reads to return signal envelopes of.
+    :param batch_samples: The number of signal samples to buffer before
+                          writing.
+    :return: A tuple of the number of reads split and a list of
+             (read ID, envelopes, split position) for `debug_read_ids`.
+    """
+    read_ids = []
+    debug = []
+    output_stem = Path(pod5).stem + "_split_duplex"
+    p5_file = f"{str(new_pod5_dir)}/{output_stem}.pod5"
+    if force_overwrite:
+        Path(p5_file).unlink(missing_ok=True)
+    with p5.Writer(p5_file) as writer, Reader(pod5) as reader:
+        batch = []
+        nsamples = total_samples = 0
+        for read in reader.reads(selection=list(split_locations),
+                                 missing_ok=True):
+            id_left, id_right = split_read_ids(read.read_id)
+            read_id_map = {
+                "read_id": read.read_id,
+                "read_id_left": id_left,
+                "read_id_right": id_right,
+            }
+            read_ids.append(read_id_map)
+
+            at = split_locations[str(read.read_id)]
+
+            signal = read.signal
+            signal_left = signal[at["left"][0]: at["left"][1]]
+            signal_right = signal[at["right"][0]: at["right"][1]]
+            fields = split_read_fields(read)
+            batch.append(Read(
+                read_id=id_left, end_reason=UNKNOWN_END_REASON,
+                signal=signal_left, **fields))
+            batch.append(Read(
+                read_id=id_right, end_reason=UNKNOWN_END_REASON,
+                signal=signal_right, **fields))
+            # the views keep the whole decoded signal alive
+            nsamples += len(signal)
+            total_samples += len(signal)
+            if nsamples >= batch_samples:
+                writer.add_reads(batch)
+                batch = []
+                nsamples = 0
+            if str(read.read_id) in debug_read_ids:
+                debug.append((
+                    str(read.read_id),
+                    [signal_envelope(x)
+                     for x in (signal, signal_left, signal_right)],
+                    at["left"][1]))
+        writer.add_reads(batch)
+
+        df = pd.DataFrame(
+            read_ids, columns=["read_id", "read_id_left", "read_id_right"])
+        df.to_csv(
+            f"{new_pod5_dir}/{output_stem}.txt", sep="\t", index=False
+        )
+        df[["read_id_left", "read_id_right"]].to_csv(
+            f"{new_pod5_dir}/{output_stem}_pair_ids.txt",
+            sep=" ",
+            index=False,
+        )
+    profiling.add_counts({'signal_samples': total_samples})
+    return len(read_ids), debug
+
+
+class Pod5Splitter:
+    """Split pod5 files in a process pool as their split locations arrive.
+
+    At most `max_in_flight` files are split at once, `submit` waits for
+    one to finish beyond that. Debug plots are drawn from decimated signal
+    by a separate pool. With a memory budget, the number of processes and
+    the signal each buffers before writing are limited to fit it.
+    """
+
+    def __init__(
+            self, new_pod5_dir, threads=1, force_overwrite=False,
+            debug_dir=None, debug_n_reads=None, debug_fraction=1.0,
+            max_in_flight=None, total=None):
+        """Initialize the splitter.
+
+        :param new_pod5_dir: The directory where the split pod5 files will
+                             be saved.
+        :param threads: The number of processes to use.
+        :param force_overwrite: If True, any existing files in
+                                `new_pod5_dir` will be overwritten.
+        :param debug_dir: A directory in which to write plots of raw signal
+        :param debug_n_reads: The maximum number of reads to plot.
+        :param debug_fraction: The fraction of reads of each file to plot.
+        :param max_in_flight: The number of files split at once, twice the
+                              number of processes by default.
+        :param total: The number of files expected, for progress display.
+        """
+        self.new_pod5_dir = new_pod5_dir
+        self.force_overwrite = force_overwrite
+        self.debug_dir = debug_dir
+        self.debug_n_reads = debug_n_reads
+        self.debug_fraction = debug_fraction
+        threads = memory.within_budget(threads, memory.WORKER_BYTES, 0.5)
+        self.max_in_flight = max_in_flight or 2 * threads
+        # int16 samples, decoded and copied into the written reads
+        self.batch_samples = memory.within_budget(
+            2_000_000, 4 * threads, 0.25, minimum=100_000)
+        Path(new_pod5_dir).mkdir(exist_ok=True, parents=True)
+        if debug_dir is not None:
+            Path(debug_dir).mkdir(exist_ok=True, parents=True)
+        self.pool = ProcessPoolExecutor(threads)
+        self.plot_pool = ProcessPoolExecutor(max(1, threads // 4))
+        self.in_flight = {}
+        self.plots = []
+        self.nplots = 0
+        self.npairs = 0
+        self.progress = tqdm(total=total)
+        self.logger = duplex_tools.get_named_logger("SplitPairs")
+
+    def submit(self, pod5, split_locations):
+        """Split the given reads of a pod5 file.
+
+        :param pod5: The pod5 file containing the reads to split.
+        :param split_locations: A dictionary of read IDs in `pod5` and
+                                their corresponding split locations.
+        """
+        while len(self.in_flight) >= self.max_in_flight:
+            done, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        debug_read_ids = set()
+        if self.debug_dir is not None:
+            n_reads = None
+            if self.debug_n_reads is not None:
+                n_reads = self.debug_n_reads - self.nplots
+            debug_read_ids = sample_debug_reads(
+                split_locations, n_reads, self.debug_fraction)
+        future = self.pool.submit(
+            split_pod5_file, pod5, split_locations, self.new_pod5_dir,
+            force_overwrite=self.force_overwrite,
+            debug_read_ids=debug_read_ids, batch_samples=self.batch_samples)
+        self.in_flight[future] = pod5
+        self.nplots += len(debug_read_ids)
+
+    def _collect(self, futures):
+        for future in futures:
+            pod5 = self.in_flight.pop(future)
+            self.logger.debug(f"Split {pod5}")
+            nsplit, debug = future.result()
+            self.npairs += nsplit
+            for read_id, envelopes, split_at in debug:
+                self.plots.append(self.plot_pool.submit(
+                    plot_split_read, f'{self.debug_dir}/{read_id}.png',
+                    envelopes, split_at))
+            self.progress.update()
+
+    def close(self):
+        """Wait for all files to be split and plots to be drawn.
+
+        :return: The number of reads split.
+        """
+        done, _ = wait(self.in_flight)
+        self._collect(done)
+        for plot in self.plots:
+            plot.result()
+        self.pool.shutdown()
+        self.plot_pool.shutdown()
+        self.progress.close()
+        if self.npairs:
+            self.logger.info(f"Created {self.npairs} new pairs")
+        else:
+            self.logger.info("No pairs created")
+        profiling.add_counts({'pairs': self.npairs})
+        memory.log_usage("Splitting pod5 files")
+        return self.npairs
+
+    def __enter__(self):
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args):
+        """Exit context, waiting for all work to finish."""
+        self.close()
+
+
 def split_pod5(
         input_pod5_dir, split_locations, new_pod5_dir, force_overwrite=False,
-        debug_dir=None
+        debug_dir=None, threads=1, debug_n_reads=None, debug_fraction=1.0
 ):
     """Split a pod5 given pre-determined locations to split them.
 
+    An index of which pod5 files hold the reads to split is built first,
+    so that only those files are processed, each by a separate worker.
+
     :param debug_dir: A directory in which to write plots of raw signal
     :param input_pod5_dir: The directory containing the pod5 file(s) to be
                            split.
@@ -110,84 +730,174 @@ def split_pod5(
     :param new_pod5_dir: The directory where the split pod5 file will be saved.
     :param force_overwrite: If True, any existing files in `new_pod5_dir` will
                             be overwritten.
+    :param threads: The number of processes to use (all CPUs if < 1).
+    :param debug_n_reads: The maximum number of reads to plot.
+    :param debug_fraction: The fraction of reads to plot.
     :return: None
 
     """
     logger = duplex_tools.get_named_logger("SplitPairs")
+    if threads is None or threads < 1:
+        threads = os.cpu_count()
+
+    pod5_files = natsorted(Path(input_pod5_dir).rglob("*.pod5"))
+    logger.info(f"Indexing reads of {len(pod5_files)} pod5 files")
+    index = index_pod5_reads(pod5_files, split_locations, threads)
+    nfound = sum(len(x) for x in index.values())
+    if nfound < len(split_locations):
+        logger.warning(
+            f"{len(split_locations) - nfound} reads to split were not "
+            "found in the pod5 files")
+    logger.info(
+        f"Splitting {nfound} reads from {len(index)} of "
+        f"{len(pod5_files)} pod5 files")
+
+    with Pod5Splitter(
+            new_pod5_dir, threads, force_overwrite=force_overwrite,
+            debug_dir=debug_dir, debug_n_reads=debug_n_reads,
+            debug_fraction=debug_fraction, total=len(index)) as splitter:
+        for pod5, read_ids in index.items():
+            splitter.submit(
+                pod5,
+                {read_id: split_locations[read_id] for read_id in read_ids})
+
+
+class Pod5ReadIndex:
+    """Compact index of the pod5 file holding each read.
+
+    The read ids are held as a sorted array of fixed-width bytes along
+    with the index of their file, a few tens of bytes per read rather than
+    the hundreds of a dictionary of strings.
+    """
+
+    def __init__(self, pod5_files, threads=1):
+        """Index the read tables of pod5 files, in parallel.
+
+        :param pod5_files: The pod5 files to index.
+        :param threads: The number of processes to use.
+        """
+        self.pod5_files = list(pod5_files)
+        read_ids, files = [], []
+        chunksize = max(1, len(self.pod5_files) // (4 * threads))
+        with ProcessPoolExecutor(threads) as pool:
+            for i, file_read_ids in enumerate(pool.map(
+                    pod5_read_ids, self.pod5_files, chunksize=chunksize)):
+                read_ids.append(np.array(file_read_ids, dtype='S'))
+                files.append(np.full(len(file_read_ids), i, dtype=np.int32))
+        read_ids = np.concatenate(read_ids or [np.zeros(0, dtype='S1')])
+        files = np.concatenate(files or [np.zeros(0, dtype=np.int32)])
+        order = np.argsort(read_ids, kind='stable')
+        self.read_ids = read_ids[order]
+        self.files = files[order]
+        # reads of each file
+        self.counts = np.bincount(self.files, minlength=len(self.pod5_files))
+
+    def __len__(self):
+        """Return the number of reads indexed."""
+        return len(self.read_ids)
+
+    @property
+    def nbytes(self):
+        """Return the memory used by the index."""
+        return self.read_ids.nbytes + self.files.nbytes
+
+    def lookup(self, read_ids):
+        """Find the files holding reads.
+
+        :param read_ids: The read ids to look up.
+        :return: An array of the index in `pod5_files` of the file holding
+                 each read, -1 for reads in none of the files.
+        """
+        query = np.array(list(read_ids), dtype='S')
+        if len(query) == 0 or len(self.read_ids) == 0:
+            return np.full(len(query), -1, dtype=np.int32)
+        at = np.minimum(
+            np.searchsorted(self.read_ids, query), len(self.read_ids) - 1)
+        return np.where(self.read_ids[at] == query, self.files[at], -1)
+
+
+def split_pairs_pipelined(
+        input_dorado_xam, input_pod5_dir, new_pod5_dir, threads=-1,
+        pod5_threads=None, force_overwrite=False, debug_dir=None,
+        debug_n_reads=None, debug_fraction=1.0, keep_locations=False,
+        **kwargs
+):
+    """Detect split locations and split pod5 files concurrently.
+
+    The read tables of all pod5 files are indexed first, into a compact
+    `Pod5ReadIndex` whose size is taken out of the memory budget. As
+    batches of reads are assessed, the files holding them are looked up
+    and the reads of each file still to be assessed are counted down. A
+    file is split as soon as all of its reads have been assessed, after
+    which its split locations are dropped. Files with reads missing from
+    the alignment file are split at the end. Detection pauses while the
+    maximum number of files are being split.
+
+    :param input_dorado_xam: The path to the input Dorado SAM/BAM file.
+    :param input_pod5_dir: The directory containing the pod5 file(s) to be
+                           split.
+    :param new_pod5_dir: The directory where the split pod5 file will be saved.
+    :param threads: The number of processes detecting split locations
+                    (all CPUs if < 1).
+    :param pod5_threads: The number of processes splitting pod5 files,
+                         half of `threads` by default.
+    :param force_overwrite: If True, any existing files in `new_pod5_dir` will
+                            be overwritten.
+    :param debug_dir: A directory in which to write plots of raw signal
+    :param debug_n_reads: The maximum number of reads to plot.
+    :param debug_fraction: The fraction of reads to plot.
+    :param keep_locations: Keep the split locations of all reads and return
+                           them, for example to write them to a uBAM.
+    :param kwargs: Passed to `iter_split_points`.
+    :return: The number of reads to split, or with `keep_locations` a
+             dictionary containing the split locations for each read.
+    """
+    logger = duplex_tools.get_named_logger("SplitPairs")
+    if threads is None or threads < 1:
+        threads = os.cpu_count()
+    if pod5_threads is None:
+        pod5_threads = max(1, threads // 2)
+
+    pod5_files = natsorted(Path(input_pod5_dir).rglob("*.pod5"))
+    logger.info(f"Indexing reads of {len(pod5_files)} pod5 files")
+    with profiling.stage('index_pod5'):
+        index = Pod5ReadIndex(pod5_files, threads)
+    logger.info(
+        f"Indexed {len(index)} reads in {memory.format_size(index.nbytes)}")
+    memory.log_usage("Indexing pod5 files")
+    remaining = index.counts.copy()
 
-    Path(new_pod5_dir).mkdir(exist_ok=True, parents=True)
-
-    ids = list(split_locations.keys())
-    if debug_dir is not None:
-        Path(debug_dir).mkdir(exist_ok=True, parents=True)
-
-    pod5_dir_input = input_pod5_dir
-    for pod5 in Path(pod5_dir_input).rglob("*.pod5"):
-        read_ids = []
-        logger.info(f"Splitting {pod5}")
-        output_stem = pod5.stem + "_split_duplex"
-        p5_file = f"{str(new_pod5_dir)}/{output_stem}.pod5"
-        if force_overwrite:
-            Path(p5_file).unlink(missing_ok=True)
-        with p5.Writer(p5_file) as writer:
-            for read in tqdm(Reader(pod5).reads(selection=ids,
-                                                missing_ok=True)):
-                read_obj = read.to_read()
-                data = vars(read_obj)
-                rd = random.Random()
-                rd.seed(read.read_id)
-                id_left = uuid.UUID(int=rd.getrandbits(128), version=4)
-                id_right = uuid.UUID(int=rd.getrandbits(128), version=4)
-                read_id_map = {
-                    "read_id": read.read_id,
-                    "read_id_left": id_left,
-                    "read_id_right": id_right,
-                }
-                read_ids.append(read_id_map)
-
-                at = split_locations[str(read.read_id)]
-
-                # Grab the data for the template read
-                signal_orig = read.signal
-                signal_left = data["signal"][at["left"][0]: at["left"][1]]
-                signal_right = data["signal"][at["right"][0]: at["right"][1]]
-                data["signal"] = signal_left
-                data["read_id"] = read_id_map["read_id_left"]
-                data["end_reason"] = EndReason(EndReasonEnum.UNKNOWN, False)
-                left = Read(**data)
-
-                # Grab the data for the complement read
-                data["signal"] = signal_right
-                data["read_id"] = read_id_map["read_id_right"]
-                data["end_reason"] = EndReason(EndReasonEnum.UNKNOWN, False)
-                right = Read(**data)
-
-                # Write the read objects
-                writer.add_read(left)
-                writer.add_read(right)
-                if debug_dir is not None:
-                    _, axes = plt.subplots(3, 1, figsize=(23, 6))
-                    for idx, (data, ax) in enumerate(zip([signal_orig,
-                                                          signal_left,
-                                                          signal_right],
-                                                         axes)):
-                        ax.plot(data, linewidth=0.05)
-                        if idx == 0:
-                            ax.axvline(at["left"][1], linewidth=0.2,
-                                       color='red')
-                    plt.savefig(f'{debug_dir}/{read.read_id}.png')
-                    plt.close()
-
-            df = pd.DataFrame(read_ids)
-            df.to_csv(
-                f"{new_pod5_dir}/{output_stem}.txt", sep="\t", index=False
-            )
-            try:
-                df[["read_id_left", "read_id_right"]].to_csv(
-                    f"{new_pod5_dir}/{output_stem}_pair_ids.txt",
-                    sep=" ",
-                    index=False,
-                )
-                logger.info(f"Created {len(read_ids)} new pairs")
-            except KeyError:
-                logger.info("No pairs created")
+    split_locations = {} if keep_locations else None
+    nsplit = nmissing = 0
+    # split locations of the files not yet split, by file index
+    located = defaultdict(dict)
+    # the index is held throughout, the workers started below share the
+    # rest of the budget
+    with memory.reserved(index.nbytes), Pod5Splitter(
+            new_pod5_dir, pod5_threads, force_overwrite=force_overwrite,
+            debug_dir=debug_dir, debug_n_reads=debug_n_reads,
+            debug_fraction=debug_fraction) as splitter:
+        for read_ids, locations in iter_split_points(
+                input_dorado_xam, threads, **kwargs):
+            nsplit += len(locations)
+            if keep_locations:
+                split_locations.update(locations)
+            for (read_id, location), i in zip(
+                    locations.items(), index.lookup(locations)):
+                if i < 0:
+                    nmissing += 1
+                else:
+                    located[i][read_id] = location
+            files = index.lookup(read_ids)
+            assessed = np.bincount(
+                files[files >= 0], minlength=len(pod5_files))
+            remaining -= assessed
+            for i in np.flatnonzero((assessed > 0) & (remaining == 0)):
+                if i in located:
+                    splitter.submit(pod5_files[i], located.pop(i))
+        for i in sorted(located):
+            splitter.submit(pod5_files[i], located.pop(i))
+    if nmissing:
+        logger.warning(
+            f"{nmissing} reads to split were not found in the pod5 files")
+    return split_locations if keep_locations else nsplit
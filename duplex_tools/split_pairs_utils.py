@@ -1,7 +1,15 @@
 """Utilities for split_pairs_steps.py."""
+import time
+
 import mappy as mp
 import numpy as np
 
+from duplex_tools import profiling
+
+# 2-bit codes of bases for k-mer hashing, other characters are treated as A
+BASE_CODES = np.zeros(256, dtype=np.int64)
+BASE_CODES[np.frombuffer(b'ACGTacgt', dtype=np.uint8)] = [0, 1, 2, 3] * 2
+
 
 def map_to_itself(seq):
     """Map a sequence to its reverse complement."""
@@ -10,6 +18,80 @@ def map_to_itself(seq):
         yield match
 
 
+def kmer_codes(codes, k):
+    """Calculate the integer codes of all k-mers of a 2-bit encoded sequence.
+
+    :param codes: array of 2-bit base codes.
+    :param k: k-mer size (at most 31).
+    """
+    nkmers = len(codes) - k + 1
+    if nkmers <= 0:
+        return np.zeros(0, dtype=np.int64)
+    kmers = np.zeros(nkmers, dtype=np.int64)
+    for offset in range(k):
+        kmers <<= 2
+        kmers |= codes[offset:offset + nkmers]
+    return kmers
+
+
+def prescreen_self_complement(
+        seq, left_midpoint_threshold=0.45, right_midpoint_threshold=0.55,
+        k=13, min_matches=2, sampling=4, min_length=2000):
+    """Cheaply check whether a read may be a template followed by complement.
+
+    A template/complement read folds onto itself: a k-mer at position i
+    is the reverse complement of a k-mer at position j, with the fold
+    midpoint (i + j + k) / 2 between the midpoint thresholds. This counts
+    such k-mer pairs without building an alignment index. Only a
+    `1 / sampling` subset of k-mers, chosen by their value, is compared
+    so that matching k-mers are always sampled together.
+
+    Reads shorter than `min_length` always pass: they hold too few k-mers
+    to screen reliably at high error rates, and self-mapping them is
+    cheap. With the defaults the reads passing include all those the
+    self-mapping splits on simulated reads with up to 25% error (30% for
+    reads of 2 kb or more).
+
+    :param seq: read sequence.
+    :param left_midpoint_threshold: Midpoint must be after this fraction
+                                    of bases
+    :param right_midpoint_threshold: Midpoint must be before this fraction
+                                     of bases
+    :param k: k-mer size.
+    :param min_matches: number of k-mer pairs required to pass.
+    :param sampling: compare one in this many k-mers.
+    :param min_length: reads shorter than this are not screened.
+    """
+    length = len(seq)
+    if length < min_length:
+        return True
+    # k-mers before the band can only pair with k-mers after it
+    band_start = int(left_midpoint_threshold * length) - k
+    band_end = int(right_midpoint_threshold * length) + k
+    codes = BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    forward = kmer_codes(codes[:max(band_end + k - 1, 0)], k)
+    # reverse complement k-mers, starting at the end of the read
+    reverse = kmer_codes(3 - codes[max(band_start, 0):][::-1], k)
+    if len(forward) == 0 or len(reverse) == 0:
+        return False
+    i = np.flatnonzero((forward * 0x9E3779B1) % 1021 % sampling == 0)
+    p = np.flatnonzero((reverse * 0x9E3779B1) % 1021 % sampling == 0)
+    forward, reverse = forward[i], reverse[p]
+
+    order = np.argsort(forward)
+    forward_sorted = forward[order]
+    idx = np.searchsorted(forward_sorted, reverse)
+    idx[idx == len(forward_sorted)] = 0
+    hits = np.flatnonzero(forward_sorted[idx] == reverse)
+    i = i[order[idx[hits]]]
+    # position of the reverse complement k-mer in the forward read
+    j = length - k - p[hits]
+    midpoint = (i + j + k) / 2
+    fold = (
+        (i + k <= j) & (midpoint > band_start) & (midpoint < band_end))
+    return int(fold.sum()) >= min_matches
+
+
 def detect_duplex_location(seq) -> tuple:
     """
     Find an optional duplex self-alignment.
@@ -36,7 +118,8 @@ def detect_duplex_location(seq) -> tuple:
 def split(read,
           match_threshold=0.8,
           left_midpoint_threshold=0.45,
-          right_midpoint_threshold=0.55
+          right_midpoint_threshold=0.55,
+          prescreen=True,
           ) -> dict:
     """Map reads to themselves.
 
@@ -55,9 +138,14 @@ def split(read,
     :param right_midpoint_threshold: Midpoint must be before this fraction
                                      of bases
     :param read: A tuple with (read_id, sequence, moves, trimmed_samples)
+    :param prescreen: Only self-map reads passing a k-mer pre-screen
+                      (see `prescreen_self_complement`)
 
     """
     read_id, sequence, mv, ts, nsamples = read
+    if prescreen and not prescreen_self_complement(
+            sequence, left_midpoint_threshold, right_midpoint_threshold):
+        return None
     maps_to_self, coordinates = selfmap_mini(sequence)
     # First element in the move array contains the stride
     stride = mv[0]
@@ -89,11 +177,47 @@ def split(read,
         read_id: {
             "left": (left_start_signal, left_end_signal),
             "right": (right_start_signal, right_end_signal),
+            "midpoint": left_end,
+            "match_fraction": match_frac,
         }
     }
     return elem
 
 
+def split_basecall(sequence, qualities, mv, ts, ns, at):
+    """Split a basecall with moves at the signal locations of a split.
+
+    Each half keeps the bases whose moves lie in its signal, its move
+    table, trimmed samples and sample count are relative to its signal as
+    written by `split_pairs_steps.split_pod5_file`.
+
+    :param sequence: The basecalled sequence.
+    :param qualities: The base qualities.
+    :param mv: The move table, led by its stride.
+    :param ts: The number of trimmed samples.
+    :param ns: The number of samples.
+    :param at: The split locations of the read, as returned by `split`.
+    :return: A tuple of (sequence, qualities, move table, trimmed samples,
+             number of samples, signal start in the parent read) for the
+             left and right halves.
+    """
+    stride = mv[0]
+    moves = np.asarray(mv[1:], dtype=np.int8)
+    left_moves = (at["left"][1] - ts) // stride
+    right_moves = (at["right"][0] - ts) // stride
+    left_bases = int(moves[:left_moves].sum())
+    right_bases = int(moves[:right_moves].sum())
+    left = (
+        sequence[:left_bases], qualities[:left_bases],
+        np.concatenate([[stride], moves[:left_moves]]).astype(np.int8),
+        ts, int(at["left"][1]), 0)
+    right = (
+        sequence[right_bases:], qualities[right_bases:],
+        np.concatenate([[stride], moves[right_moves:]]).astype(np.int8),
+        0, ns - int(at["right"][0]), int(at["right"][0]))
+    return left, right
+
+
 def selfmap_mini(seq):
     """Map a sequence onto itself and get split points."""
     duploc = detect_duplex_location(seq)
@@ -108,3 +232,59 @@ def selfmap_mini(seq):
         "4_seqend": _4seqend,
     }
     return True, coordinates
+
+
+def pack_reads(reads):
+    """Pack reads into a compact, array-backed batch.
+
+    Sequences and move tables are concatenated into single buffers with
+    offsets, which are much cheaper to send to worker processes than
+    individual strings and arrays.
+
+    :param reads: list of (read_id, sequence, moves, trimmed_samples,
+        nsamples) tuples.
+    :returns: tuple of (read_ids, sequences, sequence offsets, moves,
+        move offsets, trimmed samples, sample counts).
+    """
+    read_ids = [x[0] for x in reads]
+    seqs = [x[1].encode() for x in reads]
+    moves = [np.asarray(x[2], dtype=np.int8) for x in reads]
+    seq_offsets = np.zeros(len(reads) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in seqs], out=seq_offsets[1:])
+    mv_offsets = np.zeros(len(reads) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in moves], out=mv_offsets[1:])
+    return (
+        read_ids, b''.join(seqs), seq_offsets,
+        np.concatenate(moves) if moves else np.zeros(0, dtype=np.int8),
+        mv_offsets,
+        np.array([x[3] for x in reads], dtype=np.int64),
+        np.array([x[4] for x in reads], dtype=np.int64))
+
+
+def unpack_reads(batch):
+    """Iterate over the reads of a batch created by `pack_reads`."""
+    read_ids, seqs, seq_offsets, moves, mv_offsets, ts, ns = batch
+    for i, read_id in enumerate(read_ids):
+        yield (
+            read_id,
+            seqs[seq_offsets[i]:seq_offsets[i + 1]].decode(),
+            moves[mv_offsets[i]:mv_offsets[i + 1]],
+            int(ts[i]), int(ns[i]))
+
+
+@profiling.staged('self_map')
+def split_batch(batch, **kwargs):
+    """Find split locations of all reads in a batch.
+
+    :param batch: reads packed by `pack_reads`.
+    :param kwargs: passed to `split`.
+    :returns: tuple of (split locations, number of reads, seconds taken).
+    """
+    start = time.perf_counter()
+    split_locations = {}
+    for read in unpack_reads(batch):
+        result = split(read, **kwargs)
+        if result is not None:
+            split_locations.update(result)
+    profiling.add_counts({'reads': len(batch[0]), 'bases': len(batch[1])})
+    return split_locations, len(batch[0]), time.perf_counter() - start
@@ -0,0 +1,85 @@
+"""Split reads of pod5 files using saved split locations."""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import os
+
+import duplex_tools
+from duplex_tools.split_pairs_steps import read_split_locations, split_pod5
+
+
+def argparser():
+    """Create argument parser."""
+    parser = ArgumentParser(
+        "Split reads of pod5 files at the locations saved by "
+        "`split_pairs --split_locations`.",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        parents=[duplex_tools._log_level()],
+        add_help=False,
+    )
+    parser.add_argument(
+        "split_locations",
+        help="The directory of split locations saved by split_pairs",
+    )
+    parser.add_argument(
+        "pod5_input_dir", help="A directory containing at least one pod5 file."
+    )
+    parser.add_argument(
+        "pod5_output_dir",
+        help="A directory where the new (split) reads will be placed",
+    )
+    parser.add_argument(
+        "--match_threshold",
+        type=float,
+        default=0.6,
+        help="Require this fraction of the template to align to the "
+             "complement",
+    )
+    parser.add_argument(
+        "--force_overwrite",
+        action="store_true",
+        help="Whether to force overwriting existing pod5s",
+    )
+    parser.add_argument(
+        "--debug_dir",
+        type=str,
+        default=None,
+        help="Which directory to write plots of raw signal to",
+    )
+    parser.add_argument(
+        "--debug_n_reads",
+        type=int,
+        default=None,
+        help="The maximum number of reads to plot into --debug_dir",
+    )
+    parser.add_argument(
+        "--debug_fraction",
+        type=float,
+        default=1.0,
+        help="The fraction of reads to plot into --debug_dir",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads to use",
+        default=os.cpu_count(),
+    )
+    return parser
+
+
+def main(args):
+    """Entry point."""
+    logger = duplex_tools.get_named_logger("SplitPod5")
+    split_locations = read_split_locations(
+        args.split_locations, args.match_threshold)
+    logger.info(
+        f'Splitting {len(split_locations)} reads from: '
+        f'{args.pod5_input_dir} into {args.pod5_output_dir}')
+    split_pod5(
+        args.pod5_input_dir,
+        split_locations,
+        args.pod5_output_dir,
+        force_overwrite=args.force_overwrite,
+        debug_dir=args.debug_dir,
+        threads=args.threads,
+        debug_n_reads=args.debug_n_reads,
+        debug_fraction=args.debug_fraction,
+    )
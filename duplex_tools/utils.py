@@ -1,4 +1,5 @@
 """Utilities for duplex-tools."""
+import numpy as np
 import pysam
 
 
@@ -10,3 +11,14 @@ def contains_references(pysam_bam: pysam.AlignmentFile):
 def is_ubam(pysam_bam: pysam.AlignmentFile):
     """Check whether a bam is uBAM."""
     return not contains_references(pysam_bam)
+
+
+def mean_qscore(qualities):
+    """Calculate the mean qscore of a read from its base qualities.
+
+    The mean is taken over error probabilities, as done by the basecaller.
+    """
+    qualities = np.asarray(qualities, dtype=float)
+    if len(qualities) == 0:
+        return 0.0
+    return float(-10 * np.log10(np.mean(10 ** (-qualities / 10))))
@@ -0,0 +1,275 @@
+"""Writers for split sequence output."""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import struct
+import zlib
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pysam
+
+COMPRESSION_CHOICES = ('bgzf', 'gzip', 'none', 'zstd')
+# Maximum uncompressed payload of a BGZF block, as used by htslib
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def bgzf_block(data, level=1):
+    """Compress data into a single BGZF block.
+
+    :param data: at most `BGZF_BLOCK_SIZE` bytes.
+    :param level: zlib compression level.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    if len(cdata) > 65536 - 26:
+        # incompressible data, store it instead
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack(
+        '<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+        len(cdata) + 25)
+    footer = struct.pack('<2I', zlib.crc32(data), len(data))
+    return header + cdata + footer
+
+
+class BGZFWriter:
+    """Binary stream writing BGZF, compressing blocks in worker threads.
+
+    The output is a valid gzip file which can additionally be indexed
+    (e.g. by `samtools fqidx`).
+    """
+
+    def __init__(self, path, threads=1, level=1):
+        """Initialize the writer.
+
+        :param path: output file path.
+        :param threads: number of compression threads.
+        :param level: zlib compression level.
+        """
+        self.fh = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.max_pending = 4 * threads
+        self.executor = None
+        if threads > 1:
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def write(self, data):
+        """Write bytes to the stream."""
+        self.buffer.extend(data)
+        nblocks = len(self.buffer) // BGZF_BLOCK_SIZE
+        if nblocks == 0:
+            return
+        with memoryview(self.buffer) as view:
+            for start in range(
+                    0, nblocks * BGZF_BLOCK_SIZE, BGZF_BLOCK_SIZE):
+                self._submit(bytes(view[start:start + BGZF_BLOCK_SIZE]))
+        del self.buffer[:nblocks * BGZF_BLOCK_SIZE]
+
+    def _submit(self, block):
+        if self.executor is None:
+            self.fh.write(bgzf_block(block, self.level))
+            return
+        self.pending.append(
+            self.executor.submit(bgzf_block, block, self.level))
+        while len(self.pending) >= self.max_pending:
+            self.fh.write(self.pending.popleft().result())
+
+    def close(self):
+        """Flush all outstanding blocks and write the EOF marker."""
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.fh.write(self.pending.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+
+
+def open_stream(path, compression='bgzf', threads=1, level=1):
+    """Open a binary output stream with the requested compression.
+
+    :param path: output file path.
+    :param compression: one of `COMPRESSION_CHOICES`.
+    :param threads: number of compression threads (bgzf and zstd only).
+    :param level: compression level.
+    """
+    if compression == 'bgzf':
+        return BGZFWriter(path, threads=threads, level=level)
+    elif compression == 'gzip':
+        return gzip.open(path, mode='wb', compresslevel=level)
+    elif compression == 'none':
+        return open(path, 'wb')
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "zstd output requires the 'zstandard' package to be "
+                "installed.")
+        compressor = zstandard.ZstdCompressor(
+            level=level, threads=threads if threads > 1 else 0)
+        return compressor.stream_writer(open(path, 'wb'))
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+class FastqWriter:
+    """Write fastq records in batches to a (compressed) stream."""
+
+    suffixes = {
+        'bgzf': '.fastq.gz', 'gzip': '.fastq.gz',
+        'none': '.fastq', 'zstd': '.fastq.zst'}
+
+    def __init__(
+            self, path, compression='bgzf', threads=1, level=1,
+            batch_size=1000):
+        """Initialize the writer.
+
+        :param path: output file path.
+        :param compression: one of `COMPRESSION_CHOICES`.
+        :param threads: number of compression threads.
+        :param level: compression level.
+        :param batch_size: number of records to format per write.
+        """
+        self.stream = open_stream(path, compression, threads, level)
+        self.batch_size = batch_size
+        self.records = []
+
+    def write(self, read_id, seq, qual, comment='', tags=None):
+        """Add a record to the output, tags are not written."""
+        self.records.append(f'@{read_id} {comment}\n{seq}\n+\n{qual}\n')
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered records to the stream."""
+        if self.records:
+            self.stream.write(''.join(self.records).encode())
+            self.records = []
+
+    def close(self):
+        """Flush remaining records and close the stream."""
+        self.flush()
+        self.stream.close()
+
+    def __enter__(self):
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args):
+        """Exit context, closing the stream."""
+        self.close()
+
+
+class BamWriter:
+    """Write unaligned records to a uBAM file."""
+
+    suffix = '.bam'
+
+    def __init__(self, path, header, threads=1):
+        """Initialize the writer.
+
+        :param path: output file path.
+        :param header: header of the input uBAM, copied to the output.
+        :param threads: number of compression threads.
+        """
+        self.header = header
+        self.bam = pysam.AlignmentFile(
+            str(path), 'wb', header=header, threads=threads)
+
+    def write(self, read_id, seq, qual, comment='', tags=None):
+        """Add a record to the output.
+
+        :param tags: list of (tag, value, value_type) tuples as returned
+            by `pysam.AlignedSegment.get_tags(with_value_type=True)`.
+        """
+        record = pysam.AlignedSegment(self.header)
+        record.query_name = read_id
+        record.query_sequence = seq
+        if qual:
+            record.query_qualities = pysam.qualitystring_to_array(qual)
+        record.flag = 4
+        if tags:
+            # array tags carry their type in the array itself
+            record.set_tags([
+                (tag, value) if value_type == 'B' else (tag, value, value_type)
+                for tag, value, value_type in tags])
+        self.bam.write(record)
+
+    def close(self):
+        """Close the file."""
+        self.bam.close()
+
+    def __enter__(self):
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args):
+        """Exit context, closing the file."""
+        self.close()
+
+
+class ManifestWriter:
+    """Stream a per-read manifest of split results to a parquet file.
+
+    Each row holds the read id, its status and the start and end
+    coordinates of the parts written for the read.
+    """
+
+    suffix = '_manifest.parquet'
+    schema = pa.schema([
+        ('read_id', pa.string()),
+        ('status', pa.string()),
+        ('starts', pa.list_(pa.int64())),
+        ('ends', pa.list_(pa.int64())),
+    ])
+
+    def __init__(self, path, batch_size=100000):
+        """Initialize the writer.
+
+        :param path: output file path.
+        :param batch_size: number of rows per parquet row group.
+        """
+        self.writer = pq.ParquetWriter(str(path), self.schema)
+        self.batch_size = batch_size
+        self._clear()
+
+    def _clear(self):
+        self.rows = {name: [] for name in self.schema.names}
+        self.nrows = 0
+
+    def write(self, read_id, status, starts=(), ends=()):
+        """Add a read to the manifest."""
+        self.rows['read_id'].append(read_id)
+        self.rows['status'].append(status)
+        self.rows['starts'].append(list(starts))
+        self.rows['ends'].append(list(ends))
+        self.nrows += 1
+        if self.nrows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered rows as a row group."""
+        if self.nrows:
+            self.writer.write_table(
+                pa.Table.from_pydict(self.rows, schema=self.schema))
+            self._clear()
+
+    def close(self):
+        """Flush remaining rows and close the file."""
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args):
+        """Exit context, closing the file."""
+        self.close()
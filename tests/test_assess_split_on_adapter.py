@@ -0,0 +1,236 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pysam
+import pytest
+
+from duplex_tools import memory
+from duplex_tools.assess_split_on_adapter import assess
+from duplex_tools.writers import ManifestWriter
+
+
+def _alignment(read, ref, pos, strand, left, right, readlen=1000, cov=99):
+    return {'Read': read, 'Ref': ref, 'Pos': pos, 'Strand': strand,
+            'LeftClip': left, 'RightClip': right, 'ReadLen': readlen,
+            'ReadCov': cov}
+
+
+def _write_inputs(copies=1):
+    stats = pd.DataFrame([
+        # single alignment
+        _alignment('single_split', 'chr1', 100, 1, 0, 0),
+        _alignment('single_kept', 'chr1', 5000, 1, 0, 0),
+        # two alignments separated by an adapter sized gap
+        _alignment('gap_split', 'chr1', 100000, 1, 0, 550, cov=45),
+        _alignment('gap_split', 'chr2', 100000, -1, 0, 550, cov=45),
+        _alignment('gap_kept', 'chr1', 200000, 1, 0, 550, cov=45),
+        _alignment('gap_kept', 'chr2', 300000, 1, 550, 0, cov=45),
+        # two alignments without a gap
+        _alignment('nogap_kept', 'chr1', 400000, 1, 0, 500, cov=50),
+        _alignment('nogap_kept', 'chr2', 500000, 1, 505, 0, cov=50),
+        # split more than once
+        _alignment('multi', 'chr1', 600000, 1, 0, 0),
+        # not processed by split_on_adapter
+        _alignment('unknown', 'chr1', 700000, 1, 0, 0),
+    ])
+    statuses = {
+        'single_split': 'split', 'gap_split': 'split',
+        'single_kept': 'not_split', 'gap_kept': 'not_split',
+        'nogap_kept': 'not_split', 'multi': 'split_multiple_times'}
+    if copies > 1:
+        # spread the alignments of a read through the file
+        stats = pd.concat(
+            [stats.assign(Read=stats['Read'] + f'_{i}')
+             for i in range(copies)],
+            ignore_index=True).sample(frac=1, random_state=1)
+        statuses = {
+            f'{read}_{i}': status for read, status in statuses.items()
+            for i in range(copies)}
+    stats.to_csv('stats.tsv', sep='\t', index=False)
+    with ManifestWriter('reads_split_manifest.parquet') as manifest:
+        for read, status in statuses.items():
+            if status == 'split':
+                manifest.write(read, status, [0, 600], [450, 1000])
+            else:
+                manifest.write(read, status)
+    return stats, statuses
+
+
+def _baseline_crosstab(stats, statuses, suffix):
+    """Write the crosstab as the original per-alignment implementation."""
+    txt = stats[stats['Read'].isin(statuses)].copy()
+    txt['qstart'] = np.where(
+        txt['Strand'] == 1, txt['LeftClip'], txt['RightClip'])
+    txt['qend'] = np.where(
+        txt['Strand'] == -1,
+        txt['ReadLen'] - txt['LeftClip'], txt['ReadLen'] - txt['RightClip'])
+    by_read = txt.groupby('Read')
+    txt['read_count'] = by_read['Ref'].transform('count')
+    txt['bases_between_reads'] = np.where(
+        txt['read_count'] == 2,
+        by_read['qstart'].transform('max') - by_read['qend'].transform('min'),
+        0)
+    txt['bases_between_alignments_min'] = np.where(
+        (txt['read_count'] == 2) & (by_read['Ref'].transform('nunique') == 1),
+        by_read['Pos'].transform('max') - by_read['Pos'].transform('min'),
+        int(1e8))
+    txt['expected_class'] = None
+    txt.loc[
+        (txt['ReadCov'] > 95) & (txt['read_count'] == 1),
+        'expected_class'] = 'single_alignment_95%cov'
+    txt.loc[
+        txt['bases_between_reads'].between(20, 160)
+        & (txt['read_count'] == 2), 'expected_class'] = 'disjoint_with_gap'
+    txt.loc[
+        txt['bases_between_reads'].lt(20) & (txt['read_count'] == 2),
+        'expected_class'] = 'disjoint_without_gap'
+    txt.loc[
+        txt['bases_between_alignments_min'] < 10000,
+        'expected_class'] = 'overlapping'
+    txt.loc[
+        txt['read_count'] > 2, 'expected_class'] = 'Read_gt-2-supplementary'
+    txt = txt[txt['expected_class'] != 'overlapping']
+    txt['split_class'] = txt['Read'].map(statuses).map({
+        'split': 'Read split', 'not_split': 'Read not split',
+        'split_multiple_times': 'Split more than once'})
+    txt = txt[txt['split_class'] != 'Split more than once']
+    crosstabbed = pd.crosstab(txt['split_class'], txt['expected_class'])
+    crosstabbed.assign(label=suffix).to_csv(
+        f'baseline_{suffix}.txt', sep='\t')
+    crosstabbed.apply(lambda r: r / r.sum(), axis=0).assign(
+        label=suffix).to_csv(f'baseline_{suffix}_fraction.txt', sep='\t')
+
+
+def test_assess(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Given alignments of reads of known structure
+    _write_inputs()
+
+    # When assessing the splitting
+    assess('stats.tsv', tmp_path, suffix='test')
+
+    # Then the reads are counted in the expected classes
+    crosstab = pd.read_csv(
+        'read_splitting_assessment_test.txt', sep='\t', index_col=0)
+    assert crosstab.loc['Read split', 'single_alignment_95%cov'] == 1
+    assert crosstab.loc['Read split', 'disjoint_with_gap'] == 2
+    assert crosstab.loc['Read not split', 'single_alignment_95%cov'] == 1
+    assert crosstab.loc['Read not split', 'disjoint_with_gap'] == 2
+    assert crosstab.loc['Read not split', 'disjoint_without_gap'] == 2
+    assert crosstab['label'].unique().tolist() == ['test']
+
+
+def test_assess_chunked(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Given many alignments, with those of a read spread through the file
+    _write_inputs(copies=200)
+
+    # When assessing the splitting reading small chunks at a time
+    assess('stats.tsv', tmp_path, suffix='whole')
+    assess('stats.tsv', tmp_path, suffix='chunked', chunk_size=0.01)
+
+    # Then the counts are the same as when reading at once
+    crosstab = pd.read_csv(
+        'read_splitting_assessment_chunked.txt', sep='\t', index_col=0)
+    assert crosstab.loc['Read not split', 'disjoint_without_gap'] == 400
+    for name in ('{}', '{}_fraction'):
+        whole = pd.read_csv(
+            f'read_splitting_assessment_{name.format("whole")}.txt',
+            sep='\t', index_col=0).drop(columns='label')
+        chunked = pd.read_csv(
+            f'read_splitting_assessment_{name.format("chunked")}.txt',
+            sep='\t', index_col=0).drop(columns='label')
+        pd.testing.assert_frame_equal(whole, chunked)
+
+
+@pytest.mark.parametrize('copies,chunk_size,bam', [
+    (1, None, False), (200, 0.01, False), (200, None, True)])
+def test_assess_matches_crosstab(
+        tmp_path, monkeypatch, copies, chunk_size, bam):
+    monkeypatch.chdir(tmp_path)
+    # Given alignments of reads of known structure
+    stats, statuses = _write_inputs(copies)
+    alignments = 'stats.tsv'
+    if bam:
+        # grouped by read, in batches the first of which lacks some classes
+        alignments = 'aligned.bam'
+        _write_bam(alignments, stats.loc[
+            stats['Read'].str.startswith('gap').astype(str)
+            .str.cat(stats['Read']).sort_values(kind='stable').index])
+        monkeypatch.setenv(memory.ENV_VAR, '1')
+
+    # When assessing the splitting, in chunks or at once
+    assess(alignments, tmp_path, suffix='test', chunk_size=chunk_size)
+
+    # Then the outputs are identical to those of a crosstab per alignment
+    _baseline_crosstab(stats, statuses, 'test')
+    for name in ('test', 'test_fraction'):
+        assert Path(f'read_splitting_assessment_{name}.txt').read_text() == \
+            Path(f'baseline_{name}.txt').read_text()
+
+
+def _write_bam(path, stats, sort_order='unsorted'):
+    header = pysam.AlignmentHeader.from_dict({
+        'HD': {'VN': '1.6', 'SO': sort_order},
+        'SQ': [{'SN': 'chr1', 'LN': 10 ** 6}, {'SN': 'chr2', 'LN': 10 ** 6}]})
+    records = []
+    seen = set()
+    for row in stats.itertuples():
+        record = pysam.AlignedSegment(header)
+        record.query_name = row.Read
+        record.reference_name = row.Ref
+        record.reference_start = row.Pos - 1
+        record.mapping_quality = 60
+        aligned = row.ReadLen - row.LeftClip - row.RightClip
+        if row.Read in seen:
+            # supplementary alignments are hard clipped
+            record.flag = 2048
+            clip = pysam.CHARD_CLIP
+            record.query_sequence = 'A' * aligned
+        else:
+            clip = pysam.CSOFT_CLIP
+            record.query_sequence = 'A' * row.ReadLen
+        record.flag |= 16 if row.Strand == -1 else 0
+        record.cigartuples = [
+            (op, length) for op, length in [
+                (clip, row.LeftClip), (pysam.CMATCH, aligned),
+                (clip, row.RightClip)] if length]
+        seen.add(row.Read)
+        records.append(record)
+    # secondary and unmapped records are ignored
+    secondary = pysam.AlignedSegment.fromstring(
+        records[0].to_string(), header)
+    secondary.flag = 256
+    unmapped = pysam.AlignedSegment(header)
+    unmapped.query_name = 'single_split'
+    unmapped.query_sequence = 'A' * 100
+    unmapped.flag = 4
+    records[1:1] = [secondary, unmapped]
+    if sort_order == 'coordinate':
+        records.sort(key=lambda x: (x.reference_id, x.reference_start))
+    with pysam.AlignmentFile(str(path), 'wb', header=header) as bam:
+        for record in records:
+            bam.write(record)
+
+
+@pytest.mark.parametrize('sort_order', ['unsorted', 'coordinate'])
+def test_assess_bam(tmp_path, monkeypatch, sort_order):
+    monkeypatch.chdir(tmp_path)
+    # Given the alignments as a BAM instead of seqkit statistics
+    stats, _ = _write_inputs()
+    _write_bam('aligned.bam', stats, sort_order)
+
+    # When assessing the splitting from each
+    assess('stats.tsv', tmp_path, suffix='stats')
+    assess('aligned.bam', tmp_path, suffix='bam', threads=2)
+
+    # Then the counts are the same
+    for name in ('{}', '{}_fraction'):
+        from_stats = pd.read_csv(
+            f'read_splitting_assessment_{name.format("stats")}.txt',
+            sep='\t', index_col=0).drop(columns='label')
+        from_bam = pd.read_csv(
+            f'read_splitting_assessment_{name.format("bam")}.txt',
+            sep='\t', index_col=0).drop(columns='label')
+        pd.testing.assert_frame_equal(from_stats, from_bam)
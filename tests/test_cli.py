@@ -0,0 +1,44 @@
+import subprocess
+import sys
+
+import pytest
+
+from duplex_tools import main
+
+
+def _imported_modules(*argv):
+    script = (
+        "import sys\n"
+        "from duplex_tools import main\n"
+        "try:\n"
+        f"    main({list(argv)!r})\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(' '.join(sys.modules))\n")
+    result = subprocess.run(
+        [sys.executable, '-c', script], capture_output=True, text=True,
+        check=True)
+    return set(result.stdout.split())
+
+
+def test_version_does_not_import_subcommands():
+    imported = _imported_modules('--version')
+    assert 'pandas' not in imported
+    assert not any(x.startswith('duplex_tools.') for x in imported)
+
+
+def test_only_selected_subcommand_imported():
+    imported = _imported_modules('pair', '--help')
+    assert 'duplex_tools.pair' in imported
+    assert 'duplex_tools.split_pairs' not in imported
+    assert 'matplotlib' not in imported
+
+
+def test_help(capsys):
+    # unselected subcommands are still listed
+    with pytest.raises(SystemExit):
+        main(['--help'])
+    assert 'split_pod5' in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main(['pair', '--help'])
+    assert '--threads' in capsys.readouterr().out
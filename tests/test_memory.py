@@ -0,0 +1,103 @@
+import logging
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from duplex_tools import main, memory, simulate
+from duplex_tools.filter_pairs import filter_candidate_pairs_by_aligning
+from duplex_tools.pairs_from_summary import find_pairs
+
+
+@pytest.mark.parametrize('text,expected', [
+    ('1024', 1024), ('512M', 512 << 20), ('4G', 4 << 30), ('1.5g', 3 << 29),
+    ('2GiB', 2 << 30), ('100KB', 100 << 10)])
+def test_parse_size(text, expected):
+    assert memory.parse_size(text) == expected
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        memory.parse_size('lots')
+
+
+def test_within_budget(monkeypatch):
+    # Given no budget, the default applies
+    monkeypatch.delenv(memory.ENV_VAR, raising=False)
+    assert memory.within_budget(8, 100) == 8
+    assert memory.within_budget(None, 100) is None
+
+    # Given a budget, as many items as fit, up to the default
+    monkeypatch.setenv(memory.ENV_VAR, '1000')
+    assert memory.within_budget(8, 100) == 8
+    assert memory.within_budget(8, 100, 0.5) == 5
+    assert memory.within_budget(None, 300) == 3
+    assert memory.within_budget(8, 10000, minimum=2) == 2
+
+
+@pytest.mark.parametrize('nbytes,expected', [
+    (0, '0 B'), (1000, '1000 B'), (1536, '1.5 KiB'), (512 << 20, '512 MiB'),
+    ((1 << 30) - 1, '1024 MiB'), (4 << 30, '4 GiB')])
+def test_format_size(nbytes, expected):
+    assert memory.format_size(nbytes) == expected
+    if nbytes:
+        assert memory.parse_size(expected) == pytest.approx(nbytes, rel=1e-3)
+
+
+def test_log_usage_small_budget(monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv(memory.ENV_VAR, str(100 << 10))
+
+    memory.log_usage('Stage')
+
+    # the percentage is of the budget as logged
+    peak = memory.peak_rss_bytes()
+    assert f"({100 * peak / (100 << 10):.0f}% of 100 KiB budget)" in \
+        caplog.text
+
+
+def test_reserved(monkeypatch):
+    monkeypatch.setenv(memory.ENV_VAR, '1000')
+
+    with memory.reserved(600):
+        assert memory.within_budget(8, 100) == 4
+    assert memory.budget() == 1000
+
+    monkeypatch.delenv(memory.ENV_VAR)
+    with memory.reserved(600):
+        assert memory.budget() is None
+
+
+def test_filter_partitions_match(tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    # Given candidate pairs of a simulated run
+    summary = simulate.simulate_pairing_summary(
+        300, n_channels=8, min_length=1000, max_length=3000, seed=4)
+    bam = str(tmp_path / 'reads.bam')
+    simulate.write_dorado_bam(bam, summary)
+    pairs = find_pairs(bam, outdir=None)
+    monkeypatch.delenv(memory.ENV_VAR, raising=False)
+    expected = filter_candidate_pairs_by_aligning(pairs, bam)
+
+    # When filtering them within a budget too small for all read ends
+    # half the budget is for 20 pairs of read ends
+    monkeypatch.setenv(memory.ENV_VAR, str(2 * 20 * 2 * 450))
+    scored = filter_candidate_pairs_by_aligning(pairs, bam)
+
+    # Then the reads are scanned for each partition, with the same result
+    assert f'{-(-len(pairs) // 20)} partitions of 20 pairs' in caplog.text
+    pd.testing.assert_frame_equal(scored, expected)
+    assert 'Scanning reads: RSS' in caplog.text
+
+
+def test_max_memory_cli(tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv(memory.ENV_VAR, '0')
+    summary = Path(__file__).parent / 'data/summaries_for_pairing/seqsummary.txt'
+
+    main([
+        'pairs_from_summary', str(summary), str(tmp_path / 'pairs'),
+        '--max_memory', '4G'])
+
+    assert memory.budget() == 4 << 30
+    assert '% of 4 GiB budget' in caplog.text
@@ -0,0 +1,67 @@
+from argparse import ArgumentTypeError
+
+import numpy as np
+import pytest
+
+from duplex_tools import main, simulate
+from duplex_tools.filter_pairs import parse_shard, shard_of
+from duplex_tools.merge_pairs import merge_shards
+
+OUTPUTS = ['pair_ids_scored.csv', 'pair_ids_filtered.txt']
+
+
+@pytest.fixture(scope='module')
+def bam(tmp_path_factory):
+    summary = simulate.simulate_pairing_summary(
+        400, n_channels=8, min_length=1000, max_length=3000, seed=5)
+    path = str(tmp_path_factory.mktemp('reads') / 'reads.bam')
+    simulate.write_dorado_bam(path, summary)
+    return path
+
+
+def test_shards_merge_to_unsharded(bam, tmp_path):
+    # Given the outputs of pair on a single node
+    single = tmp_path / 'single'
+    main(['pair', bam, '--output_dir', str(single)])
+
+    # When pair is run in three shards into a shared directory and merged
+    sharded = tmp_path / 'sharded'
+    for shard in ['2/3', '3/3', '1/3']:
+        main(['pair', bam, '--output_dir', str(sharded), '--shard', shard])
+    main(['merge_pairs', str(sharded)])
+
+    # Then the merged outputs are identical to those of the single node
+    for name in OUTPUTS:
+        assert (sharded / name).read_bytes() == (single / name).read_bytes()
+    assert (sharded / 'pair_ids.txt').read_bytes() == \
+        (single / 'pair_ids.txt').read_bytes()
+    assert len((single / OUTPUTS[1]).read_text().splitlines()) > 0
+
+
+def test_merge_incomplete_shards(bam, tmp_path):
+    main(['pair', bam, '--output_dir', str(tmp_path), '--shard', '2/2'])
+
+    with pytest.raises(FileNotFoundError, match='Shards 1 of 2'):
+        merge_shards(tmp_path)
+
+
+def test_shard_of():
+    read_ids = [f'read{i}' for i in range(1000)]
+
+    shards = shard_of(read_ids, 4)
+
+    # every read is assigned to one shard, the same on each call
+    assert set(shards) == {0, 1, 2, 3}
+    np.testing.assert_array_equal(shards, shard_of(read_ids, 4))
+    assert np.bincount(shards).min() > 200
+
+
+@pytest.mark.parametrize('text,expected', [('1/1', (1, 1)), ('3/8', (3, 8))])
+def test_parse_shard(text, expected):
+    assert parse_shard(text) == expected
+
+
+@pytest.mark.parametrize('text', ['0/4', '5/4', '1', 'a/b'])
+def test_parse_shard_invalid(text):
+    with pytest.raises(ArgumentTypeError):
+        parse_shard(text)
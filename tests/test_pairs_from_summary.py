@@ -3,9 +3,12 @@ from pathlib import Path
 
 import os
 
+import numpy as np
 import pandas as pd
 
-from duplex_tools.pairs_from_summary import find_pairs
+from duplex_tools import simulate
+from duplex_tools.filter_pairs import filter_candidate_pairs_by_aligning
+from duplex_tools.pairs_from_summary import find_pairs, load_seqsummary
 
 import pkg_resources
 
@@ -67,3 +70,38 @@ def test_pairs_are_same():
     print(f'Reads missing from seq: {missing_from_seq}')
     print(f'Reads missing from bam: {missing_from_bam}')
     assert IoU > 0.9
+
+
+def test_pairs_in_memory(tmp_path):
+    # Given a loaded sequencing summary
+    summary = load_seqsummary(seqsummary)
+
+    # When finding pairs without writing files
+    pairs = find_pairs(summary, outdir=None)
+
+    # Then the pairs are those written by the command
+    written = find_pairs(seqsummary, outdir=tmp_path)
+    expected = pd.read_csv(
+        tmp_path / 'pair_ids.txt', sep=' ', names=['read_id', 'read_id_next'])
+    pd.testing.assert_frame_equal(pairs, expected, check_dtype=False)
+    pd.testing.assert_frame_equal(pairs, written)
+    # and the loaded summary is not modified
+    assert list(summary.columns) == list(load_seqsummary(seqsummary).columns)
+
+    # When scoring them against in-memory read ends
+    rng = np.random.default_rng(0)
+    read_ends = dict()
+    for i, (first, second) in enumerate(pairs.itertuples(index=False)):
+        end = simulate.random_sequence(rng, 250)
+        read_ends[(first, 0)] = end
+        # only the first pair is template/complement
+        read_ends[(second, 1)] = (
+            end if i == 0 else simulate.random_sequence(rng, 250))
+    scored = filter_candidate_pairs_by_aligning(pairs, read_ends)
+
+    # Then a scored table is returned and nothing is written
+    assert list(scored.columns) == ['read_id', 'read_id_next', 'score']
+    assert len(scored) == len(pairs)
+    assert scored['score'][0] > 0.6 > scored['score'][1:].max()
+    assert sorted(x.name for x in tmp_path.iterdir()) == [
+        'pair_ids.txt', 'pair_stats.txt']
@@ -0,0 +1,129 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+from pathlib import Path
+import pstats
+
+import pysam
+
+from duplex_tools import main, profiling, simulate
+
+
+@profiling.staged('work')
+def _work(n):
+    profiling.add_counts({'reads': 1, 'bases': n})
+    return sum(range(n))
+
+
+def test_stage_disabled():
+    # Given profiling is not configured
+    # Then stages only run their code
+    assert _work(10) == 45
+    assert profiling.report() == {}
+
+
+def test_stage_timings_merged_over_workers(tmp_path):
+    # Given profiling with cProfile is enabled
+    profiling.configure(tmp_path, 'cprofile')
+
+    # When stages run in this process and in worker processes
+    with profiling.stage('outer'):
+        with ProcessPoolExecutor(2) as executor:
+            list(executor.map(_work, [10000] * 6))
+        _work(10000)
+    timings = profiling.report()['stages']
+
+    # Then the timings of all processes are combined
+    assert timings['outer']['calls'] == 1
+    assert timings['work']['calls'] == 7
+    assert timings['work']['processes'] >= 2
+    # and the profiles of each stage are merged into a single file
+    assert sorted(x.name for x in tmp_path.iterdir()) == [
+        'outer.pstats', 'work.pstats']
+    stats = pstats.Stats(str(tmp_path / 'work.pstats')).stats
+    assert sum(
+        calls for (_, _, name), (calls, *_) in stats.items()
+        if name == '_work') == 7
+    # and profiling is disabled again
+    assert profiling.report() == {}
+
+
+def test_metrics_counters_merged_over_workers(tmp_path):
+    # Given run metrics are enabled
+    profiling.configure()
+
+    # When stages count reads in this process and in worker processes
+    with ProcessPoolExecutor(2) as executor:
+        list(executor.map(_work, [100] * 6))
+    _work(100)
+    path = tmp_path / 'metrics.json'
+    profiling.report(path, log=False, command='test')
+
+    # Then the counters of all processes are summed
+    with open(path) as fh:
+        metrics = json.load(fh)
+    assert metrics['command'] == 'test'
+    assert metrics['counters'] == {'reads': 7, 'bases': 700}
+    assert metrics['reads_per_s'] == 7 / metrics['wall_seconds']
+    assert metrics['stages']['work']['calls'] == 7
+    assert metrics['worker_processes'] >= 1
+    assert 0 < metrics['worker_utilisation']
+    assert metrics['peak_rss_mb'] > 0
+
+
+def test_metrics_with_sampling_profiler(tmp_path):
+    # Given the sampling profiler is enabled
+    profiling.configure(tmp_path, 'sampling')
+
+    # When a stage runs long enough to be sampled and counts reads
+    with profiling.stage('outer'):
+        for _ in range(20):
+            _work(100000)
+    metrics = profiling.report(log=False)
+
+    # Then the counters are those of the run, not the sampled stacks
+    assert metrics['counters'] == {'reads': 20, 'bases': 2000000}
+    assert metrics['reads_per_s'] == 20 / metrics['wall_seconds']
+    assert list(tmp_path.glob('*.folded'))
+
+
+def test_metrics_cli(tmp_path):
+    # Given a subcommand run with --metrics
+    path = tmp_path / 'metrics.json'
+    summary = Path(__file__).parent / 'data/summaries_for_pairing/seqsummary.txt'
+    main([
+        'pairs_from_summary', str(summary), str(tmp_path / 'pairs'),
+        '--metrics', str(path)])
+
+    # Then the metrics include its stages and counters
+    with open(path) as fh:
+        metrics = json.load(fh)
+    assert metrics['command'] == 'pairs_from_summary'
+    assert {'load_summary', 'compute_metrics', 'write'} <= set(
+        metrics['stages'])
+    assert metrics['counters']['reads'] > 0
+    assert metrics['bases_per_s'] > 0
+
+
+def test_filter_pairs_metrics(tmp_path):
+    # Given candidate pairs of the reads of a uBAM
+    summary = simulate.simulate_pairing_summary(
+        60, n_channels=4, min_length=300, max_length=600, seed=3)
+    bam = str(tmp_path / 'reads.bam')
+    simulate.write_dorado_bam(bam, summary)
+    main(['pair', bam, '--output_dir', str(tmp_path / 'pairs')])
+
+    # When filter_pairs is run with --metrics
+    path = tmp_path / 'metrics.json'
+    main([
+        'filter_pairs', str(tmp_path / 'pairs/pair_ids.txt'), bam,
+        '--metrics', str(path)])
+
+    # Then the throughput is that of the reads scanned
+    with open(path) as fh:
+        metrics = json.load(fh)
+    with pysam.AlignmentFile(bam, check_sq=False) as fh:
+        lengths = [x.query_length for x in fh.fetch(until_eof=True)]
+    assert metrics['counters']['reads'] == len(lengths)
+    assert metrics['counters']['bases'] == sum(lengths)
+    assert metrics['reads_per_s'] > 0
+    assert metrics['bases_per_s'] > 0
@@ -0,0 +1,110 @@
+from pathlib import Path
+import random
+
+import pysam
+import pytest
+
+from duplex_tools import simulate
+from duplex_tools.reads import parse_tag, read_batches, read_records
+from duplex_tools.writers import FastqWriter
+
+FASTQ_DIR = Path(__file__).parent / 'data/fastq_200-th-200'
+
+
+def _records(n=3000, seed=2):
+    rng = random.Random(seed)
+    for i in range(n):
+        seq = ''.join(rng.choice('ACGT') for _ in range(rng.randint(1, 500)))
+        comment = f'qs:f:{i / 4} ch:i:{i % 7}' if i % 3 else None
+        yield f'read{i}', seq, 'I' * len(seq), comment
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip', 'bgzf'])
+@pytest.mark.parametrize('threads', [1, 4])
+def test_fastq_records(tmp_path, compression, threads):
+    # Given a fastq file, larger than a chunk of the reader
+    path = tmp_path / f'reads{FastqWriter.suffixes[compression]}'
+    with FastqWriter(path, compression=compression) as writer:
+        for read_id, seq, qual, comment in _records():
+            writer.write(read_id, seq, qual, comment or '')
+
+    # When reading all the fields
+    records = list(read_records(
+        path, ('read_id', 'seq', 'qual', 'comment'), threads=threads))
+
+    # Then they are those of the reads, as read by htslib
+    expected = [
+        (x.name, x.sequence, x.quality, x.comment)
+        for x in pysam.FastxFile(str(path))]
+    assert records == expected
+    assert len(records) == 3000
+
+
+def test_fastq_projection(tmp_path):
+    path = tmp_path / 'reads.fastq'
+    with FastqWriter(path, compression='none') as writer:
+        for read_id, seq, qual, comment in _records(10):
+            writer.write(read_id, seq, qual, comment or '')
+
+    batches = list(read_batches(
+        path, ('length', 'qs', 'ch', 'tags'), batch_size=4))
+
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    expected = [
+        (len(seq), i / 4 if i % 3 else None, i % 7 if i % 3 else None, None)
+        for i, (_, seq, _, _) in enumerate(_records(10))]
+    assert [x for batch in batches for x in batch] == expected
+
+
+def test_multiline_fastq():
+    # the reads of the test data are wrapped over several lines
+    path = FASTQ_DIR / '200bases-tailhead-200bases_zipped.fastq.gz'
+    expected = [
+        (x.name, x.sequence, x.quality)
+        for x in pysam.FastxFile(str(path))]
+
+    records = list(read_records(path, ('read_id', 'seq', 'qual')))
+
+    assert records == expected
+
+
+def test_ubam_records(tmp_path):
+    summary = simulate.simulate_pairing_summary(
+        50, n_channels=4, min_length=100, max_length=300, seed=1)
+    bam = str(tmp_path / 'reads.bam')
+    simulate.write_dorado_bam(bam, summary)
+
+    records = list(read_records(
+        bam, ('read_id', 'length', 'ch', 'xx', 'tags'), threads=2))
+
+    with pysam.AlignmentFile(bam, check_sq=False) as fh:
+        expected = [
+            (x.query_name, x.query_length, x.get_tag('ch'), None,
+             x.get_tags(with_value_type=True))
+            for x in fh.fetch(until_eof=True)]
+    assert records == expected
+
+
+def test_stop_early(tmp_path):
+    path = tmp_path / 'reads.fastq'
+    with FastqWriter(path, compression='none') as writer:
+        for read_id, seq, qual, comment in _records():
+            writer.write(read_id, seq, qual, comment or '')
+
+    batches = read_batches(path, batch_size=10, read_ahead=1)
+    assert len(next(batches)) == 10
+    batches.close()
+
+
+@pytest.mark.parametrize('item,expected', [
+    ('qs:f:9.5', ('qs', 9.5)), ('ch:i:12', ('ch', 12)),
+    ('st:Z:2023-01-01T00:00:00', ('st', '2023-01-01T00:00:00')),
+    ('mv:B:c,5,1,0', ('mv', [5, 1, 0])), ('runid=abc', None),
+    ('xx:i:abc', None)])
+def test_parse_tag(item, expected):
+    assert parse_tag(item) == expected
+
+
+def test_unknown_field(tmp_path):
+    with pytest.raises(ValueError):
+        read_batches(tmp_path / 'reads.fastq', ('sequence',))
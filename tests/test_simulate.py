@@ -0,0 +1,68 @@
+import pandas as pd
+
+from duplex_tools import simulate
+from duplex_tools.filter_pairs import filter_candidate_pairs_by_aligning
+from duplex_tools.pairs_from_summary import find_pairs
+from duplex_tools.split_on_adapter import build_targets, find_mid_adaptor
+from duplex_tools.split_pairs_utils import split
+
+
+def test_simulation_is_reproducible():
+    first = list(simulate.simulate_concatemers(5, seed=3))
+    second = list(simulate.simulate_concatemers(5, seed=3))
+    assert first == second
+    assert first != list(simulate.simulate_concatemers(5, seed=4))
+
+
+def test_mutate_error_free():
+    rng = simulate.np.random.default_rng(0)
+    seq = simulate.random_sequence(rng, 100)
+    assert simulate.mutate(rng, seq, 0) == seq
+    assert len(simulate.mutate(rng, seq, 0.3)) > 0
+
+
+def test_simulated_adapters_are_found():
+    targets = build_targets(
+        n_bases_to_mask_head=5, n_bases_to_mask_tail=14,
+        degenerate_bases=11)['Native']
+    records = simulate.simulate_concatemers(
+        20, fraction_concatemers=1, error_rate=0, max_length=3000, seed=1)
+    for _, seq, _, start, end in records:
+        result = find_mid_adaptor(seq, targets)
+        assert result['editDistance'] < 9
+        assert start <= result['locations'][0][0] < end
+
+
+def test_simulated_template_complement_is_split(tmp_path):
+    records = list(simulate.simulate_template_complement(
+        10, fraction_pairs=1, error_rate=0.02, max_length=5000, seed=2))
+    truth = simulate.write_moves_bam(tmp_path / 'moves.bam', records)
+    for read_id, seq, _, mv, ts, ns, midpoint in records:
+        result = split((read_id, seq, mv, ts, ns))
+        assert result is not None
+        assert abs(result[read_id]['left'][1] - truth[read_id][1]) < 1000
+        assert result[read_id]['right'][1] == ns
+
+
+def test_simulated_pairs_are_found(tmp_path):
+    summary = simulate.simulate_pairing_summary(
+        500, n_channels=16, min_length=1000, max_length=3000, seed=3)
+    assert len(summary) == 500
+    pd.testing.assert_frame_equal(
+        summary, simulate.simulate_pairing_summary(
+            500, n_channels=16, min_length=1000, max_length=3000, seed=3))
+    truth = simulate.pairing_truth(summary)
+    assert len(truth) > 0
+
+    simulate.write_sequencing_summary(tmp_path / 'summary.txt', summary)
+    simulate.write_dorado_bam(tmp_path / 'reads.bam', summary)
+    from_summary = find_pairs(tmp_path / 'summary.txt', outdir=None)
+    from_bam = find_pairs(str(tmp_path / 'reads.bam'), outdir=None)
+    pd.testing.assert_frame_equal(from_summary, from_bam)
+    candidates = set(zip(from_bam['read_id'], from_bam['read_id_next']))
+    assert truth <= candidates
+
+    scored = filter_candidate_pairs_by_aligning(
+        from_bam, str(tmp_path / 'reads.bam'))
+    passed = scored[scored['score'] > 0.6]
+    assert set(zip(passed['read_id'], passed['read_id_next'])) == truth
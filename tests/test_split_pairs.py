@@ -0,0 +1,330 @@
+import uuid
+
+import numpy as np
+import pytest
+import pandas as pd
+from pod5 import EndReasonEnum, Reader
+import pysam
+
+from duplex_tools import simulate
+from duplex_tools.split_pairs_steps import (
+    chunk_path, get_split_points, index_pod5_reads, Pod5ReadIndex,
+    read_split_locations, sample_debug_reads,
+    signal_envelope, split_pairs_pipelined, split_pod5,
+    write_split_bam)
+from duplex_tools.split_pairs_utils import (
+    pack_reads, prescreen_self_complement, split, unpack_reads)
+
+
+def _reads(n=20, seed=0):
+    return [
+        (read_id, seq, mv, ts, ns)
+        for read_id, seq, _, mv, ts, ns, _ in
+        simulate.simulate_template_complement(
+            n, max_length=4000, seed=seed)]
+
+
+def test_pack_reads_roundtrip():
+    reads = _reads()
+    unpacked = list(unpack_reads(pack_reads(reads)))
+    assert len(unpacked) == len(reads)
+    for (read_id, seq, mv, ts, ns), packed in zip(reads, unpacked):
+        assert packed[0] == read_id
+        assert packed[1] == seq
+        assert np.array_equal(packed[2], np.asarray(mv))
+        assert packed[3:] == (ts, ns)
+
+
+def test_get_split_points_matches_split(tmp_path):
+    records = list(simulate.simulate_template_complement(
+        60, max_length=4000, seed=1))
+    bam = tmp_path / 'moves.bam'
+    simulate.write_moves_bam(bam, records)
+    expected = {}
+    for read_id, seq, _, mv, ts, ns, _ in records:
+        expected.update(split((read_id, seq, mv, ts, ns)) or {})
+
+    split_locations = get_split_points(
+        str(bam), threads=2, batch_size=7, chunk_size=10)
+
+    assert split_locations == expected
+    assert len(split_locations) > 0
+
+
+def test_prescreen_self_complement():
+    records = list(simulate.simulate_template_complement(
+        100, max_length=4000, error_rate=0.15, seed=2))
+    for _, seq, _, _, _, _, midpoint in records:
+        if midpoint is not None:
+            assert prescreen_self_complement(seq)
+    # random sequences are rejected
+    rejected = [
+        not prescreen_self_complement(seq)
+        for _, seq, _, _, _, _, midpoint in records if midpoint is None]
+    assert sum(rejected) / len(rejected) > 0.9
+
+
+@pytest.mark.parametrize('min_length,max_length,error_rate,seed', [
+    (2000, 4000, 0.15, 3), (2000, 4000, 0.25, 3), (300, 1500, 0.2, 1)])
+def test_prescreen_keeps_split_points(
+        min_length, max_length, error_rate, seed):
+    # the reads split are those split without the pre-screen, also for
+    # short reads with many errors
+    records = list(simulate.simulate_template_complement(
+        100, min_length=min_length, max_length=max_length,
+        error_rate=error_rate, seed=seed))
+    for read_id, seq, _, mv, ts, ns, _ in records:
+        read = (read_id, seq, mv, ts, ns)
+        assert split(read) == split(read, prescreen=False)
+
+
+def _write_pod5s(directory, nfiles=4, nreads=5):
+    rng = np.random.default_rng(0)
+    read_ids = []
+    for i in range(nfiles):
+        records = [
+            (str(uuid.UUID(int=int(rng.integers(2 ** 63)), version=4)),
+             rng.integers(-100, 100, 1000).astype(np.int16))
+            for _ in range(nreads)]
+        simulate.write_pod5(directory / f'reads_{i}.pod5', records)
+        read_ids.append([read_id for read_id, _ in records])
+    return read_ids
+
+
+def test_index_pod5_reads(tmp_path):
+    read_ids = _write_pod5s(tmp_path)
+    pod5s = [tmp_path / f'reads_{i}.pod5' for i in range(len(read_ids))]
+    wanted = read_ids[0][:2] + read_ids[2][-1:]
+
+    index = index_pod5_reads(pod5s, wanted, threads=2)
+
+    assert index == {pod5s[0]: read_ids[0][:2], pod5s[2]: read_ids[2][-1:]}
+
+
+def test_pod5_read_index(tmp_path):
+    read_ids = _write_pod5s(tmp_path)
+    pod5s = [tmp_path / f'reads_{i}.pod5' for i in range(len(read_ids))]
+
+    index = Pod5ReadIndex(pod5s, threads=2)
+
+    assert len(index) == sum(map(len, read_ids))
+    assert list(index.counts) == [len(x) for x in read_ids]
+    np.testing.assert_array_equal(
+        index.lookup([read_ids[2][0], 'missing', read_ids[0][-1]]),
+        [2, -1, 0])
+
+
+def test_split_pod5_only_affected_files(tmp_path):
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    read_ids = _write_pod5s(input_dir)
+    at = {'left': (0, 400), 'right': (450, 1000)}
+    split_locations = {read_ids[1][0]: at, read_ids[3][2]: at}
+
+    split_pod5(input_dir, split_locations, tmp_path / 'output', threads=2)
+
+    outputs = sorted(x.name for x in (tmp_path / 'output').glob('*.pod5'))
+    assert outputs == [
+        'reads_1_split_duplex.pod5', 'reads_3_split_duplex.pod5']
+    with Reader(input_dir / 'reads_1.pod5') as reader:
+        original = next(reader.reads(selection=[read_ids[1][0]]))
+        signal = original.signal
+        read_number = original.read_number
+    with Reader(tmp_path / 'output' / outputs[0]) as reader:
+        halves = sorted(
+            (read.signal for read in reader.reads()), key=len)
+        assert {read.read_number for read in reader.reads()} == {
+            read_number}
+    assert np.array_equal(halves[0], signal[:400])
+    assert np.array_equal(halves[1], signal[450:])
+    pairs = pd.read_csv(
+        tmp_path / 'output' / 'reads_1_split_duplex.txt', sep='\t')
+    assert list(pairs['read_id']) == [read_ids[1][0]]
+
+
+def test_signal_envelope():
+    signal = np.arange(10, dtype=np.int16)[::-1].copy()
+    starts, mins, maxs = signal_envelope(signal, width=4)
+    assert list(starts) == [0, 2, 5, 7]
+    assert list(mins) == [8, 5, 3, 0]
+    assert list(maxs) == [9, 7, 4, 2]
+    starts, mins, maxs = signal_envelope(signal, width=20)
+    assert np.array_equal(mins, signal) and np.array_equal(maxs, signal)
+
+
+def test_sample_debug_reads():
+    read_ids = [str(i) for i in range(100)]
+    assert len(sample_debug_reads(read_ids)) == 100
+    assert len(sample_debug_reads(read_ids, fraction=0.1)) == 10
+    assert len(sample_debug_reads(read_ids, n_reads=3, fraction=0.1)) == 3
+    assert sample_debug_reads(read_ids, n_reads=3) == \
+        sample_debug_reads(read_ids[::-1], n_reads=3)
+
+
+def test_split_pod5_debug_plots(tmp_path):
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    read_ids = _write_pod5s(input_dir, nfiles=2)
+    at = {'left': (0, 400), 'right': (450, 1000)}
+    split_locations = {read_id: at for read_id in read_ids[0]}
+
+    split_pod5(
+        input_dir, split_locations, tmp_path / 'output',
+        debug_dir=tmp_path / 'debug', debug_n_reads=2)
+
+    plots = list((tmp_path / 'debug').glob('*.png'))
+    assert len(plots) == 2
+    assert {x.stem for x in plots} <= set(read_ids[0])
+
+
+def _pod5s_with_moves(directory, nfiles=3, nreads=8):
+    """Write template/complement reads to a moves BAM and pod5 files."""
+    rng = np.random.default_rng(4)
+    records = []
+    for record in simulate.simulate_template_complement(
+            nfiles * nreads, max_length=3000, seed=4):
+        read_id = str(uuid.UUID(int=int(rng.integers(2 ** 63)), version=4))
+        records.append((read_id,) + record[1:])
+    bam = directory / 'moves.bam'
+    simulate.write_moves_bam(bam, records)
+    pod5_dir = directory / 'pod5'
+    pod5_dir.mkdir()
+    for i in range(nfiles):
+        simulate.write_pod5(
+            pod5_dir / f'reads_{i}.pod5',
+            [(read_id, rng.integers(-100, 100, ns).astype(np.int16))
+             for read_id, _, _, _, _, ns, _ in
+             records[i * nreads:(i + 1) * nreads]])
+    return bam, pod5_dir
+
+
+def test_split_pairs_pipelined(tmp_path):
+    bam, pod5_dir = _pod5s_with_moves(tmp_path)
+    split_locations = get_split_points(str(bam), threads=1)
+    split_pod5(pod5_dir, split_locations, tmp_path / 'sequential')
+
+    pipelined = split_pairs_pipelined(
+        str(bam), pod5_dir, tmp_path / 'pipelined', threads=2,
+        batch_size=5, keep_locations=True)
+
+    assert len(split_locations) > 0
+    assert pipelined == split_locations
+    # without keeping locations only the number of reads split is returned
+    assert split_pairs_pipelined(
+        str(bam), pod5_dir, tmp_path / 'counted', threads=2,
+        batch_size=5) == len(split_locations)
+    expected = sorted(
+        x.name for x in (tmp_path / 'sequential').iterdir())
+    assert sorted(
+        x.name for x in (tmp_path / 'pipelined').iterdir()) == expected
+    for name in expected:
+        if name.endswith('.txt'):
+            assert (tmp_path / 'sequential' / name).read_text() == \
+                (tmp_path / 'pipelined' / name).read_text()
+
+
+def test_split_locations_table(tmp_path):
+    bam, _ = _pod5s_with_moves(tmp_path, nfiles=2, nreads=20)
+    expected = get_split_points(str(bam), threads=1)
+    table = tmp_path / 'split_locations'
+
+    split_locations = get_split_points(
+        str(bam), threads=2, chunk_size=7, batch_size=3,
+        split_locations_dir=table)
+
+    assert split_locations == expected
+    assert len(list(table.glob('chunk_*.parquet'))) == 6
+    assert read_split_locations(table, match_threshold=0.8) == expected
+    # the table keeps reads below the match threshold
+    assert len(read_split_locations(table)) >= len(expected)
+
+    # resume after losing the last chunks
+    chunk_path(table, 4).unlink()
+    chunk_path(table, 5).unlink()
+    with pytest.raises(FileExistsError):
+        get_split_points(str(bam), chunk_size=7, split_locations_dir=table)
+    with pytest.raises(ValueError):
+        get_split_points(
+            str(bam), chunk_size=10, split_locations_dir=table, resume=True)
+    resumed = get_split_points(
+        str(bam), threads=2, chunk_size=7, batch_size=3,
+        split_locations_dir=table, resume=True)
+    assert resumed == expected
+    assert len(list(table.glob('chunk_*.parquet'))) == 6
+
+
+def test_write_split_bam(tmp_path):
+    bam, pod5_dir = _pod5s_with_moves(tmp_path)
+    split_locations = get_split_points(str(bam), threads=1)
+    split_pod5(pod5_dir, split_locations, tmp_path / 'output')
+    output_bam = tmp_path / 'output' / 'split.bam'
+
+    nsplit = write_split_bam(str(bam), split_locations, output_bam)
+
+    assert nsplit == len(split_locations) > 0
+    pair_ids = pd.concat([
+        pd.read_csv(x, sep='\t')
+        for x in (tmp_path / 'output').glob('*_split_duplex.txt')])
+    pair_ids = pair_ids.set_index('read_id')
+    with pysam.AlignmentFile(str(bam), check_sq=False) as fh:
+        parents = {read.query_name: read for read in fh.fetch(until_eof=True)}
+    with pysam.AlignmentFile(str(output_bam), check_sq=False) as fh:
+        halves = list(fh.fetch(until_eof=True))
+    assert len(halves) == 2 * nsplit
+    for left, right in zip(halves[::2], halves[1::2]):
+        parent = parents[left.get_tag('pi')]
+        assert left.query_name == \
+            pair_ids.loc[parent.query_name, 'read_id_left']
+        assert right.query_name == \
+            pair_ids.loc[parent.query_name, 'read_id_right']
+        assert left.query_sequence + right.query_sequence == \
+            parent.query_sequence
+        at = split_locations[parent.query_name]
+        stride = parent.get_tag('mv')[0]
+        for half, start, end in (
+                (left, 0, at['left'][1]), (right, *at['right'])):
+            mv = half.get_tag('mv')
+            assert mv[0] == stride
+            assert sum(mv[1:]) == half.query_length
+            assert half.get_tag('sp') == start
+            assert half.get_tag('ns') == end - start
+            assert half.get_tag('ns') - half.get_tag('ts') == \
+                (len(mv) - 1) * stride
+
+
+def test_split_halves_keep_read_metadata(tmp_path):
+    # Given a read split in two
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    read_id = _write_pod5s(input_dir, nfiles=1, nreads=3)[0][1]
+    at = {'left': (10, 400), 'right': (450, 990)}
+
+    split_pod5(input_dir, {read_id: at}, tmp_path / 'output')
+
+    # Then each half keeps the metadata of the read, with its slice of the
+    # signal and, as the end of the read is not that of its halves, an
+    # unknown end reason
+    with Reader(input_dir / 'reads_0.pod5') as reader:
+        parent = next(reader.reads(selection=[read_id]))
+        signal = parent.signal
+        metadata = {
+            name: getattr(parent, name)
+            for name in ('pore', 'calibration', 'read_number',
+                         'start_sample', 'median_before')}
+        run_info = parent.run_info
+    pairs = pd.read_csv(tmp_path / 'output' / 'reads_0_split_duplex.txt',
+                        sep='\t')
+    with Reader(tmp_path / 'output' / 'reads_0_split_duplex.pod5') as reader:
+        halves = {str(read.read_id): read for read in reader.reads()}
+        assert len(halves) == 2
+        for column, side in (('read_id_left', 'left'),
+                             ('read_id_right', 'right')):
+            half = halves[pairs[column][0]]
+            start, end = at[side]
+            np.testing.assert_array_equal(half.signal, signal[start:end])
+            assert half.num_samples == end - start
+            assert half.run_info == run_info
+            assert half.end_reason.reason == EndReasonEnum.UNKNOWN
+            assert not half.end_reason.forced
+            for name, value in metadata.items():
+                assert getattr(half, name) == value, name
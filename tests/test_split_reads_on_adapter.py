@@ -1,3 +1,4 @@
+import array
 import io
 import tempfile
 from contextlib import redirect_stderr
@@ -6,10 +7,15 @@ from pathlib import Path
 import os
 
 import duplex_tools
+import numpy as np
+import pandas as pd
 import pkg_resources
+import pysam
 import shutil
 import logging
-from duplex_tools.split_on_adapter import split
+from duplex_tools import simulate
+from duplex_tools.split_on_adapter import (
+    build_targets, EDIT_THRESHOLDS, split, split_parts, split_reads)
 
 
 def test_split_on_adapter(caplog):
@@ -31,6 +37,10 @@ def test_split_on_adapter(caplog):
     # Then (1) there are files created in the expected locations
     assert os.path.exists(dir)
     assert (Path(dir) / expected_file).is_file()
+    manifest = pd.read_parquet(
+        Path(dir) / '200bases-tailhead-200bases_split_manifest.parquet')
+    assert manifest['status'].tolist() == ['split']
+    assert manifest['starts'][0].tolist() == [0, 245]
 
     # Then (2) stdout from script contains the number of split reads
     print(output.getvalue())
@@ -74,3 +84,182 @@ def test_split_multiple_on_adapter(caplog):
 
     # Then (2) stdout from script contains the number of split reads
     assert "Split 1 reads" in ''.join(caplog.text)
+
+
+def test_split_ubam_on_adapter(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    # Given a uBAM with dorado-like tags
+    filename_in = pkg_resources.resource_filename(
+        'tests.data.fastq_200-th-200', '200bases-tailhead-200bases.fastq')
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    header = pysam.AlignmentHeader.from_dict(
+        {'HD': {'VN': '1.6', 'SO': 'unknown'}})
+    with pysam.AlignmentFile(
+            str(input_dir / 'reads.bam'), 'wb', header=header) as bam:
+        for read in pysam.FastxFile(filename_in):
+            record = pysam.AlignedSegment(header)
+            record.query_name = read.name
+            record.query_sequence = read.sequence
+            record.query_qualities = pysam.qualitystring_to_array(
+                read.quality)
+            record.flag = 4
+            record.set_tags([
+                ('ch', 1, 'i'), ('qs', 16, 'i'),
+                ('mv', array.array('b', [5, 1, 0]))])
+            bam.write(record)
+
+    # When splitting it
+    output_dir = tmp_path / 'output'
+    split(input_dir, output_dir=output_dir, pattern='*.bam')
+
+    # Then the split halves are written to a uBAM with adjusted tags
+    assert "Split 1 reads" in caplog.text
+    with pysam.AlignmentFile(
+            str(output_dir / 'reads_split.bam'), check_sq=False) as bam:
+        records = list(bam.fetch(until_eof=True))
+    assert [x.query_name for x in records] == [
+        '200bases-tailhead-200bases_1', '200bases-tailhead-200bases_2']
+    for record in records:
+        assert record.get_tag('pi') == '200bases-tailhead-200bases'
+        assert record.get_tag('ch') == 1
+        assert record.get_tag('qs') == 16
+        assert not record.has_tag('mv')
+        assert len(record.query_qualities) == len(record.query_sequence)
+
+
+def test_split_resume(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    fastq_dir = pkg_resources.resource_filename(
+        'tests.data', 'fastq_200-th-200')
+    output_dir = tmp_path / 'output'
+    split(fastq_dir, output_dir=output_dir)
+    markers = sorted(output_dir.glob('*.done'))
+    assert len(markers) == 2
+    assert not list(output_dir.glob('*.partial'))
+
+    # When one file is unfinished, only that one is processed again
+    markers[0].unlink()
+    caplog.clear()
+    split(fastq_dir, output_dir=output_dir, resume=True)
+    assert 'Resuming: 1 of 2 files already completed' in caplog.text
+    assert 'Split 2 reads' in caplog.text
+    assert markers[0].is_file()
+
+
+def _pair_reads(input_dir):
+    rng = np.random.default_rng(5)
+    adapter = simulate.adapter_sequences('Native')[0]
+    template = simulate.random_sequence(rng, 1000)
+    reads = {
+        # template followed by its complement
+        'duplex': template + adapter + simulate.reverse_complement(template),
+        'chimera': template + adapter + simulate.random_sequence(rng, 1000),
+        'unsplit': simulate.random_sequence(rng, 2000)}
+    input_dir.mkdir()
+    simulate.write_fastq(
+        input_dir / 'reads.fastq',
+        [(read_id, seq, '?' * len(seq), None, None)
+         for read_id, seq in reads.items()])
+
+
+def test_split_write_pairs(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    input_dir = tmp_path / 'input'
+    _pair_reads(input_dir)
+
+    split(input_dir, output_dir=tmp_path / 'output', score_pairs=True)
+
+    output = tmp_path / 'output'
+    assert (output / 'reads_split_pair_ids.txt').read_text() == (
+        'duplex_1 duplex_2\nchimera_1 chimera_2\n')
+    scored = pd.read_csv(output / 'reads_split_pair_ids_scored.csv')
+    assert list(scored['read_id']) == ['duplex_1', 'chimera_1']
+    assert scored['score'][0] > 0.6 > scored['score'][1]
+    assert (output / 'reads_split_pair_ids_filtered.txt').read_text() == (
+        'duplex_1 duplex_2\n')
+    assert 'Wrote 2 pairs of split reads' in caplog.text
+
+
+def test_split_resume_pair_counts(tmp_path):
+    # Given files split with and without scoring pairs
+    input_dir = tmp_path / 'input'
+    _pair_reads(input_dir)
+    scored = split(input_dir, output_dir=tmp_path / 'scored', score_pairs=True)
+    unpaired = split(input_dir, output_dir=tmp_path / 'unpaired')
+    assert scored['pairs'] == 2 and scored['good_pairs'] == 1
+    assert unpaired.get('pairs', 0) == 0
+
+    markers = [
+        tmp_path / name / 'reads_split.done' for name in ('scored', 'unpaired')]
+    written = [x.stat().st_mtime_ns for x in markers]
+
+    # When resuming from the completed files
+    # Then the counts of the completed files are restored
+    assert split(
+        input_dir, output_dir=tmp_path / 'scored', score_pairs=True,
+        resume=True) == scored
+    assert split(
+        input_dir, output_dir=tmp_path / 'unpaired', resume=True) == unpaired
+    # without processing them again
+    assert [x.stat().st_mtime_ns for x in markers] == written
+
+
+
+def test_split_resume_stale_outputs(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    input_dir = tmp_path / 'input'
+    _pair_reads(input_dir)
+    output_dir = tmp_path / 'output'
+    split(input_dir, output_dir=output_dir, compression='gzip')
+
+    # When resuming with other output options, or after the input changed
+    # Then the outputs are written again
+    for kwargs in ({'compression': 'bgzf'}, {'write_pairs': True}):
+        caplog.clear()
+        split(input_dir, output_dir=output_dir, resume=True, **kwargs)
+        assert 'Resuming: 0 of 1 files already completed' in caplog.text
+    assert (output_dir / 'reads_split_pair_ids.txt').is_file()
+
+    caplog.clear()
+    split(input_dir, output_dir=output_dir, resume=True, write_pairs=True)
+    assert 'Resuming: 1 of 1 files already completed' in caplog.text
+
+    with open(input_dir / 'reads.fastq', 'a') as fh:
+        fh.write('@extra\nACGT\n+\n????\n')
+    caplog.clear()
+    counts = split(
+        input_dir, output_dir=output_dir, resume=True, write_pairs=True)
+    assert 'Resuming: 0 of 1 files already completed' in caplog.text
+    assert counts['unedited'] == 2
+
+
+def test_split_reads_in_memory():
+    # Given reads with and without an adapter
+    rng = np.random.default_rng(6)
+    adapter = simulate.adapter_sequences('Native')[0]
+    left = simulate.random_sequence(rng, 1000)
+    right = simulate.random_sequence(rng, 1000)
+    reads = [
+        ('split', left + adapter + right, '?' * 2000 + '+' * len(adapter),
+         'comment', None),
+        ('unsplit', left, '?' * 1000, 'comment', None)]
+    targets = build_targets(
+        n_bases_to_mask_head=5, n_bases_to_mask_tail=14,
+        degenerate_bases=11)['Native']
+
+    # When splitting them in memory
+    results = list(split_reads(iter(reads), targets, EDIT_THRESHOLDS['Native']))
+
+    # Then each read is classified
+    assert [(read[0], status) for read, status, _ in results] == [
+        ('split', 'split'), ('unsplit', 'not_split')]
+    # and the parts of the split read are on either side of the adapter
+    read, _, hits = results[0]
+    parts = list(split_parts(read, hits))
+    assert [part[0] for part, _, _ in parts] == ['split_1', 'split_2']
+    (first, _, end), (second, start, _) = parts
+    assert abs(end - 1000) < 30
+    assert abs(start - 1000 - len(adapter)) < 30
+    assert first[1] == read[1][:end]
+    assert first[3] == f'comment 0->{end}'
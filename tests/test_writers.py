@@ -0,0 +1,40 @@
+import gzip
+import random
+
+import pysam
+import pytest
+
+from duplex_tools.writers import FastqWriter
+
+
+def _records(n=5000, seed=1):
+    rng = random.Random(seed)
+    for i in range(n):
+        seq = ''.join(rng.choice('ACGT') for _ in range(rng.randint(1, 300)))
+        yield f'read{i}', seq, 'I' * len(seq), f'comment{i}'
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_bgzf_writer_roundtrip(tmp_path, threads):
+    path = tmp_path / 'out.fastq.gz'
+    with FastqWriter(path, compression='bgzf', threads=threads) as writer:
+        for record in _records():
+            writer.write(*record)
+
+    expected = ''.join(
+        f'@{read_id} {comment}\n{seq}\n+\n{qual}\n'
+        for read_id, seq, qual, comment in _records())
+    with gzip.open(path, 'rt') as fh:
+        assert fh.read() == expected
+    # readable as BGZF by htslib
+    with pysam.libcbgzf.BGZFile(str(path), 'rb') as fh:
+        assert fh.read().decode() == expected
+
+
+def test_uncompressed_writer(tmp_path):
+    path = tmp_path / 'out.fastq'
+    with FastqWriter(path, compression='none', batch_size=7) as writer:
+        for record in _records(20):
+            writer.write(*record)
+    names = [x.name for x in pysam.FastxFile(str(path))]
+    assert names == [f'read{i}' for i in range(20)]